@@ -0,0 +1,100 @@
+"""Balance reads and writes must not get slower as an account accumulates history.
+
+Seeds accounts with growing transaction/snapshot history and times
+``get_user_balance`` and ``create_transaction`` against each of them.
+
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/history_scaling.py --max-ratio 1.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import dotenv
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.enums import TransactionType
+from app.models import Base, BalancesSnapshots, Transaction, User
+from app.repositories import PaymentRepository
+from app.schemas import TransactionCreate
+
+dotenv.load_dotenv()
+
+
+async def seed_user(session_maker: async_sessionmaker, history: int) -> uuid.UUID:
+    user_id = uuid.uuid4()
+    started = datetime.utcnow() - timedelta(seconds=history)
+    async with session_maker() as session, session.begin():
+        session.add(User(id=user_id, name=f"history-{history}", balance=Decimal(history)))
+        await session.flush()
+        for chunk in range(0, history, 5000):
+            rows = range(chunk, min(chunk + 5000, history))
+            await session.execute(sa.insert(Transaction), [
+                {"id": uuid.uuid4(), "user_id": user_id, "amount": Decimal(1),
+                 "type": TransactionType.DEPOSIT, "created_at": started + timedelta(seconds=i)}
+                for i in rows
+            ])
+            await session.execute(sa.insert(BalancesSnapshots), [
+                {"user_id": user_id, "balance": Decimal(i + 1), "created_at": started + timedelta(seconds=i)}
+                for i in rows
+            ])
+    return user_id
+
+
+async def measure(repo: PaymentRepository, user_id: uuid.UUID, iterations: int) -> dict[str, float]:
+    reads, writes = [], []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await repo.get_user_balance(user_id)
+        reads.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await repo.create_transaction(TransactionCreate(
+            id=uuid.uuid4(), user_id=user_id, amount=Decimal("0.01"), type=TransactionType.DEPOSIT,
+        ))
+        writes.append(time.perf_counter() - start)
+    return {
+        "read_p50_ms": statistics.median(reads) * 1000,
+        "write_p50_ms": statistics.median(writes) * 1000,
+    }
+
+
+async def main(args: argparse.Namespace) -> int:
+    engine = create_async_engine(args.dsn)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    repo = PaymentRepository(session_maker)
+    results = {}
+    for history in args.history:
+        user_id = await seed_user(session_maker, history)
+        await measure(repo, user_id, 5)  # warm up
+        results[history] = await measure(repo, user_id, args.iterations)
+    await engine.dispose()
+
+    baseline = results[min(results)]
+    worst_ratio = max(
+        result[key] / baseline[key]
+        for result in results.values()
+        for key in baseline
+    )
+    print(json.dumps({"results": results, "worst_ratio": worst_ratio}, indent=2))
+    return 1 if args.max_ratio and worst_ratio > args.max_ratio else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL"))
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 1_000, 10_000, 50_000])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--max-ratio", type=float, default=None,
+                        help="fail if any size is this many times slower than the smallest one")
+    sys.exit(asyncio.run(main(parser.parse_args())))
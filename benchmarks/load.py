@@ -0,0 +1,326 @@
+"""Load test of the payments API: throughput, latency percentiles, lock waits and DB round trips per mix.
+
+Each mix seeds its accounts through ``POST /api/users/`` and a first deposit,
+then runs ``--concurrency`` clients for ``--duration`` seconds, each picking
+operations by the mix weights:
+
+- ``hot_account``: a handful of accounts, mostly writes, measures row lock contention
+- ``uniform``: writes and reads spread over many accounts
+- ``read_heavy``: mostly current balance reads
+- ``historical``: mostly balance-as-of-ts reads over the seeded history
+
+By default the app runs in this process behind an ASGI transport with the
+settings from the environment (TRANSACTION_WRITE_MODE, caches, ...), which
+also lets it count DB round trips per request. ``--url`` targets a running
+server instead; round trips are not reported then. Lock waits are sampled
+from pg_stat_activity through ``--dsn`` in both cases. The JSON report
+carries the commit and settings it ran with, compare reports across commits.
+
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/load.py --mix hot_account uniform --output load.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import typing
+import uuid
+from datetime import datetime
+
+import dotenv
+import httpx
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import create_async_engine
+
+dotenv.load_dotenv()
+
+OPERATIONS: typing.Final = ("create_user", "deposit", "withdraw", "balance", "balance_at", "balances_batch")
+MIXES: typing.Final[dict[str, dict[str, typing.Any]]] = {
+    "hot_account": {"accounts": 4, "weights": {"deposit": 0.45, "withdraw": 0.45, "balance": 0.1}},
+    "uniform": {"accounts": 1000, "weights": {"deposit": 0.35, "withdraw": 0.25, "balance": 0.4}},
+    "read_heavy": {"accounts": 1000, "weights": {"deposit": 0.05, "balance": 0.9, "balances_batch": 0.05}},
+    "historical": {"accounts": 200, "weights": {"deposit": 0.2, "balance_at": 0.8}},
+}
+INITIAL_BALANCE: typing.Final = "1000000.00"
+BALANCES_BATCH_SIZE: typing.Final = 100
+LOCK_SAMPLE_INTERVAL: typing.Final = 0.01
+LOCK_WAITERS_SQL: typing.Final = sa.text(
+    "SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock' AND datname = current_database()"
+)
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {operation: [] for operation in OPERATIONS}
+        self.statuses: dict[str, dict[int, int]] = {operation: {} for operation in OPERATIONS}
+
+    def record(self, operation: str, seconds: float, status_code: int) -> None:
+        self.latencies[operation].append(seconds)
+        statuses = self.statuses[operation]
+        statuses[status_code] = statuses.get(status_code, 0) + 1
+
+
+class LockWaitSampler:
+    """Estimates lock wait time as waiting sessions x sampling interval."""
+
+    def __init__(self, dsn: str):
+        self.engine = create_async_engine(dsn, pool_size=1, max_overflow=0)
+        self.wait_seconds = 0.0
+        self.waiters_max = 0
+
+    async def run(self) -> None:
+        async with self.engine.connect() as connection:
+            while True:
+                waiters = await connection.scalar(LOCK_WAITERS_SQL)
+                self.wait_seconds += waiters * LOCK_SAMPLE_INTERVAL
+                self.waiters_max = max(self.waiters_max, waiters)
+                await connection.rollback()
+                await asyncio.sleep(LOCK_SAMPLE_INTERVAL)
+
+
+class RoundTripCounter:
+    """Statements, BEGINs and COMMITs/ROLLBACKs the in-process app sends to Postgres."""
+
+    EVENTS: typing.Final = ("before_cursor_execute", "begin", "commit", "rollback")
+
+    def __init__(self, sync_engine: typing.Any):
+        self.count = 0
+        for event in self.EVENTS:
+            sa.event.listen(sync_engine, event, self._observe)
+
+    def _observe(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        self.count += 1
+
+
+def percentiles(latencies: list[float]) -> dict[str, float | None]:
+    if len(latencies) < 2:
+        value = latencies[0] * 1000 if latencies else None
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {"p50_ms": cuts[49] * 1000, "p95_ms": cuts[94] * 1000, "p99_ms": cuts[98] * 1000}
+
+
+async def request(
+        client: httpx.AsyncClient,
+        recorder: Recorder | None,
+        operation: str,
+        method: str,
+        url: str,
+        **kwargs: typing.Any) -> httpx.Response:
+    start = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    if recorder is not None:
+        recorder.record(operation, time.perf_counter() - start, response.status_code)
+    return response
+
+
+async def create_user(client: httpx.AsyncClient, recorder: Recorder | None) -> str:
+    user_id = str(uuid.uuid4())
+    await request(client, recorder, "create_user", "POST", "/api/users/", json={"id": user_id, "name": "load"})
+    return user_id
+
+
+async def transact(
+        client: httpx.AsyncClient,
+        recorder: Recorder | None,
+        user_id: str,
+        transaction_type: str,
+        amount: str = "1.00") -> None:
+    await request(client, recorder, transaction_type.lower(), "POST", "/api/transactions/", json={
+        "id": str(uuid.uuid4()), "user_id": user_id, "amount": amount, "type": transaction_type,
+    })
+
+
+async def seed(client: httpx.AsyncClient, accounts: int, concurrency: int) -> list[str]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def seed_account() -> str:
+        async with semaphore:
+            user_id = await create_user(client, None)
+            await transact(client, None, user_id, "DEPOSIT", INITIAL_BALANCE)
+            return user_id
+
+    return list(await asyncio.gather(*(seed_account() for _ in range(accounts))))
+
+
+async def client_loop(
+        client: httpx.AsyncClient,
+        recorder: Recorder,
+        rng: random.Random,
+        weights: dict[str, float],
+        accounts: list[str],
+        history: tuple[datetime, datetime],
+        deadline: float) -> None:
+    operations, cumulative = list(weights), list(weights.values())
+    while time.perf_counter() < deadline:
+        operation = rng.choices(operations, cumulative)[0]
+        user_id = rng.choice(accounts)
+        if operation == "create_user":
+            await create_user(client, recorder)
+        elif operation in ("deposit", "withdraw"):
+            await transact(client, recorder, user_id, operation.upper())
+        elif operation == "balance":
+            await request(client, recorder, operation, "GET", f"/api/users/{user_id}/balance/")
+        elif operation == "balance_at":
+            since, until = history
+            ts = since + (until - since) * rng.random()
+            await request(client, recorder, operation, "GET", f"/api/users/{user_id}/balance/",
+                          params={"ts": ts.isoformat()})
+        elif operation == "balances_batch":
+            user_ids = rng.sample(accounts, min(BALANCES_BATCH_SIZE, len(accounts)))
+            await request(client, recorder, operation, "POST", "/api/users/balances:batch",
+                          json={"user_ids": user_ids})
+        else:
+            raise ValueError(f"Unknown operation: {operation}")
+
+
+async def run_mix(
+        client: httpx.AsyncClient,
+        mix: dict[str, typing.Any],
+        args: argparse.Namespace,
+        round_trips: RoundTripCounter | None) -> dict[str, typing.Any]:
+    accounts = await seed(client, args.accounts or mix["accounts"], args.concurrency)
+    # Some history to read balances as of, the warm-up writes the rest of it.
+    history_start = datetime.utcnow()
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    await asyncio.gather(*(
+        client_loop(client, Recorder(), rng, mix["weights"], accounts, (history_start, datetime.utcnow()),
+                    time.perf_counter() + args.warmup)
+        for _ in range(args.concurrency)
+    ))
+    history = (history_start, datetime.utcnow())
+
+    sampler = LockWaitSampler(args.dsn)
+    sampler_task = asyncio.create_task(sampler.run())
+    round_trips_before = round_trips.count if round_trips is not None else 0
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client_loop(client, recorder, rng, mix["weights"], accounts, history, start + args.duration)
+        for _ in range(args.concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+    sampler_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await sampler_task
+    await sampler.engine.dispose()
+
+    latencies = [latency for operation in OPERATIONS for latency in recorder.latencies[operation]]
+    operations = {
+        operation: {
+            "requests": len(recorder.latencies[operation]),
+            "statuses": recorder.statuses[operation],
+            **percentiles(recorder.latencies[operation]),
+        }
+        for operation in OPERATIONS
+        if recorder.latencies[operation]
+    }
+    return {
+        "accounts": len(accounts),
+        "concurrency": args.concurrency,
+        "duration_seconds": elapsed,
+        "requests": len(latencies),
+        "errors": sum(
+            count for statuses in recorder.statuses.values() for status_code, count in statuses.items()
+            # Rejected withdrawals (422) are an expected answer, not an error.
+            if status_code >= 500 or status_code in (400, 404, 409)
+        ),
+        "throughput_rps": len(latencies) / elapsed,
+        **percentiles(latencies),
+        "lock_wait_seconds": sampler.wait_seconds,
+        "lock_wait_ms_per_request": sampler.wait_seconds * 1000 / len(latencies) if latencies else None,
+        "lock_waiters_max": sampler.waiters_max,
+        "db_round_trips_per_request": (
+            (round_trips.count - round_trips_before) / len(latencies)
+            if round_trips is not None and latencies else None
+        ),
+        "operations": operations,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.asynccontextmanager
+async def api_client(args: argparse.Namespace) -> typing.AsyncIterator[tuple[httpx.AsyncClient, typing.Any]]:
+    """A client of --url, or of the app started in process, and the app's settings if in process."""
+    limits = httpx.Limits(max_connections=args.concurrency)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+            yield client, None
+        return
+
+    from app.application import AppBuilder
+
+    builder = AppBuilder()
+    async with builder.lifespan_manager(builder.app):
+        transport = httpx.ASGITransport(app=builder.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=60) as client:
+            yield client, builder
+
+
+async def main(args: argparse.Namespace) -> int:
+    mixes = dict(MIXES)
+    if args.mix_file:
+        with open(args.mix_file) as f:
+            mixes.update(json.load(f))
+    unknown = [name for name in args.mix if name not in mixes]
+    if unknown:
+        print(f"Unknown mixes: {', '.join(unknown)}, known: {', '.join(mixes)}", file=sys.stderr)
+        return 2
+
+    report: dict[str, typing.Any] = {
+        "commit": git_commit(),
+        "started_at": datetime.utcnow().isoformat(),
+        "target": args.url or "in-process",
+        "mixes": {},
+    }
+    async with api_client(args) as (client, builder):
+        round_trips = None
+        if builder is not None:
+            round_trips = RoundTripCounter(builder._async_engine.sync_engine)
+            report["settings"] = {
+                "transaction_write_mode": builder.settings.transaction_write_mode.value,
+                "write_coalescing": builder.settings.write_coalescing,
+                "snapshot_mode": builder.settings.snapshot_mode.value,
+                "balance_cache": builder.settings.balance_cache.value,
+                "result_cache_max_bytes": builder.settings.result_cache_max_bytes,
+                "db_pool_limits": builder.settings.db_pool_limits(),
+            }
+        for name in args.mix:
+            report["mixes"][name] = await run_mix(client, mixes[name], args, round_trips)
+            print(f"{name}: {report['mixes'][name]['throughput_rps']:.0f} rps", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mix", nargs="+", default=list(MIXES),
+                        help=f"mixes to run, built in: {', '.join(MIXES)}")
+    parser.add_argument("--mix-file", help='JSON of extra mixes: {"name": {"accounts": N, "weights": {op: w}}}, '
+                                           f"operations: {', '.join(OPERATIONS)}")
+    parser.add_argument("--url", help="base URL of a running server, the app runs in process by default")
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL"), help="database to sample lock waits from")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per mix")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds per mix")
+    parser.add_argument("--accounts", type=int, default=None, help="override the number of accounts of every mix")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,124 @@
+"""Per-transaction CPU cost and storage size of both MONEY_REPRESENTATION modes.
+
+CPU: parsing a TransactionCreate body, the balance arithmetic of a withdrawal
+and rendering the Transaction response, in microseconds per transaction, best
+of ``--repeat`` rounds alternating between the representations. With
+DATABASE_URL set, also asyncpg decoding ``--rows`` amounts from NUMERIC(12, 2)
+and from BIGINT, and the size of a table of ``--rows`` random amounts in each
+type (temporary tables, nothing is written to the schema).
+
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/money.py --iterations 100000 --rows 1000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import typing
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+import pydantic
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.enums import TransactionType
+from app.money import MinorUnits, MinorUnitsInput
+
+# Type of request amounts, of response amounts and the Postgres type, per representation.
+REPRESENTATIONS: typing.Final = {
+    "decimal": (Decimal, Decimal, "numeric(12, 2)"),
+    "minor_units": (MinorUnitsInput, MinorUnits, "bigint"),
+}
+
+
+def transaction_models(amount_in: typing.Any, amount_out: typing.Any) -> tuple[type, type]:
+    # Same fields as app.schemas, which only hold the configured representation.
+    request = pydantic.create_model(
+        "TransactionCreate", id=(uuid.UUID, ...), user_id=(uuid.UUID, ...), amount=(amount_in, ...),
+        type=(TransactionType, ...))
+    response = pydantic.create_model(
+        "Transaction", id=(uuid.UUID, ...), user_id=(uuid.UUID, ...), amount=(amount_out, ...),
+        type=(TransactionType, ...), created_at=(datetime, ...))
+    return request, response
+
+
+def measure_cpu(representation: str, iterations: int) -> float:
+    amount_in, amount_out, _ = REPRESENTATIONS[representation]
+    request_model, response_model = transaction_models(amount_in, amount_out)
+    body = json.dumps({
+        "id": str(uuid.uuid4()), "user_id": str(uuid.uuid4()), "amount": "12.34", "type": "WITHDRAW",
+    }).encode()
+    balance = request_model.model_validate_json(body.replace(b"12.34", b"1000.00")).amount
+    created_at = datetime.utcnow()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        data = request_model.model_validate_json(body)
+        new_balance = balance - data.amount
+        if new_balance < 0:
+            raise AssertionError("Overdraft")
+        response_model(
+            id=data.id, user_id=data.user_id, amount=data.amount, type=data.type, created_at=created_at,
+        ).model_dump_json()
+    return (time.perf_counter() - start) / iterations
+
+
+async def measure_db(dsn: str, rows: int) -> dict[str, dict[str, float]]:
+    engine = create_async_engine(dsn)
+    results: dict[str, dict[str, float]] = {}
+    try:
+        async with engine.connect() as conn:
+            driver = (await conn.get_raw_connection()).driver_connection
+            for representation, (_, _, sql_type) in REPRESENTATIONS.items():
+                table = f"money_{representation}"
+                await driver.execute(f"""
+                    CREATE TEMPORARY TABLE {table} AS
+                    SELECT CAST(round(CAST(random() * 100000 AS numeric), 2)
+                        * {1 if sql_type.startswith("numeric") else 100} AS {sql_type}) AS amount
+                    FROM generate_series(1, {rows})
+                """)
+                await driver.execute(f"VACUUM ANALYZE {table}")
+                start = time.perf_counter()
+                await driver.fetch(f"SELECT amount FROM {table}")
+                decode = time.perf_counter() - start
+                results[representation] = {
+                    "decode_us_per_row": decode / rows * 1e6,
+                    "table_bytes": await driver.fetchval(f"SELECT pg_total_relation_size('{table}')"),
+                    "column_bytes_per_row": float(
+                        await driver.fetchval(f"SELECT avg(pg_column_size(amount)) FROM {table}")),
+                }
+                await driver.execute(f"DROP TABLE {table}")
+    finally:
+        await engine.dispose()
+    return results
+
+
+def main(args: argparse.Namespace) -> int:
+    rounds = [
+        {representation: measure_cpu(representation, args.iterations) for representation in REPRESENTATIONS}
+        for _ in range(args.repeat)
+    ]
+    report: dict[str, typing.Any] = {
+        "iterations": args.iterations,
+        "cpu_us_per_transaction": {
+            representation: min(cpu[representation] for cpu in rounds) * 1e6 for representation in REPRESENTATIONS
+        },
+    }
+    dsn = os.getenv("DATABASE_URL")
+    if dsn:
+        report["rows"] = args.rows
+        report["db"] = asyncio.run(measure_db(dsn, args.rows))
+    else:
+        print("DATABASE_URL is not set, skipping decoding and storage", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=100_000, help="rows of the decoding and storage tables")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,107 @@
+"""Per-request response serialization cost of each endpoint, before and after ModelResponse.
+
+"before" is what FastAPI does with a handler returning ORM objects and a
+``response_model``: validate against the response field, dump to dicts and
+``json.dumps`` them. "after" is what the handlers do now: validate once and
+render with pydantic-core. No database is involved.
+
+    python benchmarks/serialization.py --iterations 20000
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import typing
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute, serialize_response
+
+from app import schemas
+from app.api import payments
+from app.api.responses import ModelResponse
+from app.enums import TransactionType
+from app.models import Transaction, User
+
+PAGE_SIZE = 100
+
+
+def make_transaction() -> Transaction:
+    return Transaction(
+        id=uuid.uuid4(),
+        user_id=uuid.uuid4(),
+        amount=Decimal("1234.56"),
+        type=TransactionType.DEPOSIT,
+        created_at=datetime.utcnow(),
+    )
+
+
+def batch_results(transactions: list[Transaction]) -> list[schemas.TransactionBatchItemResult]:
+    return [
+        schemas.TransactionBatchItemResult(
+            id=transaction.id, status_code=200, transaction=schemas.Transaction.model_validate(transaction))
+        for transaction in transactions
+    ]
+
+
+def cases() -> dict[str, tuple[typing.Callable[[], typing.Any], typing.Callable[[], typing.Any]]]:
+    """Endpoint path -> (what handlers used to return, what they return now)."""
+    user = User(id=uuid.uuid4(), name="benchmark", created_at=datetime.utcnow())
+    transaction = make_transaction()
+    batch = [make_transaction() for _ in range(PAGE_SIZE)]
+    page = [make_transaction() for _ in range(PAGE_SIZE)]
+    balance = Decimal("1234.56")
+    return {
+        "/users/": (lambda: user, lambda: schemas.User.model_validate(user, from_attributes=True)),
+        "/transactions/": (lambda: transaction, lambda: schemas.Transaction.model_validate(transaction)),
+        "/transactions/{transaction_id}": (
+            lambda: transaction,
+            lambda: schemas.Transaction.model_validate(transaction),
+        ),
+        "/transactions/batch": (lambda: batch_results(batch), lambda: batch_results(batch)),
+        "/users/{user_id}/balance/": (lambda: {"balance": balance}, lambda: schemas.UserBalance(balance=balance)),
+        "/users/{user_id}/transactions": (
+            lambda: {"items": page, "next_cursor": "cursor"},
+            lambda: schemas.TransactionPage(
+                items=[schemas.Transaction.model_validate(t) for t in page], next_cursor="cursor"),
+        ),
+    }
+
+
+async def time_per_call(render: typing.Callable[[], typing.Awaitable[bytes]], iterations: int) -> float:
+    await render()  # warm up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await render()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+async def main(args: argparse.Namespace) -> int:
+    routes = {route.path: route for route in payments.ROUTER.routes if isinstance(route, APIRoute)}
+    results = {}
+    for path, (returned, build) in cases().items():
+        field = routes[path].response_field
+
+        async def before() -> bytes:
+            return JSONResponse(await serialize_response(field=field, response_content=returned())).body
+
+        async def after() -> bytes:
+            return ModelResponse(build()).body
+
+        assert json.loads(await before()) == json.loads(await after()), path
+        results[path] = {
+            "before_us": await time_per_call(before, args.iterations),
+            "after_us": await time_per_call(after, args.iterations),
+        }
+        results[path]["speedup"] = results[path]["before_us"] / results[path]["after_us"]
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5_000)
+    sys.exit(asyncio.run(main(parser.parse_args())))
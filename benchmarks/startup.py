@@ -0,0 +1,120 @@
+"""Cold start of one worker: import, app build, startup and first requests.
+
+Every run is a fresh interpreter, so imports are not cached across runs. Each
+one reports the seconds spent importing app.application, building the app
+with create_app(), running its startup (engine, caches, pool warm-up) and
+serving the first and second ``GET /api/users/{id}/balance`` in process, plus
+the wall time of the whole process. Runs repeat for every ``--pool-warmup``
+value, passed to the app as DB_POOL_WARMUP. The schema must exist already,
+see ``alembic upgrade head``.
+
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/startup.py --runs 10 --pool-warmup 0 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import typing
+import uuid
+from datetime import datetime
+
+PHASES: typing.Final = ("import", "build", "startup", "first_request", "second_request", "process")
+
+
+async def measure_child() -> dict[str, float]:
+    timings = {}
+    mark = time.perf_counter()
+
+    def phase(name: str) -> None:
+        nonlocal mark
+        now = time.perf_counter()
+        timings[name] = now - mark
+        mark = now
+
+    from app.application import create_app
+    phase("import")
+    app = create_app()
+    phase("build")
+
+    import httpx
+
+    async with app.router.lifespan_context(app):
+        phase("startup")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+            # An unknown user costs the same DB round trip as a known one.
+            for name in ("first_request", "second_request"):
+                mark = time.perf_counter()
+                await client.get(f"/api/users/{uuid.uuid4()}/balance")
+                phase(name)
+    return timings
+
+
+def run_child(pool_warmup: int) -> dict[str, float]:
+    env = {**os.environ, "DB_POOL_WARMUP": str(pool_warmup)}
+    started_at = time.perf_counter()
+    output = subprocess.check_output([sys.executable, __file__, "--child"], env=env, text=True)
+    timings = json.loads(output.splitlines()[-1])
+    # Includes interpreter startup and shutdown, which the child cannot see.
+    timings["process"] = time.perf_counter() - started_at
+    return timings
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "max": max(samples),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args: argparse.Namespace) -> int:
+    report: dict[str, typing.Any] = {
+        "commit": git_commit(),
+        "started_at": datetime.utcnow().isoformat(),
+        "runs": args.runs,
+        "pool_warmup": {},
+    }
+    for pool_warmup in args.pool_warmup:
+        runs = [run_child(pool_warmup) for _ in range(args.runs)]
+        report["pool_warmup"][str(pool_warmup)] = {
+            phase: summarize([run[phase] for run in runs]) for phase in PHASES
+        }
+        summary = report["pool_warmup"][str(pool_warmup)]
+        print(
+            f"DB_POOL_WARMUP={pool_warmup}: "
+            + ", ".join(f"{phase} {summary[phase]['median'] * 1000:.1f} ms" for phase in PHASES),
+            file=sys.stderr,
+        )
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per --pool-warmup value")
+    parser.add_argument("--pool-warmup", type=int, nargs="+", default=[0], help="DB_POOL_WARMUP values to compare")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+    if parsed.child:
+        print(json.dumps(asyncio.run(measure_child())))
+        sys.exit(0)
+    sys.exit(main(parsed))
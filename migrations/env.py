@@ -7,6 +7,9 @@ from sqlalchemy.ext.asyncio import async_engine_from_config
 
 from alembic import context
 
+from app.db.migrations import include_object
+from app.models import METADATA
+
 dotenv.load_dotenv()
 
 config = context.config
@@ -14,7 +17,8 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
-target_metadata = None
+# Compared by `alembic revision --autogenerate` and `alembic check`.
+target_metadata = METADATA
 
 # Set your SQLAlchemy URL with the async driver
 config.set_main_option('sqlalchemy.url', os.getenv("DATABASE_URL"))
@@ -28,6 +32,9 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
+        # Migrations with autocommit blocks commit what ran before them, keep each one atomic on its own.
+        transaction_per_migration=True,
     )
 
     with context.begin_transaction():
@@ -47,8 +54,13 @@ def run_migrations_online() -> None:
         async with connectable.connect() as connection:
             await connection.run_sync(run_migrations)
 
-    async def run_migrations(connection):
-        context.configure(connection=connection, target_metadata=target_metadata)
+    def run_migrations(connection):
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+            transaction_per_migration=True,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
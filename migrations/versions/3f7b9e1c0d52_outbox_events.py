@@ -0,0 +1,37 @@
+"""Outbox events
+
+Revision ID: 3f7b9e1c0d52
+Revises: a81f3c6d2e90
+Create Date: 2024-11-26 11:37:09.158342
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f7b9e1c0d52'
+down_revision: Union[str, None] = 'a81f3c6d2e90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # IF NOT EXISTS: databases bootstrapped by create_all() already have them.
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_events (
+            id BIGSERIAL PRIMARY KEY,
+            event_type VARCHAR(64) NOT NULL,
+            payload JSONB NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            available_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+    """)
+    op.execute("CREATE INDEX IF NOT EXISTS ix_outbox_events_available_at ON outbox_events (available_at)")
+
+
+def downgrade() -> None:
+    op.drop_table("outbox_events")
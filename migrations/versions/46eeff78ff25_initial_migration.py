@@ -1,7 +1,7 @@
 """Initial migration
 
 Revision ID: 46eeff78ff25
-Revises: 
+Revises: 6606aa6e4b6a
 Create Date: 2024-10-17 17:51:47.788005
 
 """
@@ -13,7 +13,7 @@ import sqlalchemy as sa
 
 # revision identifiers, used by Alembic.
 revision: str = '46eeff78ff25'
-down_revision: Union[str, None] = None
+down_revision: Union[str, None] = '6606aa6e4b6a'
 branch_labels: Union[str, Sequence[str], None] = None
 depends_on: Union[str, Sequence[str], None] = None
 
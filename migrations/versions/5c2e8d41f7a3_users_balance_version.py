@@ -0,0 +1,26 @@
+"""Users balance version
+
+Revision ID: 5c2e8d41f7a3
+Revises: ee9f1eb39e9b
+Create Date: 2024-11-12 09:41:07.118452
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c2e8d41f7a3'
+down_revision: Union[str, None] = 'ee9f1eb39e9b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # IF NOT EXISTS: databases bootstrapped by create_all() already have the column.
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS balance_version BIGINT NOT NULL DEFAULT 0")
+
+
+def downgrade() -> None:
+    op.drop_column("users", "balance_version")
@@ -0,0 +1,37 @@
+"""Ledger mode
+
+Revision ID: a81f3c6d2e90
+Revises: 5c2e8d41f7a3
+Create Date: 2024-11-19 15:02:44.620915
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a81f3c6d2e90'
+down_revision: Union[str, None] = '5c2e8d41f7a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # IF NOT EXISTS: databases bootstrapped by create_all() already have them.
+    op.execute("CREATE SEQUENCE IF NOT EXISTS transactions_seq")
+    op.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS seq BIGINT")
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS ledger_seq BIGINT NOT NULL DEFAULT 0")
+    # Partial: only ledger mode sets seq, the indexes stay empty in the other modes.
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_transactions_user_id_seq ON transactions (user_id, seq) WHERE seq IS NOT NULL"
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS ix_transactions_seq ON transactions (seq) WHERE seq IS NOT NULL")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_transactions_seq", "transactions")
+    op.drop_index("ix_transactions_user_id_seq", "transactions")
+    op.drop_column("users", "ledger_seq")
+    op.drop_column("transactions", "seq")
+    op.execute("DROP SEQUENCE IF EXISTS transactions_seq")
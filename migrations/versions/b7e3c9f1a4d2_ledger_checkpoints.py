@@ -0,0 +1,35 @@
+"""Ledger checkpoints
+
+Stores how far ledger transactions are folded into users.balance, so the
+checkpointers of all workers resume from it instead of rescanning the ledger.
+
+Revision ID: b7e3c9f1a4d2
+Revises: d8a2f5c1e7b4
+Create Date: 2024-12-10 10:21:36.482017
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e3c9f1a4d2'
+down_revision: Union[str, None] = 'd8a2f5c1e7b4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # IF NOT EXISTS: databases bootstrapped by create_all() already have it.
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+            id SMALLINT PRIMARY KEY,
+            folded_seq BIGINT NOT NULL DEFAULT 0,
+            checkpointed_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        )
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table("ledger_checkpoints")
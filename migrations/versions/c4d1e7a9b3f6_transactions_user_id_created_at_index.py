@@ -0,0 +1,36 @@
+"""Transactions user_id, created_at index
+
+Built concurrently, partition by partition, so writes to transactions keep
+going. It replaces ix_transactions_user_id, which it covers: history pages
+and balances as of a timestamp filter on user_id and created_at.
+
+Revision ID: c4d1e7a9b3f6
+Revises: 3f7b9e1c0d52
+Create Date: 2024-12-03 10:24:51.730416
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from app.db.migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4d1e7a9b3f6'
+down_revision: Union[str, None] = '3f7b9e1c0d52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        create_index_concurrently(
+            op.get_bind(), "ix_transactions_user_id_created_at", "transactions", ["user_id", "created_at"])
+        drop_index_concurrently(op.get_bind(), "ix_transactions_user_id")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        create_index_concurrently(op.get_bind(), "ix_transactions_user_id", "transactions", ["user_id"])
+        drop_index_concurrently(op.get_bind(), "ix_transactions_user_id_created_at")
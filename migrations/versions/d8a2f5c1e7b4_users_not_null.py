@@ -0,0 +1,47 @@
+"""Users not null
+
+Brings users in line with the models: created_at, balance and
+transactions_since_snapshot were created nullable by the migrations but
+NOT NULL by create_all(). NULLs are backfilled in batches, the constraint is
+then added without a long exclusive lock.
+
+Revision ID: d8a2f5c1e7b4
+Revises: c4d1e7a9b3f6
+Create Date: 2024-12-03 15:08:17.254903
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.db.migrations import backfill_in_batches, set_not_null
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8a2f5c1e7b4'
+down_revision: Union[str, None] = 'c4d1e7a9b3f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Value of the NULLs of each column. Users without created_at predate it, the migration time is the best guess.
+BACKFILLS = {
+    "created_at": "timezone('utc', now())",
+    "balance": "0",
+    "transactions_since_snapshot": "0",
+}
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for column, value in BACKFILLS.items():
+            backfill_in_batches(op.get_bind(), sa.text(f"""
+                UPDATE users SET {column} = {value}
+                WHERE id IN (SELECT id FROM users WHERE {column} IS NULL LIMIT :batch_size)
+            """))
+            set_not_null(op.get_bind(), "users", column)
+
+
+def downgrade() -> None:
+    for column in BACKFILLS:
+        op.alter_column("users", column, nullable=True)
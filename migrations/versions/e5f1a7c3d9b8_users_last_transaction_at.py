@@ -0,0 +1,29 @@
+"""Users last transaction at
+
+The single-statement write path stamps a user's next transaction strictly after
+users.last_transaction_at, so concurrent writes commit in timestamp order.
+
+Revision ID: e5f1a7c3d9b8
+Revises: b7e3c9f1a4d2
+Create Date: 2024-12-16 11:47:05.301942
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5f1a7c3d9b8'
+down_revision: Union[str, None] = 'b7e3c9f1a4d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # No backfill: until a user's next write, NULL leaves the ordering to the clock alone.
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_transaction_at TIMESTAMP WITHOUT TIME ZONE")
+
+
+def downgrade() -> None:
+    op.drop_column("users", "last_transaction_at")
@@ -0,0 +1,144 @@
+"""Partitioned schema
+
+Creates the schema with transactions and balances_snapshots range partitioned
+by month of created_at. Databases bootstrapped by create_all() before
+partitioning keep their rows: the old tables become one "legacy" partition
+covering everything up to the end of the current month, and monthly
+partitions start after it.
+
+Revision ID: ee9f1eb39e9b
+Revises: 46eeff78ff25
+Create Date: 2024-11-04 10:12:31.417203
+
+"""
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from app.db.partitions import create_partitions, month_start
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'ee9f1eb39e9b'
+down_revision: Union[str, None] = '46eeff78ff25'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PARTITIONED_TABLES = ("transactions", "balances_snapshots")
+
+
+def _relkind(table: str) -> Union[str, None]:
+    return op.get_bind().execute(
+        sa.text("SELECT relkind::text FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}
+    ).scalar()
+
+
+def _rename_to_legacy(table: str) -> None:
+    legacy = f"{table}_legacy"
+    op.rename_table(table, legacy)
+    # Index names are schema-wide, free them for the partitioned table. Equivalent
+    # indexes are picked up again instead of rebuilt when the partition is attached.
+    indexes = op.get_bind().execute(
+        sa.text("SELECT indexname FROM pg_indexes WHERE tablename = :table"), {"table": legacy}
+    ).scalars().all()
+    for index in indexes:
+        op.execute(f"ALTER INDEX {index} RENAME TO {index.replace(table, legacy, 1)}")
+    op.execute(f"ALTER TABLE {legacy} RENAME CONSTRAINT {table}_user_id_fkey TO {legacy}_user_id_fkey")
+    op.alter_column(legacy, "created_at", nullable=False)
+    # Partitions must carry the partition key in their primary key as well.
+    op.execute(
+        f"ALTER TABLE {legacy} DROP CONSTRAINT {legacy}_pkey, "
+        f"ADD CONSTRAINT {legacy}_pkey PRIMARY KEY (id, created_at)"
+    )
+
+
+def upgrade() -> None:
+    users_kind = _relkind("users")
+    if users_kind is None:
+        op.create_table(
+            "users",
+            sa.Column("id", postgresql.UUID(as_uuid=True), primary_key=True),
+            sa.Column("name", sa.String(255), nullable=False),
+            sa.Column("created_at", sa.DateTime),
+            sa.Column("balance", sa.Numeric(precision=12, scale=2), server_default="0"),
+            sa.Column("transactions_since_snapshot", sa.Integer, server_default="0"),
+            sa.Column("snapshot_at", sa.DateTime, nullable=True),
+        )
+    else:
+        op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS transactions_since_snapshot INTEGER DEFAULT 0")
+        op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS snapshot_at TIMESTAMP WITHOUT TIME ZONE")
+
+    if _relkind("transaction_keys") is None:
+        op.create_table(
+            "transaction_keys",
+            sa.Column("id", postgresql.UUID(as_uuid=True), primary_key=True),
+            sa.Column("created_at", sa.DateTime, nullable=False),
+        )
+
+    if _relkind("transactions") == "p":
+        # Already partitioned (bootstrapped by create_all), only monthly partitions are missing.
+        create_partitions(op.get_bind())
+        return
+
+    legacy = _relkind("transactions") == "r"
+    if legacy:
+        for table in PARTITIONED_TABLES:
+            _rename_to_legacy(table)
+
+    transaction_type = postgresql.ENUM("WITHDRAW", "DEPOSIT", name="transactiontype", create_type=False)
+    transaction_type.create(op.get_bind(), checkfirst=True)
+    op.execute("CREATE SEQUENCE IF NOT EXISTS balances_snapshots_id_seq")
+    op.create_table(
+        "transactions",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("user_id", postgresql.UUID(as_uuid=True), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("amount", sa.Numeric(precision=12, scale=2), nullable=False),
+        sa.Column("type", transaction_type, nullable=False),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+        sa.PrimaryKeyConstraint("id", "created_at"),
+        postgresql_partition_by="RANGE (created_at)",
+    )
+    op.create_index("ix_transactions_user_id", "transactions", ["user_id"])
+    op.create_table(
+        "balances_snapshots",
+        sa.Column("id", sa.Integer, server_default=sa.text("nextval('balances_snapshots_id_seq')"), nullable=False),
+        sa.Column("user_id", postgresql.UUID(as_uuid=True), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("balance", sa.Numeric(precision=12, scale=2), nullable=False),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+        sa.PrimaryKeyConstraint("id", "created_at"),
+        postgresql_partition_by="RANGE (created_at)",
+    )
+    op.execute("ALTER SEQUENCE balances_snapshots_id_seq OWNED BY balances_snapshots.id")
+    op.create_index(
+        "ix_balances_snapshots_user_id_created_at_desc",
+        "balances_snapshots",
+        ["user_id", sa.text("created_at DESC")],
+    )
+
+    first_month = month_start(datetime.utcnow().date())
+    for table in PARTITIONED_TABLES:
+        op.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    if legacy:
+        first_month = month_start(first_month, 1)
+        for table in PARTITIONED_TABLES:
+            op.execute(
+                f"ALTER TABLE {table} ATTACH PARTITION {table}_legacy "
+                f"FOR VALUES FROM (MINVALUE) TO ('{first_month.isoformat()}')"
+            )
+        op.execute(
+            "INSERT INTO transaction_keys (id, created_at) "
+            "SELECT id, created_at FROM transactions_legacy ON CONFLICT (id) DO NOTHING"
+        )
+    create_partitions(op.get_bind(), since=first_month)
+
+
+def downgrade() -> None:
+    op.drop_table("balances_snapshots")
+    op.drop_table("transactions")
+    op.drop_table("transaction_keys")
+    op.drop_table("users")
+    op.execute("DROP SEQUENCE IF EXISTS balances_snapshots_id_seq")
+    op.execute("DROP TYPE IF EXISTS transactiontype")
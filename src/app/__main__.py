@@ -1,16 +1,28 @@
+import contextlib
+import os
+
 import granian
-from granian.constants import Interfaces, Loops
+from granian.constants import HTTPModes, Interfaces, Loops
 
 from app.settings import get_settings
 
 
 if __name__ == "__main__":
     settings = get_settings()
+    # Left by the pre-stop hook of a previous run, it would keep every worker unready.
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(settings.health_drain_file)
     granian.Granian(
-        target="application:application",
+        target="application:create_app",
+        factory=True,
         address="0.0.0.0",  # noqa: S104
         port=settings.app_port,
         interface=Interfaces.ASGI,
+        workers=settings.app_workers,
+        threads=settings.app_runtime_threads,
+        backlog=settings.app_backlog,
+        backpressure=settings.app_backpressure,
+        http=HTTPModes(settings.app_http),
         log_dictconfig={"root": {"level": "INFO"}} if not settings.debug else {},
         log_level=settings.log_level,
         loop=Loops.uvloop,
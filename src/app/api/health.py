@@ -0,0 +1,25 @@
+import typing
+
+import fastapi
+
+from app.api.responses import ModelResponse
+from app.db.resources import get_readiness_probe
+from app.health import ReadinessProbe
+
+ROUTER: typing.Final = fastapi.APIRouter()
+
+
+@ROUTER.get("/health/live")
+async def get_liveness() -> dict[str, str]:
+    """The worker serves requests, nothing else is checked: restarting it would not fix the DB."""
+    return {"status": "ok"}
+
+
+@ROUTER.get("/health/ready")
+async def get_readiness(
+        readiness_probe: ReadinessProbe | None = fastapi.Depends(get_readiness_probe),
+) -> fastapi.Response:
+    if readiness_probe is None:
+        return ModelResponse({"ready": False, "state": "unknown", "checks": {}}, status_code=503)
+    report = await readiness_probe.check()
+    return ModelResponse(report, status_code=200 if report["ready"] else 503)
@@ -0,0 +1,18 @@
+import typing
+
+import fastapi
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from app.db.resources import get_metrics
+from app.metrics import Metrics
+
+ROUTER: typing.Final = fastapi.APIRouter()
+
+
+@ROUTER.get("/metrics", include_in_schema=False)
+async def get_metrics_exposition(
+        metrics: Metrics | None = fastapi.Depends(get_metrics),
+) -> fastapi.Response:
+    if metrics is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    return fastapi.Response(metrics.render(), media_type=CONTENT_TYPE_LATEST)
@@ -1,29 +1,58 @@
+import base64
+import contextlib
+import csv
+import io
+import asyncio
 import typing
 import uuid
 from datetime import datetime
 
 import fastapi
+import pydantic
+from fastapi.responses import StreamingResponse
 from starlette import status
 
 from app import schemas
-from app.db.resources import get_payment_repo
+from app.api.responses import ModelResponse
+from app.db.replicas import CONSISTENCY_TOKEN_HEADER, ReplicaRouter
+from app.db.resources import get_balance_stream, get_metrics, get_payment_repo, get_replica_router
+from app.enums import ExportFormat
 from app.exceptions import (
     InsufficientFundsError,
     UserExistsError,
     UserNotExistsError,
     TransactionAmountZeroError,
-    TransactionAlreadyExistsError, UnknownTransactionTypeError
+    TransactionAlreadyExistsError, UnknownTransactionTypeError,
+    TransactionError,
+    TransactionIdConflictError,
 )
+from app.metrics import Metrics
 from app.repositories import PaymentRepository
+from app.repositories.payments import HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE_MAX
+from app.settings import Settings
+from app.streams.balances import BalanceChangeHub
 
 ROUTER: typing.Final = fastapi.APIRouter()
 
+STREAM_CHUNK_SIZE: typing.Final = 500
+# Comment lines sent to idle event streams, so proxies do not time them out.
+EVENT_STREAM_KEEPALIVE_SECONDS: typing.Final = 15.0
+
+TRANSACTION_ERROR_STATUS_CODES: typing.Final[dict[type[TransactionError], int]] = {
+    UserNotExistsError: status.HTTP_400_BAD_REQUEST,
+    TransactionAmountZeroError: status.HTTP_400_BAD_REQUEST,
+    TransactionAlreadyExistsError: status.HTTP_400_BAD_REQUEST,
+    UnknownTransactionTypeError: status.HTTP_400_BAD_REQUEST,
+    InsufficientFundsError: status.HTTP_422_UNPROCESSABLE_ENTITY,
+}
+
 
 @ROUTER.post("/users/", response_model=schemas.User)
 async def create_user(
         data: schemas.UserCreate,
         payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
-) -> schemas.User:
+        replicas: ReplicaRouter | None = fastapi.Depends(get_replica_router),
+) -> ModelResponse:
     try:
         user = await payment_repo.create_user(data)
     except UserExistsError as e:
@@ -31,43 +60,75 @@ async def create_user(
             status_code=status.HTTP_409_CONFLICT,
             detail=str(e),
         )
-    return typing.cast(schemas.User, user)
+    return ModelResponse(
+        schemas.User.model_validate(user, from_attributes=True), headers=_consistency_headers(replicas))
 
 
 @ROUTER.post("/transactions/", response_model=schemas.Transaction)
 async def create_transaction(
         data: schemas.TransactionCreate,
         payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
-) -> schemas.Transaction:
+        metrics: Metrics | None = fastapi.Depends(get_metrics),
+        replicas: ReplicaRouter | None = fastapi.Depends(get_replica_router),
+) -> ModelResponse:
     try:
         transaction = await payment_repo.create_transaction(data)
-    except (UserNotExistsError,
-            TransactionAmountZeroError,
-            TransactionAlreadyExistsError,
-            UnknownTransactionTypeError) as e:
+    except TransactionError as e:
+        if metrics is not None:
+            metrics.observe_transaction(data.type, e)
         raise fastapi.HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=str(e),
-        )
-    except InsufficientFundsError as e:
-        raise fastapi.HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            status_code=TRANSACTION_ERROR_STATUS_CODES[type(e)],
             detail=str(e),
         )
 
-    return typing.cast(schemas.Transaction, transaction)
+    if metrics is not None:
+        metrics.observe_transaction(data.type, transaction)
+    return ModelResponse(schemas.Transaction.model_validate(transaction), headers=_consistency_headers(replicas))
 
 
-@ROUTER.get("/transactions/{transaction_id}")
+@ROUTER.post("/transactions/batch", response_model=list[schemas.TransactionBatchItemResult])
+async def create_transactions_batch(
+        data: typing.Annotated[
+            list[schemas.TransactionCreate],
+            fastapi.Body(min_length=1, max_length=Settings.transactions_batch_size_max),
+        ],
+        payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
+        metrics: Metrics | None = fastapi.Depends(get_metrics),
+        replicas: ReplicaRouter | None = fastapi.Depends(get_replica_router),
+) -> ModelResponse:
+    results = await payment_repo.create_transactions_bulk(data)
+    if metrics is not None:
+        for item, result in zip(data, results):
+            metrics.observe_transaction(item.type, result)
+    return ModelResponse([
+        schemas.TransactionBatchItemResult(
+            id=item.id,
+            status_code=TRANSACTION_ERROR_STATUS_CODES[type(result)],
+            detail=str(result),
+        )
+        if isinstance(result, TransactionError)
+        else schemas.TransactionBatchItemResult(
+            id=item.id,
+            status_code=status.HTTP_200_OK,
+            transaction=schemas.Transaction.model_validate(result),
+        )
+        for item, result in zip(data, results)
+    ], headers=_consistency_headers(replicas))
+
+
+@ROUTER.get("/transactions/{transaction_id}", response_model=schemas.Transaction)
 async def get_transaction(
         transaction_id: uuid.UUID,
         payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
-) -> schemas.Transaction:
-    transaction = await payment_repo.get_transaction(transaction_id)
+) -> ModelResponse:
+    try:
+        transaction = await payment_repo.get_transaction(transaction_id)
+    except TransactionIdConflictError as e:
+        raise fastapi.HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     if transaction is None:
         raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                     detail="Transaction not found")
-    return typing.cast(schemas.Transaction, transaction)
+    return ModelResponse(schemas.Transaction.model_validate(transaction))
 
 
 @ROUTER.get("/users/{user_id}/balance/", response_model=schemas.UserBalance)
@@ -75,7 +136,7 @@ async def get_user_balance(
         user_id: uuid.UUID,
         ts: datetime | None = None,
         payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
-) -> schemas.UserBalance:
+) -> ModelResponse:
     try:
         balance = await payment_repo.get_user_balance(user_id, ts=ts)
     except UserNotExistsError as e:
@@ -84,4 +145,197 @@ async def get_user_balance(
             detail=str(e),
         )
 
-    return typing.cast(schemas.UserBalance, {"balance": balance})
+    return ModelResponse(schemas.UserBalance(balance=balance))
+
+
+@ROUTER.get(
+    "/users/{user_id}/balance/stream",
+    response_class=StreamingResponse,
+    responses={status.HTTP_200_OK: {"content": {"text/event-stream": {}}}},
+)
+async def stream_user_balance(
+        user_id: uuid.UUID,
+        balance_stream: BalanceChangeHub | None = fastapi.Depends(get_balance_stream),
+) -> StreamingResponse:
+    """Server-sent ``balance`` events: the current balance, then the new one after every change.
+
+    A client that reads slower than the balance changes skips intermediate balances.
+    """
+    if balance_stream is None:
+        raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Balance stream is disabled")
+
+    with contextlib.ExitStack() as stack:
+        # Subscribed before reading, so no change can slip in between.
+        queue = stack.enter_context(balance_stream.subscribe(user_id))
+        try:
+            # From the primary: a replica may lag behind a change that was notified already.
+            balance = await balance_stream.fetch_balance(user_id)
+        except UserNotExistsError as e:
+            raise fastapi.HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e),
+            )
+        # Only handed over to the response once nothing can fail, it unsubscribes when the stream ends.
+        subscription = stack.pop_all()
+
+    async def events() -> typing.AsyncIterator[str]:
+        with subscription:
+            sent = None
+            next_balance = balance
+            while True:
+                if next_balance != sent:
+                    item = schemas.UserBalanceItem(user_id=user_id, balance=next_balance)
+                    yield f"event: balance\ndata: {item.model_dump_json()}\n\n"
+                    sent = next_balance
+                try:
+                    next_balance = await asyncio.wait_for(queue.get(), EVENT_STREAM_KEEPALIVE_SECONDS)
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@ROUTER.post(
+    "/users/balances:batch",
+    response_class=StreamingResponse,
+    responses={status.HTTP_200_OK: {"model": list[schemas.UserBalanceItem]}},
+)
+async def get_user_balances(
+        data: schemas.UserBalancesQuery,
+        payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
+) -> StreamingResponse:
+    """Balances of many users at once, unknown users come last with a null balance."""
+    async def balances() -> typing.AsyncIterator[schemas.UserBalanceItem]:
+        missing = set(data.user_ids)
+        async for user_id, balance in payment_repo.get_user_balances(data.user_ids, ts=data.ts):
+            missing.discard(user_id)
+            yield schemas.UserBalanceItem(user_id=user_id, balance=balance)
+        for user_id in missing:
+            yield schemas.UserBalanceItem(user_id=user_id, balance=None)
+
+    return StreamingResponse(_chunked(_json_array(balances())), media_type="application/json")
+
+
+@ROUTER.get("/users/{user_id}/transactions", response_model=schemas.TransactionPage)
+async def get_user_transactions(
+        user_id: uuid.UUID,
+        cursor: str | None = None,
+        limit: typing.Annotated[int, fastapi.Query(ge=1, le=HISTORY_PAGE_SIZE_MAX)] = HISTORY_PAGE_SIZE,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        export: ExportFormat | None = None,
+        payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
+) -> ModelResponse | StreamingResponse:
+    """Transactions created in [since, until), newest first and a page at a time.
+
+    With ``export`` all of them are streamed instead, oldest first, as NDJSON or CSV.
+    """
+    if export is not None:
+        return await _export_user_transactions(payment_repo, user_id, since, until, export)
+
+    try:
+        page = await payment_repo.get_user_transactions(
+            user_id, limit=limit, before=_decode_cursor(cursor) if cursor else None, since=since, until=until)
+    except UserNotExistsError as e:
+        raise fastapi.HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+
+    return ModelResponse(schemas.TransactionPage(
+        items=[schemas.Transaction.model_validate(transaction) for transaction in page],
+        next_cursor=_encode_cursor(page[-1].created_at, page[-1].id) if len(page) == limit else None,
+    ))
+
+
+async def _export_user_transactions(
+        payment_repo: PaymentRepository,
+        user_id: uuid.UUID,
+        since: datetime | None,
+        until: datetime | None,
+        export: ExportFormat) -> StreamingResponse:
+    rows = payment_repo.stream_user_transactions(user_id, since=since, until=until)
+    # Fetch the first row before the response starts, errors can not be reported once it has.
+    try:
+        first = await anext(rows, None)
+    except UserNotExistsError as e:
+        raise fastapi.HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+
+    async def transactions() -> typing.AsyncIterator[schemas.Transaction]:
+        # Closing rows releases the cursor and its connection even if the client goes away early.
+        async with contextlib.aclosing(rows):
+            if first is None:
+                return
+            yield schemas.Transaction.model_validate(first)
+            async for row in rows:
+                yield schemas.Transaction.model_validate(row)
+
+    if export == ExportFormat.CSV:
+        return StreamingResponse(_chunked(_csv_lines(transactions())), media_type="text/csv")
+    return StreamingResponse(_chunked(_ndjson_lines(transactions())), media_type="application/x-ndjson")
+
+
+def _consistency_headers(replicas: ReplicaRouter | None) -> dict[str, str] | None:
+    """Token letting the client read this write from replicas, see app.db.replicas."""
+    if replicas is None:
+        return None
+    return {CONSISTENCY_TOKEN_HEADER: replicas.consistency_token()}
+
+
+def _encode_cursor(created_at: datetime, transaction_id: uuid.UUID) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()} {transaction_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    try:
+        created_at, transaction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(" ")
+        return datetime.fromisoformat(created_at), uuid.UUID(transaction_id)
+    except ValueError:
+        raise fastapi.HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        )
+
+
+async def _chunked(parts: typing.AsyncIterable[str]) -> typing.AsyncIterator[str]:
+    """Join STREAM_CHUNK_SIZE parts per chunk sent, instead of one message per row."""
+    chunk = []
+    async for part in parts:
+        chunk.append(part)
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+async def _json_array(items: typing.AsyncIterable[pydantic.BaseModel]) -> typing.AsyncIterator[str]:
+    separator = "["
+    async for item in items:
+        yield separator + item.model_dump_json()
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+async def _ndjson_lines(items: typing.AsyncIterable[pydantic.BaseModel]) -> typing.AsyncIterator[str]:
+    async for item in items:
+        yield item.model_dump_json() + "\n"
+
+
+async def _csv_lines(transactions: typing.AsyncIterable[schemas.Transaction]) -> typing.AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(schemas.Transaction.model_fields)
+    async for transaction in transactions:
+        writer.writerow(transaction.model_dump(mode="json").values())
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
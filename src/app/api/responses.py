@@ -0,0 +1,16 @@
+import typing
+
+import pydantic_core
+from fastapi.responses import JSONResponse
+
+
+class ModelResponse(JSONResponse):
+    """JSON response rendered by pydantic-core straight from models to bytes.
+
+    Handlers returning it skip FastAPI's response_model validation and its
+    model -> dict -> json.dumps round trip; Decimal, UUID and datetime fields
+    are encoded in Rust without intermediate dicts.
+    """
+
+    def render(self, content: typing.Any) -> bytes:
+        return pydantic_core.to_json(content)
@@ -0,0 +1,72 @@
+import typing
+
+import fastapi
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.cache.balances import BalanceCache
+from app.cache.results import ResultCache
+from app.db.base import get_engine
+from app.db.replicas import ReplicaRouter
+from app.db.resources import (
+    get_balance_cache,
+    get_balance_stream,
+    get_outbox_dispatcher,
+    get_replica_router,
+    get_result_cache,
+)
+from app.outbox.dispatcher import OutboxDispatcher
+from app.streams.balances import BalanceChangeHub
+
+ROUTER: typing.Final = fastapi.APIRouter()
+
+
+@ROUTER.get("/stats/db-pool")
+async def get_db_pool_stats(
+        engine: AsyncEngine = fastapi.Depends(get_engine),
+) -> dict[str, int | float]:
+    return engine.pool.stats()
+
+
+@ROUTER.get("/stats/balance-cache")
+async def get_balance_cache_stats(
+        balance_cache: BalanceCache | None = fastapi.Depends(get_balance_cache),
+) -> dict[str, int | float]:
+    if balance_cache is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="Balance cache is disabled")
+    return balance_cache.stats.as_dict()
+
+
+@ROUTER.get("/stats/result-cache")
+async def get_result_cache_stats(
+        result_cache: ResultCache | None = fastapi.Depends(get_result_cache),
+) -> dict[str, int | float]:
+    if result_cache is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="Result cache is disabled")
+    return result_cache.stats()
+
+
+@ROUTER.get("/stats/outbox")
+async def get_outbox_stats(
+        outbox_dispatcher: OutboxDispatcher | None = fastapi.Depends(get_outbox_dispatcher),
+) -> dict[str, int | float]:
+    if outbox_dispatcher is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="Outbox is disabled")
+    return outbox_dispatcher.stats.as_dict()
+
+
+@ROUTER.get("/stats/balance-stream")
+async def get_balance_stream_stats(
+        balance_stream: BalanceChangeHub | None = fastapi.Depends(get_balance_stream),
+) -> dict[str, int]:
+    if balance_stream is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="Balance stream is disabled")
+    return balance_stream.stats.as_dict(balance_stream.subscriber_count())
+
+
+@ROUTER.get("/stats/replicas")
+async def get_replica_stats(
+        replicas: ReplicaRouter | None = fastapi.Depends(get_replica_router),
+) -> dict[str, typing.Any]:
+    if replicas is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="No replicas configured")
+    return replicas.stats()
@@ -1,51 +1,289 @@
+import asyncio
 import contextlib
 import typing
 
+import asyncpg
 import fastapi
+import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import (
     async_sessionmaker,
-    create_async_engine,
     AsyncSession as AsyncSessionType,
     AsyncEngine,
 )
 
-from app.api.payments import ROUTER
-from app.db.base import get_db
-from app.models import Base
+from app.api import health, metrics, payments, stats
+from app.api.responses import ModelResponse
+from app.cache.balances import BalanceCache, create_balance_cache
+from app.cache.results import ResultCache, create_result_cache
+from app.db.base import create_engine, get_db, get_engine, warm_up_pool
+from app.db.replicas import ReplicaRouter
+from app.db.shards import ShardSet
+from app.db.resources import (
+    get_balance_cache,
+    get_balance_stream,
+    get_metrics,
+    get_outbox_dispatcher,
+    get_readiness_probe,
+    get_replica_router,
+    get_result_cache,
+    get_shards,
+    get_write_coalescer,
+)
+from app.metrics import Metrics, MetricsMiddleware
+from app.enums import OutboxSinkBackend, ReadinessState, WriteMode
+from app.health import ReadinessProbe
+from app.outbox.dispatcher import OutboxDispatcher
+from app.outbox.sinks import create_outbox_sink
+from app.profiling import Profiler, ProfilingMiddleware
+from app.repositories import PaymentRepository
+from app.repositories.coalescing import WriteCoalescer
+from app.repositories.ledger import LedgerCheckpointer
+from app.repositories.sharded import ShardedPaymentRepository
+from app.repositories.snapshots import SnapshotPolicy
 from app.settings import Settings
+from app.streams.balances import BalanceChangeHub
 
 
 def include_routers(app: fastapi.FastAPI) -> None:
-    app.include_router(ROUTER, prefix="/api")
+    app.include_router(payments.ROUTER, prefix="/api")
+    app.include_router(stats.ROUTER, prefix="/api")
+    app.include_router(metrics.ROUTER)
+    app.include_router(health.ROUTER)
 
 
 class AppBuilder:
     _async_engine: AsyncEngine
     _session_maker: async_sessionmaker[AsyncSessionType]
+    _write_coalescer: WriteCoalescer | None = None
+    _balance_cache: BalanceCache | None = None
+    _result_cache: ResultCache | None = None
+    _outbox_dispatcher: OutboxDispatcher | None = None
+    _outbox_task: asyncio.Task[None] | None = None
+    _balance_stream: BalanceChangeHub | None = None
+    _balance_stream_task: asyncio.Task[None] | None = None
+    _metrics: Metrics | None = None
+    _profiler: Profiler | None = None
+    _replica_router: ReplicaRouter | None = None
+    _replica_router_task: asyncio.Task[None] | None = None
+    _shards: ShardSet | None = None
 
-    def __init__(self) -> None:
+    def __init__(
+            self,
+            replica_dsns: typing.Sequence[str] | None = None,
+            shard_dsns: typing.Mapping[str, str] | None = None) -> None:
         self.settings = Settings()
+        self.replica_dsns = list(self.settings.db_replica_dsns if replica_dsns is None else replica_dsns)
+        self.shard_dsns = dict(self.settings.db_shard_dsns if shard_dsns is None else shard_dsns)
+        # Rejects settings without a bound on commits before anything is cached as final.
+        self.commit_horizon = self.settings.commit_horizon()
+        # A replica misses the commits of the last max lag, they must fall within the margin.
+        max_lag = self.settings.db_replica_max_lag_ms / 1000
+        if self.replica_dsns and max_lag >= self.settings.commit_horizon_margin_seconds:
+            raise ValueError(
+                "DB_REPLICA_MAX_LAG_MS must be below COMMIT_HORIZON_MARGIN_SECONDS: "
+                "balances read from replicas are cached as final past the commit horizon")
+        if self.shard_dsns:
+            # Each of these reads or writes one database only.
+            unsupported = {
+                "DATABASE_REPLICA_URLS": bool(self.replica_dsns),
+                "BALANCE_STREAM": self.settings.balance_stream,
+                "OUTBOX_SINK": self.settings.outbox_sink != OutboxSinkBackend.NONE,
+            }
+            if any(unsupported.values()):
+                raise ValueError(
+                    "DATABASE_SHARD_URLS does not support "
+                    + ", ".join(name for name, enabled in unsupported.items() if enabled))
+        self._ledger_checkpointers: list[asyncio.Task[None]] = []
+        self.readiness_probe = ReadinessProbe.from_settings(self.settings)
         self.app: fastapi.FastAPI = fastapi.FastAPI(
             title=self.settings.service_name,
             debug=self.settings.debug,
             lifespan=self.lifespan_manager,
+            default_response_class=ModelResponse,
         )
 
         self.app.dependency_overrides[get_db] = self.get_async_session_maker
+        self.app.dependency_overrides[get_engine] = self.get_async_engine
+        self.app.dependency_overrides[get_write_coalescer] = self.get_write_coalescer
+        self.app.dependency_overrides[get_balance_cache] = self.get_balance_cache
+        self.app.dependency_overrides[get_result_cache] = self.get_result_cache
+        self.app.dependency_overrides[get_outbox_dispatcher] = self.get_outbox_dispatcher
+        self.app.dependency_overrides[get_balance_stream] = self.get_balance_stream
+        self.app.dependency_overrides[get_metrics] = self.get_metrics
+        self.app.dependency_overrides[get_readiness_probe] = self.get_readiness_probe
+        self.app.dependency_overrides[get_replica_router] = self.get_replica_router
+        self.app.dependency_overrides[get_shards] = self.get_shards
+        if self.settings.metrics_enabled:
+            self._metrics = Metrics()
+            self.app.add_middleware(MetricsMiddleware, metrics=self._metrics)
+        self._profiler = Profiler.from_settings(self.settings)
+        if self._profiler is not None:
+            self.app.add_middleware(ProfilingMiddleware, profiler=self._profiler)
         include_routers(self.app)
 
-    async def get_async_session_maker(self) -> AsyncSessionType:
+    async def get_async_session_maker(self) -> async_sessionmaker[AsyncSessionType]:
         return self._session_maker
 
+    async def get_async_engine(self) -> AsyncEngine:
+        return self._async_engine
+
+    async def get_write_coalescer(self) -> WriteCoalescer | None:
+        return self._write_coalescer
+
+    async def get_balance_cache(self) -> BalanceCache | None:
+        return self._balance_cache
+
+    async def get_result_cache(self) -> ResultCache | None:
+        return self._result_cache
+
+    async def get_outbox_dispatcher(self) -> OutboxDispatcher | None:
+        return self._outbox_dispatcher
+
+    async def get_balance_stream(self) -> BalanceChangeHub | None:
+        return self._balance_stream
+
+    async def get_metrics(self) -> Metrics | None:
+        return self._metrics
+
+    async def get_readiness_probe(self) -> ReadinessProbe:
+        return self.readiness_probe
+
+    async def get_replica_router(self) -> ReplicaRouter | None:
+        return self._replica_router
+
+    async def get_shards(self) -> ShardSet | None:
+        return self._shards
+
     async def init_async_resources(self) -> None:
-        self._async_engine = create_async_engine(self.settings.db_dsn)
-        self._session_maker = async_sessionmaker(bind=self._async_engine, expire_on_commit=False)
+        if self.shard_dsns:
+            self._shards = ShardSet.from_engines(
+                {name: create_engine(self.settings, dsn) for name, dsn in self.shard_dsns.items()})
+            # The first shard stands in for the database in pool stats, pool metrics and readiness.
+            first = next(iter(self._shards))
+            self._async_engine, self._session_maker = first.engine, first.session_maker
+        else:
+            self._async_engine = create_engine(self.settings)
+            self._session_maker = async_sessionmaker(bind=self._async_engine, expire_on_commit=False)
+        for engine in self._engines():
+            if self._metrics is not None:
+                self._metrics.instrument_engine(engine, primary=engine is self._async_engine)
+            if self._profiler is not None:
+                self._profiler.instrument_engine(engine)
+        if self.replica_dsns:
+            replica_engines = [create_engine(self.settings, dsn) for dsn in self.replica_dsns]
+            for engine in replica_engines:
+                if self._metrics is not None:
+                    self._metrics.instrument_engine(engine, primary=False)
+                if self._profiler is not None:
+                    self._profiler.instrument_engine(engine)
+            self._replica_router = ReplicaRouter.from_settings(self.settings, self._session_maker, replica_engines)
+            # Reads go to the primary until the first check found the replicas fresh.
+            self._replica_router_task = asyncio.create_task(self._replica_router.run())
+        self._balance_cache = create_balance_cache(self.settings)
+        self._result_cache = create_result_cache(self.settings)
+        if self.settings.write_coalescing:
+            self._write_coalescer = WriteCoalescer(
+                apply_batch=self._payment_repo(
+                    write_mode=self.settings.transaction_write_mode,
+                    snapshot_policy=SnapshotPolicy.from_settings(self.settings),
+                    balance_cache=self._balance_cache,
+                    outbox=self.settings.outbox_sink != OutboxSinkBackend.NONE,
+                    notify_balance_changes=self.settings.balance_stream,
+                ).create_transactions_bulk,
+                max_batch_size=self.settings.write_coalescing_max_batch_size,
+                max_wait=self.settings.write_coalescing_max_wait_ms / 1000,
+            )
+
+        # The schema comes from `alembic upgrade head`, run once per deployment instead of per worker.
+        pool_size, _ = self.settings.db_pool_limits()
+        warmup_connections = min(self.settings.db_pool_warmup, pool_size)
+        if warmup_connections > 0:
+            await asyncio.gather(*(
+                warm_up_pool(engine, warmup_connections, self._prepare_statements) for engine in self._engines()))
+
+        if self.settings.transaction_write_mode == WriteMode.LEDGER:
+            session_makers = [shard.session_maker for shard in self._shards] if self._shards else [self._session_maker]
+            for session_maker in session_makers:
+                checkpointer = LedgerCheckpointer(
+                    session_maker,
+                    PaymentRepository(session_maker, write_mode=WriteMode.LEDGER).checkpoint_ledger,
+                    interval=self.settings.ledger_checkpoint_interval_seconds,
+                    horizon=self.commit_horizon,
+                )
+                self._ledger_checkpointers.append(asyncio.create_task(checkpointer.run()))
+
+        outbox_sink = create_outbox_sink(self.settings)
+        if outbox_sink is not None:
+            self._outbox_dispatcher = OutboxDispatcher(
+                self._session_maker,
+                outbox_sink,
+                batch_size=self.settings.outbox_batch_size,
+                poll_interval=self.settings.outbox_poll_interval_seconds,
+                retry_backoff=self.settings.outbox_retry_backoff_seconds,
+                retry_backoff_max=self.settings.outbox_retry_backoff_max_seconds,
+            )
+            self._outbox_task = asyncio.create_task(self._outbox_dispatcher.run())
+
+        if self.settings.balance_stream:
+            # LISTEN pins its connection, it gets a dedicated one instead of a pool slot.
+            listen_dsn = sa.make_url(self.settings.db_dsn).set(drivername="postgresql").render_as_string(
+                hide_password=False)
+            self._balance_stream = BalanceChangeHub(
+                connect=lambda: asyncpg.connect(listen_dsn),
+                fetch_balance=PaymentRepository(
+                    self._session_maker, write_mode=self.settings.transaction_write_mode).get_user_balance,
+            )
+            self._balance_stream_task = asyncio.create_task(self._balance_stream.run())
+
+        self.readiness_probe.engine = self._async_engine
+        self.readiness_probe.state = ReadinessState.READY
+
+    def _engines(self) -> list[AsyncEngine]:
+        if self._shards is not None:
+            return [shard.engine for shard in self._shards]
+        return [self._async_engine]
+
+    def _payment_repo(self, **options: typing.Any) -> PaymentRepository | ShardedPaymentRepository:
+        if self._shards is not None:
+            return ShardedPaymentRepository(self._shards, **options)
+        return PaymentRepository(self._session_maker, **options)
 
-        async with self._async_engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+    async def _prepare_statements(self, session_maker: async_sessionmaker[AsyncSessionType]) -> None:
+        await PaymentRepository(
+            session_maker,
+            write_mode=self.settings.transaction_write_mode,
+            outbox=self.settings.outbox_sink != OutboxSinkBackend.NONE,
+            notify_balance_changes=self.settings.balance_stream,
+        ).warm_up()
 
     async def tear_down(self) -> None:
-        await self._async_engine.dispose()
+        self.readiness_probe.state = ReadinessState.DRAINING
+        for ledger_checkpointer in self._ledger_checkpointers:
+            ledger_checkpointer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await ledger_checkpointer
+        if self._balance_stream_task is not None:
+            self._balance_stream_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._balance_stream_task
+            await self._balance_stream.close()
+        if self._outbox_task is not None:
+            self._outbox_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._outbox_task
+            await self._outbox_dispatcher.sink.close()
+        if self._write_coalescer is not None:
+            await self._write_coalescer.close()
+        if self._balance_cache is not None:
+            await self._balance_cache.close()
+        if self._replica_router_task is not None:
+            self._replica_router_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._replica_router_task
+            for replica in self._replica_router.replicas:
+                await replica.engine.dispose()
+        for engine in self._engines():
+            await engine.dispose()
 
     @contextlib.asynccontextmanager
     async def lifespan_manager(self, _: fastapi.FastAPI) -> typing.AsyncIterator[dict[str, typing.Any]]:
@@ -56,4 +294,8 @@ class AppBuilder:
             await self.tear_down()
 
 
-application = AppBuilder().app
+def create_app(
+        replica_dsns: typing.Sequence[str] | None = None,
+        shard_dsns: typing.Mapping[str, str] | None = None) -> fastapi.FastAPI:
+    """Application factory, the app is only built in the processes serving it."""
+    return AppBuilder(replica_dsns, shard_dsns).app
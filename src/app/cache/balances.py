@@ -0,0 +1,190 @@
+import abc
+import collections
+import logging
+import time
+import typing
+import uuid
+
+from app.enums import BalanceCacheBackend, WriteMode
+from app.money import MoneyValue
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class CachedBalance(typing.NamedTuple):
+    balance: MoneyValue
+    version: int
+    cached_at: float
+
+
+class BalanceCacheStats:
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        # Writes refused because the cache already held a newer version of the balance.
+        self.stale_sets = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+        # Age of the entries served on hits, i.e. how stale a hit can be.
+        self.hit_age_seconds_sum = 0.0
+        self.hit_age_seconds_max = 0.0
+
+    def observe_hit(self, entry: CachedBalance) -> None:
+        self.hits += 1
+        age = max(time.time() - entry.cached_at, 0.0)
+        self.hit_age_seconds_sum += age
+        self.hit_age_seconds_max = max(self.hit_age_seconds_max, age)
+
+    def as_dict(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "sets": self.sets,
+            "stale_sets": self.stale_sets,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "errors": self.errors,
+            "hit_age_seconds_sum": self.hit_age_seconds_sum,
+            "hit_age_seconds_max": self.hit_age_seconds_max,
+        }
+
+
+class BalanceCache(abc.ABC):
+    """Current balances by user ID, versioned by users.balance_version.
+
+    ``set`` only ever replaces an entry with a newer version, so a slow reader
+    can never put back a balance that a concurrent write already superseded.
+    """
+
+    def __init__(self) -> None:
+        self.stats = BalanceCacheStats()
+
+    async def get(self, user_id: uuid.UUID) -> CachedBalance | None:
+        try:
+            entry = await self._get(user_id)
+        except Exception:
+            logger.exception("Balance cache lookup failed")
+            self.stats.errors += 1
+            entry = None
+        if entry is None:
+            self.stats.misses += 1
+        else:
+            self.stats.observe_hit(entry)
+        return entry
+
+    async def set(self, user_id: uuid.UUID, balance: MoneyValue, version: int) -> None:
+        # The balance is already committed, a cache failure must not fail the request.
+        try:
+            stored = await self._set(user_id, CachedBalance(balance, version, time.time()))
+        except Exception:
+            logger.exception("Balance cache update failed")
+            self.stats.errors += 1
+            return
+        if stored:
+            self.stats.sets += 1
+        else:
+            self.stats.stale_sets += 1
+
+    async def close(self) -> None:
+        """Release the backend's resources."""
+
+    @abc.abstractmethod
+    async def _get(self, user_id: uuid.UUID) -> CachedBalance | None: ...
+
+    @abc.abstractmethod
+    async def _set(self, user_id: uuid.UUID, entry: CachedBalance) -> bool:
+        """Store entry unless a newer version is cached, return whether it was stored."""
+
+
+class InMemoryBalanceCache(BalanceCache):
+    """Per-process LRU. Other workers do not see its updates, the TTL bounds their staleness."""
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: collections.OrderedDict[uuid.UUID, CachedBalance] = collections.OrderedDict()
+
+    async def _get(self, user_id: uuid.UUID) -> CachedBalance | None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if time.time() - entry.cached_at > self.ttl:
+            del self._entries[user_id]
+            self.stats.expirations += 1
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    async def _set(self, user_id: uuid.UUID, entry: CachedBalance) -> bool:
+        current = self._entries.get(user_id)
+        if current is not None and current.version > entry.version:
+            return False
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+        return True
+
+
+# KEYS[1]: entry hash; ARGV: version, balance, cached_at, ttl in milliseconds.
+_SET_IF_NEWER_LUA: typing.Final = """
+local current = redis.call('HGET', KEYS[1], 'version')
+if current and tonumber(current) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'version', ARGV[1], 'balance', ARGV[2], 'cached_at', ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class RedisBalanceCache(BalanceCache):
+    """Cache shared by all workers, in Redis or anything speaking its protocol."""
+
+    def __init__(self, client: typing.Any, ttl: float, key_prefix: str = "balance:"):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._set_if_newer = client.register_script(_SET_IF_NEWER_LUA)
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float) -> "RedisBalanceCache":
+        import redis.asyncio  # optional dependency, only needed for this backend
+
+        return cls(redis.asyncio.Redis.from_url(url), ttl)
+
+    async def _get(self, user_id: uuid.UUID) -> CachedBalance | None:
+        entry = await self.client.hgetall(f"{self.key_prefix}{user_id}")
+        if not entry:
+            return None
+        return CachedBalance(MoneyValue(entry[b"balance"].decode()), int(entry[b"version"]), float(entry[b"cached_at"]))
+
+    async def _set(self, user_id: uuid.UUID, entry: CachedBalance) -> bool:
+        stored = await self._set_if_newer(
+            keys=[f"{self.key_prefix}{user_id}"],
+            args=[entry.version, str(entry.balance), entry.cached_at, int(self.ttl * 1000)],
+        )
+        return bool(stored)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def create_balance_cache(settings: Settings) -> BalanceCache | None:
+    if settings.transaction_write_mode == WriteMode.LEDGER and settings.balance_cache != BalanceCacheBackend.NONE:
+        # Ledger deposits do not touch the user row, there is no balance version to order entries by.
+        logger.warning("The balance cache is not supported in ledger write mode, it stays disabled")
+        return None
+    if settings.balance_cache == BalanceCacheBackend.MEMORY:
+        return InMemoryBalanceCache(settings.balance_cache_size, settings.balance_cache_ttl_seconds)
+    if settings.balance_cache == BalanceCacheBackend.REDIS:
+        return RedisBalanceCache.from_url(settings.balance_cache_url, settings.balance_cache_ttl_seconds)
+    return None
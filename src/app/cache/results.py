@@ -0,0 +1,102 @@
+import collections
+import sys
+import time
+import typing
+
+from app.settings import Settings
+
+MISSING: typing.Final = object()
+
+
+def approximate_size(value: typing.Any) -> int:
+    """Shallow size of value and of its attributes, good enough to budget memory."""
+    size = sys.getsizeof(value)
+    attributes = getattr(value, "__dict__", None)
+    if attributes:
+        size += sum(sys.getsizeof(attribute) for attribute in attributes.values())
+    elif isinstance(value, tuple):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class _Entry(typing.NamedTuple):
+    value: typing.Any
+    size: int
+    expires_at: float | None
+
+
+class ResultCache:
+    """LRU of results that never change once read, capped by their approximate size in memory.
+
+    ``None`` stands for "not found" and expires after ``negative_ttl`` seconds,
+    since the missing row may still be created. Any other value stays until evicted.
+    """
+
+    def __init__(self, max_bytes: int, negative_ttl: float):
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.size = 0
+        self._entries: collections.OrderedDict[typing.Hashable, _Entry] = collections.OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: typing.Hashable) -> typing.Any:
+        """Cached value of key, ``MISSING`` if there is none."""
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at is not None and entry.expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        if entry.value is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return entry.value
+
+    def set(self, key: typing.Hashable, value: typing.Any) -> None:
+        size = approximate_size(key) + approximate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        expires_at = time.monotonic() + self.negative_ttl if value is None else None
+        self._entries[key] = _Entry(value, size, expires_at)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def delete(self, key: typing.Hashable) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    def _remove(self, key: typing.Hashable) -> None:
+        self.size -= self._entries.pop(key).size
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def create_result_cache(settings: Settings) -> ResultCache | None:
+    if settings.result_cache_max_bytes <= 0:
+        return None
+    return ResultCache(settings.result_cache_max_bytes, settings.result_cache_negative_ttl_seconds)
@@ -1,21 +1,66 @@
+import asyncio
+import contextlib
 import logging
+import time
 import typing
 
-from sqlalchemy.ext import asyncio as sa
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession as AsyncSessionType,
+    async_sessionmaker,
+    create_async_engine,
+)
 
-from app.settings import get_settings
+from app.db.pool import InstrumentedAsyncQueuePool
+from app.settings import Settings
 
 logger = logging.getLogger(__name__)
 
-engine: AsyncEngine = create_async_engine(get_settings().db_dsn)
 
+def create_engine(settings: Settings, dsn: str | None = None) -> AsyncEngine:
+    """Engine of the primary, or of the replica at dsn."""
+    pool_size, max_overflow = settings.db_pool_limits()
+    return create_async_engine(
+        dsn or settings.db_dsn,
+        echo=settings.db_echo,
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        pool_recycle=settings.db_pool_recycle,
+        connect_args={
+            "prepared_statement_cache_size": settings.db_prepared_statement_cache_size,
+            "server_settings": {"statement_timeout": str(settings.db_statement_timeout_ms)},
+        },
+    )
 
-async def create_session(_engine: sa.AsyncEngine) -> typing.AsyncIterator[sa.AsyncSession]:
-    async with sa.AsyncSession(_engine, expire_on_commit=False, autoflush=False) as session:
-        yield session
 
+async def warm_up_pool(
+        engine: AsyncEngine,
+        connections: int,
+        prepare: typing.Callable[[async_sessionmaker[AsyncSessionType]], typing.Awaitable[None]]) -> None:
+    """Open connections before the first request and let prepare() run the hot statements on each.
 
-async def get_db():
-    async for session in create_session(engine):
-        yield session
+    The connections are held together, so each one is opened and prepared,
+    and go back to the pool afterwards with their prepared statements.
+    """
+    start = time.perf_counter()
+
+    async def warm_up(connection: typing.Any) -> None:
+        await prepare(async_sessionmaker(bind=connection, expire_on_commit=False))
+
+    async with contextlib.AsyncExitStack() as stack:
+        opened = await asyncio.gather(*(stack.enter_async_context(engine.connect()) for _ in range(connections)))
+        await asyncio.gather(*(warm_up(connection) for connection in opened))
+    logger.info("Warmed up %s pool connections in %.3fs", connections, time.perf_counter() - start)
+
+
+async def get_engine() -> AsyncEngine:
+    """Resolved by AppBuilder, which owns the only engine of the process."""
+    raise RuntimeError("The engine is provided by AppBuilder, override get_engine outside of it")
+
+
+async def get_db() -> async_sessionmaker[AsyncSessionType]:
+    """Resolved by AppBuilder to a session maker bound to its engine."""
+    raise RuntimeError("The session maker is provided by AppBuilder, override get_db outside of it")
@@ -0,0 +1,177 @@
+"""Helpers for migrations that must not lock live tables.
+
+CREATE INDEX CONCURRENTLY and batched backfills cannot run inside a
+transaction. Call them from an autocommit block of the migration::
+
+    def upgrade() -> None:
+        with op.get_context().autocommit_block():
+            create_index_concurrently(op.get_bind(), "ix_transactions_user_id_created_at", "transactions",
+                                      ["user_id", "created_at"])
+
+Both are idempotent, so a migration interrupted halfway can simply be run again.
+"""
+import logging
+import time
+import typing
+
+import sqlalchemy as sa
+
+from app.db.partitions import PARTITIONED_TABLES
+
+logger = logging.getLogger(__name__)
+
+# How long DDL that needs a brief exclusive lock waits for it before failing, instead of queueing
+# every query on the table behind it.
+LOCK_TIMEOUT: typing.Final = "5s"
+
+
+def include_object(obj: typing.Any, name: str | None, type_: str, reflected: bool, compare_to: typing.Any) -> bool:
+    """Keep partitions, which are created at runtime and not part of the models, out of autogenerate."""
+    if type_ == "table" and reflected and compare_to is None and name is not None:
+        return not any(name.startswith(f"{table}_") for table in PARTITIONED_TABLES)
+    return True
+
+
+def _index_state(connection: sa.Connection, name: str) -> bool | None:
+    """Whether the index is valid, None if it does not exist."""
+    return connection.execute(
+        sa.text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": name}
+    ).scalar()
+
+
+def _is_partitioned(connection: sa.Connection, table: str) -> bool:
+    return connection.execute(
+        sa.text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}
+    ).scalar() or False
+
+
+def _partitions(connection: sa.Connection, table: str) -> list[str]:
+    return list(connection.execute(sa.text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(:table)
+        ORDER BY child.relname
+    """), {"table": table}).scalars())
+
+
+def _attached_index(connection: sa.Connection, parent_index: str, partition: str) -> str | None:
+    return connection.execute(sa.text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_index ON pg_index.indexrelid = child.oid
+        WHERE pg_inherits.inhparent = to_regclass(:parent_index) AND pg_index.indrelid = to_regclass(:partition)
+    """), {"parent_index": parent_index, "partition": partition}).scalar()
+
+
+def _build_concurrently(connection: sa.Connection, name: str, table: str, definition: str) -> None:
+    if _index_state(connection, name) is False:
+        # Left invalid by an interrupted build, it is maintained by writes but never used.
+        connection.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    connection.execute(sa.text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}"))
+
+
+def create_index_concurrently(
+        connection: sa.Connection,
+        name: str,
+        table: str,
+        columns: typing.Sequence[str],
+        where: str | None = None) -> None:
+    """Build an index without blocking writes, also on partitioned tables.
+
+    Postgres cannot build an index concurrently on a partitioned table. The
+    index is created on the parent only, which is instant and leaves it
+    invalid, then built concurrently on each partition and attached to it.
+    It becomes valid once every partition has its index attached. Partitions
+    created in the meantime get the index from the parent.
+    """
+    definition = f"({', '.join(columns)})" + (f" WHERE {where}" if where else "")
+    if not _is_partitioned(connection, table):
+        _build_concurrently(connection, name, table, definition)
+        return
+    if _index_state(connection, name):
+        return
+
+    connection.execute(sa.text(f"SET lock_timeout = '{LOCK_TIMEOUT}'"))
+    try:
+        connection.execute(sa.text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}"))
+        for partition in _partitions(connection, table):
+            if _attached_index(connection, name, partition) is not None:
+                continue
+            partition_index = f"{partition}_{name.removeprefix('ix_').removeprefix(f'{table}_')}"[:63]
+            start = time.monotonic()
+            _build_concurrently(connection, partition_index, partition, definition)
+            connection.execute(sa.text(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}"))
+            logger.info("Built %s in %.1fs", partition_index, time.monotonic() - start)
+    finally:
+        connection.execute(sa.text("RESET lock_timeout"))
+
+
+def drop_index_concurrently(connection: sa.Connection, name: str) -> None:
+    """Drop an index without blocking writes where Postgres allows it.
+
+    Indexes of partitioned tables cannot be dropped concurrently, they are
+    dropped under a brief lock bounded by LOCK_TIMEOUT.
+    """
+    partitioned = connection.execute(
+        sa.text("SELECT relkind = 'I' FROM pg_class WHERE oid = to_regclass(:name)"), {"name": name}
+    ).scalar()
+    if partitioned is None:
+        return
+    if not partitioned:
+        connection.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        return
+    connection.execute(sa.text(f"SET lock_timeout = '{LOCK_TIMEOUT}'"))
+    try:
+        connection.execute(sa.text(f"DROP INDEX IF EXISTS {name}"))
+    finally:
+        connection.execute(sa.text("RESET lock_timeout"))
+
+
+def set_not_null(connection: sa.Connection, table: str, column: str) -> None:
+    """SET NOT NULL without holding an exclusive lock during the table scan.
+
+    A NOT VALID check constraint is validated under a lock that lets writes
+    through, then SET NOT NULL relies on it instead of scanning the table
+    itself. NULLs must have been backfilled first.
+    """
+    constraint = f"{table}_{column}_not_null"[:63]
+    connection.execute(sa.text(f"SET lock_timeout = '{LOCK_TIMEOUT}'"))
+    try:
+        connection.execute(sa.text(f"""
+            DO $$ BEGIN
+                ALTER TABLE {table} ADD CONSTRAINT {constraint} CHECK ({column} IS NOT NULL) NOT VALID;
+            EXCEPTION WHEN duplicate_object THEN NULL;
+            END $$
+        """))
+        connection.execute(sa.text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}"))
+        connection.execute(sa.text(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL"))
+        connection.execute(sa.text(f"ALTER TABLE {table} DROP CONSTRAINT {constraint}"))
+    finally:
+        connection.execute(sa.text("RESET lock_timeout"))
+
+
+def backfill_in_batches(
+        connection: sa.Connection,
+        statement: sa.TextClause,
+        batch_size: int = 10_000,
+        pause: float = 0.0) -> int:
+    """Run statement until it changes no more rows, committing each batch; return the rows changed.
+
+    statement must change at most :batch_size rows per run and skip the rows
+    already done, e.g. ``UPDATE t SET b = a WHERE id IN (SELECT id FROM t
+    WHERE b IS NULL LIMIT :batch_size)``. Row locks are only held for one
+    batch, ``pause`` seconds between batches leave room for replication.
+    """
+    if connection.get_execution_options().get("isolation_level") != "AUTOCOMMIT":
+        raise RuntimeError("Backfills commit batch by batch, run them in an autocommit block")
+    total = 0
+    while True:
+        changed = connection.execute(statement, {"batch_size": batch_size}).rowcount
+        total += changed
+        if changed < batch_size:
+            return total
+        logger.info("Backfilled %s rows", total)
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,171 @@
+"""Online conversion of money columns between MONEY_REPRESENTATION modes.
+
+Each money column gets a shadow column in the target type, which a trigger
+keeps in sync with every row written meanwhile. The existing rows are then
+backfilled in batches and the shadow column is set NOT NULL. None of this
+blocks writers. Finally, one short transaction drops the old column and
+renames the shadow column in its place::
+
+    python -m app.db.money to-minor-units
+    python -m app.db.money to-decimal
+
+Until the swap, writers keep running with the old MONEY_REPRESENTATION. Stop
+them before the swap, ``--prepare-only`` runs every step up to it, and
+restart them with the new MONEY_REPRESENTATION after it. Flush the redis
+balance cache too, its entries hold amounts in the old representation.
+Partitions detached to an archive schema are not converted.
+"""
+import argparse
+import asyncio
+import logging
+import typing
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.db.migrations import (
+    LOCK_TIMEOUT,
+    backfill_in_batches,
+    create_index_concurrently,
+    drop_index_concurrently,
+    set_not_null,
+)
+from app.enums import MoneyRepresentation
+from app.money import MINOR_UNITS_PER_UNIT, SCALE
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class MoneyColumn(typing.NamedTuple):
+    table: str
+    column: str
+    primary_key: tuple[str, ...]
+    server_default: str | None = None
+
+
+MONEY_COLUMNS: typing.Final = (
+    MoneyColumn("users", "balance", ("id",), server_default="0"),
+    MoneyColumn("transactions", "amount", ("id", "created_at")),
+    MoneyColumn("balances_snapshots", "balance", ("id", "created_at")),
+)
+
+# Postgres type and conversion from the other representation, per target representation.
+SQL_TYPES: typing.Final = {
+    MoneyRepresentation.DECIMAL: (
+        "numeric", f"numeric(12, {SCALE})", f"CAST({{column}} AS numeric) / {MINOR_UNITS_PER_UNIT}"),
+    MoneyRepresentation.MINOR_UNITS: ("bigint", "bigint", f"CAST({{column}} * {MINOR_UNITS_PER_UNIT} AS bigint)"),
+}
+
+
+def _names(money_column: MoneyColumn) -> tuple[str, str, str]:
+    """Shadow column, its sync trigger (and function) and its backfill index."""
+    shadow = f"{money_column.column}_converted"
+    return shadow, f"{money_column.table}_{shadow}_sync", f"ix_{money_column.table}_{shadow}_pending"
+
+
+def _data_type(connection: sa.Connection, table: str, column: str) -> str | None:
+    return connection.execute(sa.text("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column
+    """), {"table": table, "column": column}).scalar()
+
+
+def prepare_column(
+        connection: sa.Connection,
+        money_column: MoneyColumn,
+        target: MoneyRepresentation,
+        batch_size: int = 10_000,
+        pause: float = 0.0) -> bool:
+    """Add, sync and backfill the shadow column; False if the column has the target type already.
+
+    Runs on an autocommit connection, writers may keep going meanwhile. It is
+    idempotent, an interrupted run is simply run again.
+    """
+    data_type, sql_type, conversion = SQL_TYPES[target]
+    table, column = money_column.table, money_column.column
+    shadow, trigger, index = _names(money_column)
+    if _data_type(connection, table, column) == data_type:
+        return False
+
+    connection.execute(sa.text(f"SET lock_timeout = '{LOCK_TIMEOUT}'"))
+    try:
+        connection.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {shadow} {sql_type}"))
+        connection.execute(sa.text(f"""
+            CREATE OR REPLACE FUNCTION {trigger}() RETURNS trigger AS $$
+            BEGIN
+                NEW.{shadow} := {conversion.format(column=f"NEW.{column}")};
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql
+        """))
+        connection.execute(sa.text(f"""
+            CREATE OR REPLACE TRIGGER {trigger} BEFORE INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {trigger}()
+        """))
+    finally:
+        connection.execute(sa.text("RESET lock_timeout"))
+
+    # Rows written from now on are converted by the trigger, the index finds the older ones.
+    create_index_concurrently(connection, index, table, money_column.primary_key, where=f"{shadow} IS NULL")
+    key = ", ".join(money_column.primary_key)
+    backfilled = backfill_in_batches(connection, sa.text(f"""
+        UPDATE {table} SET {shadow} = {conversion.format(column=column)}
+        WHERE ({key}) IN (SELECT {key} FROM {table} WHERE {shadow} IS NULL LIMIT :batch_size)
+    """), batch_size=batch_size, pause=pause)
+    logger.info("Backfilled %s.%s: %s rows", table, shadow, backfilled)
+    set_not_null(connection, table, shadow)
+    drop_index_concurrently(connection, index)
+    return True
+
+
+def swap_columns(connection: sa.Connection, target: MoneyRepresentation) -> list[str]:
+    """Replace the prepared money columns by their shadow columns, in the caller's transaction.
+
+    Only takes brief exclusive locks, bounded by LOCK_TIMEOUT. Writers must
+    be stopped: rows they write in the old representation after it would be
+    stored unconverted.
+    """
+    data_type = SQL_TYPES[target][0]
+    swapped = []
+    connection.execute(sa.text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+    for money_column in MONEY_COLUMNS:
+        table, column = money_column.table, money_column.column
+        shadow, trigger, _ = _names(money_column)
+        if _data_type(connection, table, shadow) != data_type:
+            continue
+        connection.execute(sa.text(f"DROP TRIGGER {trigger} ON {table}"))
+        connection.execute(sa.text(f"DROP FUNCTION {trigger}()"))
+        connection.execute(sa.text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        connection.execute(sa.text(f"ALTER TABLE {table} RENAME COLUMN {shadow} TO {column}"))
+        if money_column.server_default is not None:
+            connection.execute(sa.text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT {money_column.server_default}"))
+        swapped.append(f"{table}.{column}")
+    return swapped
+
+
+async def main(args: argparse.Namespace) -> None:
+    target = MoneyRepresentation.MINOR_UNITS if args.command == "to-minor-units" else MoneyRepresentation.DECIMAL
+    engine = create_async_engine(get_settings().db_dsn)
+    try:
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            for money_column in MONEY_COLUMNS:
+                await conn.run_sync(prepare_column, money_column, target, args.batch_size, args.pause)
+        if not args.prepare_only:
+            async with engine.begin() as conn:
+                swapped = await conn.run_sync(swap_columns, target)
+            logger.info("Converted to %s: %s", target.value, ", ".join(swapped) or "nothing to do")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convert money columns to another MONEY_REPRESENTATION.")
+    parser.add_argument("command", choices=["to-minor-units", "to-decimal"])
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds between backfill batches")
+    parser.add_argument("--prepare-only", action="store_true",
+                        help="stop before swapping the columns, which requires the writers to be stopped")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,159 @@
+"""Monthly partitions of the transactions and balances_snapshots tables.
+
+Run from cron (or any scheduler) to keep partitions created ahead of time
+and to detach old ones::
+
+    python -m app.db.partitions create --months-ahead 3
+    python -m app.db.partitions detach --older-than 24 --archive-schema archive
+"""
+import argparse
+import asyncio
+import logging
+import re
+import typing
+from datetime import date, datetime, time
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.models import BalancesSnapshots, Transaction, User
+from app.repositories.payments import PaymentRepository
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLES: typing.Final = ("transactions", "balances_snapshots")
+MONTHS_AHEAD: typing.Final = 3
+
+_MONTHLY_PARTITION: typing.Final = re.compile(r"_(\d{4})_(\d{2})$")
+
+
+def month_start(value: date, months: int = 0) -> date:
+    """First day of the month ``months`` after the one containing value."""
+    month_index = value.year * 12 + value.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_{month:%Y_%m}"
+
+
+def list_partitions(connection: sa.Connection, table: str) -> dict[date, str]:
+    """Monthly partitions of table by first day of their month (default/legacy ones are skipped)."""
+    rows = connection.execute(sa.text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :table
+    """), {"table": table}).scalars()
+    partitions = {}
+    for name in rows:
+        match = _MONTHLY_PARTITION.search(name)
+        if match:
+            partitions[date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def create_partitions(
+        connection: sa.Connection,
+        months_ahead: int = MONTHS_AHEAD,
+        since: typing.Optional[date] = None) -> list[str]:
+    """Create the monthly partitions from ``since`` (default: this month) to ``months_ahead`` months later.
+
+    Must run before rows for a month arrive: once the default partition holds
+    rows of a month, creating that month's partition fails.
+    """
+    first = month_start(since or datetime.utcnow().date())
+    created = []
+    for table in PARTITIONED_TABLES:
+        existing = list_partitions(connection, table)
+        for offset in range(months_ahead + 1):
+            month = month_start(first, offset)
+            if month in existing:
+                continue
+            name = partition_name(table, month)
+            connection.execute(sa.text(
+                f"CREATE TABLE {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{month_start(month, 1).isoformat()}')"
+            ))
+            created.append(name)
+    return created
+
+
+def carry_forward_balances(connection: sa.Connection, cutoff: datetime) -> int:
+    """Snapshot the balance as of cutoff of every user with transactions or snapshots before it.
+
+    Historical balances start from the last snapshot before them, so with
+    these snapshots balances after cutoff no longer need the older rows.
+    Users with a snapshot at cutoff already are skipped, the step is idempotent.
+    """
+    has_history = sa.or_(
+        sa.exists().where(Transaction.user_id == User.id, Transaction.created_at < cutoff),
+        sa.exists().where(BalancesSnapshots.user_id == User.id, BalancesSnapshots.created_at < cutoff),
+    )
+    carried = sa.exists().where(BalancesSnapshots.user_id == User.id, BalancesSnapshots.created_at == cutoff)
+    balances = PaymentRepository._balances_at_query(sa.and_(has_history, ~carried), cutoff)
+    result = connection.execute(sa.insert(BalancesSnapshots).from_select(
+        ["user_id", "balance", "created_at"],
+        balances.add_columns(sa.literal(cutoff, sa.DateTime)),
+    ))
+    return result.rowcount
+
+
+def detach_partitions(
+        connection: sa.Connection,
+        older_than_months: int,
+        archive_schema: typing.Optional[str] = None,
+        today: typing.Optional[date] = None) -> list[str]:
+    """Detach partitions whose whole month is older than ``older_than_months`` months.
+
+    Detached partitions stay as plain tables, optionally moved to ``archive_schema``
+    so they can be dumped and dropped. Their transactions keep their key, so the
+    IDs stay reserved, but they are no longer served by the API. Balances are
+    carried forward first, see carry_forward_balances, so balances as of the
+    cutoff or later still include them.
+    """
+    cutoff = month_start(today or datetime.utcnow().date(), -older_than_months)
+    partitions = [
+        (table, name)
+        for table in PARTITIONED_TABLES
+        for month, name in sorted(list_partitions(connection, table).items())
+        if month_start(month, 1) <= cutoff
+    ]
+    if not partitions:
+        return []
+    carried = carry_forward_balances(connection, datetime.combine(cutoff, time()))
+    logger.info("Carried forward the balances of %s users to %s", carried, cutoff)
+    if archive_schema:
+        connection.execute(sa.text(f'CREATE SCHEMA IF NOT EXISTS "{archive_schema}"'))
+    for table, name in partitions:
+        connection.execute(sa.text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        if archive_schema:
+            connection.execute(sa.text(f'ALTER TABLE {name} SET SCHEMA "{archive_schema}"'))
+    return [name for _, name in partitions]
+
+
+async def main(args: argparse.Namespace) -> None:
+    engine = create_async_engine(get_settings().db_dsn)
+    try:
+        async with engine.begin() as conn:
+            if args.command == "create":
+                tables = await conn.run_sync(create_partitions, args.months_ahead)
+            else:
+                tables = await conn.run_sync(detach_partitions, args.older_than, args.archive_schema)
+    finally:
+        await engine.dispose()
+    logger.info("%s: %s", args.command, ", ".join(tables) or "nothing to do")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain monthly partitions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="create partitions ahead of time")
+    create.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD)
+    detach = commands.add_parser("detach", help="detach (and archive) old partitions")
+    detach.add_argument("--older-than", type=int, required=True, help="age in months")
+    detach.add_argument("--archive-schema", default=None)
+    asyncio.run(main(parser.parse_args()))
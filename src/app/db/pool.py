@@ -0,0 +1,65 @@
+import bisect
+import time
+import typing
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry
+
+CHECKOUT_WAIT_BUCKETS: typing.Final = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class PoolMetrics:
+    """Checkout wait statistics of one pool, kept across pool re-creation."""
+
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_sum = 0.0
+        self.wait_seconds_max = 0.0
+        # Counts per bucket of CHECKOUT_WAIT_BUCKETS, the last one is +Inf; app.metrics accumulates them.
+        self.wait_buckets = [0] * (len(CHECKOUT_WAIT_BUCKETS) + 1)
+
+    def observe_checkout(self, wait_seconds: float) -> None:
+        self.checkouts += 1
+        self.wait_seconds_sum += wait_seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+        self.wait_buckets[bisect.bisect_left(CHECKOUT_WAIT_BUCKETS, wait_seconds)] += 1
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that measures how long callers wait for a connection."""
+
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        self.metrics.observe_checkout(time.perf_counter() - start)
+        return connection
+
+    def recreate(self) -> "InstrumentedAsyncQueuePool":
+        pool = typing.cast(InstrumentedAsyncQueuePool, super().recreate())
+        pool.metrics = self.metrics
+        return pool
+
+    def stats(self) -> dict[str, int | float]:
+        capacity = self.size() + self._max_overflow
+        checked_out = self.checkedout()
+        return {
+            "size": self.size(),
+            "max_overflow": self._max_overflow,
+            "checked_in": self.checkedin(),
+            "checked_out": checked_out,
+            "overflow": max(self.overflow(), 0),
+            "saturation": checked_out / capacity if capacity > 0 else 0.0,
+            "checkouts": self.metrics.checkouts,
+            "checkout_timeouts": self.metrics.timeouts,
+            "checkout_wait_seconds_sum": self.metrics.wait_seconds_sum,
+            "checkout_wait_seconds_max": self.metrics.wait_seconds_max,
+        }
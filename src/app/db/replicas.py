@@ -0,0 +1,150 @@
+"""Routing of reads to streaming replicas, DATABASE_REPLICA_URLS.
+
+ReplicaRouter samples the WAL position of the primary every
+DB_REPLICA_CHECK_INTERVAL_MS, along with the position each replica has
+replayed. A replica that replayed the position sampled at time t holds every
+transaction committed before t, so each replica is known to be fresh as of
+the newest such sample, with no dependency on the clocks of the servers.
+
+Reads that tolerate lag go to a replica fresh as of DB_REPLICA_MAX_LAG_MS
+ago, or to the primary when none is. Write responses carry a consistency
+token, the time the write committed; a read that sends it back in
+``X-Consistency-Token`` only goes to a replica fresh as of that time, so
+clients read their own writes. Tokens are compared across workers, which
+needs their clocks in sync to within the check interval.
+"""
+import asyncio
+import itertools
+import logging
+import time
+import typing
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession as AsyncSessionType, async_sessionmaker
+
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+CONSISTENCY_TOKEN_HEADER: typing.Final = "X-Consistency-Token"
+
+PRIMARY_WAL_POSITION_SQL: typing.Final = sa.text("SELECT CAST(pg_current_wal_lsn() AS text)")
+# A server that is not a standby, e.g. the primary itself in local setups, is always fresh.
+REPLICA_WAL_POSITION_SQL: typing.Final = sa.text("""
+    SELECT CAST(CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END AS text)
+""")
+
+
+def parse_lsn(lsn: str) -> int:
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class Replica:
+    def __init__(self, name: str, engine: AsyncEngine):
+        self.name = name
+        self.engine = engine
+        self.session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+        # Every transaction committed on the primary before this time is replayed here.
+        self.fresh_as_of = 0.0
+        self.reads = 0
+        self.failed_checks = 0
+
+
+class ReplicaRouter:
+    def __init__(
+            self,
+            primary: async_sessionmaker[AsyncSessionType],
+            replicas: typing.Sequence[Replica],
+            max_lag: float,
+            check_interval: float):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.primary_reads = 0
+        self._next = itertools.count()
+        # (time, WAL position) of the primary, oldest first.
+        self._samples: list[tuple[float, int]] = []
+
+    @classmethod
+    def from_settings(
+            cls,
+            settings: Settings,
+            primary: async_sessionmaker[AsyncSessionType],
+            engines: typing.Sequence[AsyncEngine]) -> "ReplicaRouter":
+        return cls(
+            primary,
+            [Replica(engine.url.render_as_string(hide_password=True), engine) for engine in engines],
+            max_lag=settings.db_replica_max_lag_ms / 1000,
+            check_interval=settings.db_replica_check_interval_ms / 1000,
+        )
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Sampling the primary WAL position failed")
+            await asyncio.sleep(self.check_interval)
+
+    async def check(self) -> None:
+        """Sample the primary, then update how fresh each replica is."""
+        sampled_at = time.time()
+        async with self.primary() as session:
+            position = parse_lsn(await session.scalar(PRIMARY_WAL_POSITION_SQL))
+        self._samples.append((sampled_at, position))
+        await asyncio.gather(*(self._check_replica(replica) for replica in self.replicas))
+        # Samples older than the stalest replica, and than max_lag, are of no use anymore.
+        oldest = min([sampled_at - self.max_lag, *(replica.fresh_as_of for replica in self.replicas)])
+        while len(self._samples) > 1 and self._samples[1][0] <= oldest:
+            self._samples.pop(0)
+
+    async def _check_replica(self, replica: Replica) -> None:
+        try:
+            async with replica.session_maker() as session:
+                replayed = parse_lsn(await session.scalar(REPLICA_WAL_POSITION_SQL))
+        except Exception:
+            # Not used again before it catches up with a later sample.
+            replica.failed_checks += 1
+            logger.warning("Checking replica %s failed", replica.name, exc_info=True)
+            return
+        for sampled_at, position in reversed(self._samples):
+            if position <= replayed:
+                replica.fresh_as_of = max(replica.fresh_as_of, sampled_at)
+                break
+
+    def session_maker(self, token: str | None = None) -> async_sessionmaker[AsyncSessionType]:
+        """Session maker of a replica fresh enough for a read, or of the primary."""
+        fresh_as_of = time.time() - self.max_lag
+        if token is not None:
+            try:
+                fresh_as_of = max(fresh_as_of, float(token))
+            except ValueError:
+                fresh_as_of = float("inf")
+        candidates = [replica for replica in self.replicas if replica.fresh_as_of >= fresh_as_of]
+        if not candidates:
+            self.primary_reads += 1
+            return self.primary
+        replica = candidates[next(self._next) % len(candidates)]
+        replica.reads += 1
+        return replica.session_maker
+
+    @staticmethod
+    def consistency_token() -> str:
+        """Token for a write that just committed, see CONSISTENCY_TOKEN_HEADER."""
+        return f"{time.time():.6f}"
+
+    def stats(self) -> dict[str, typing.Any]:
+        now = time.time()
+        return {
+            "primary_reads": self.primary_reads,
+            "replicas": {
+                replica.name: {
+                    "reads": replica.reads,
+                    "lag_seconds": now - replica.fresh_as_of if replica.fresh_as_of else None,
+                    "failed_checks": replica.failed_checks,
+                }
+                for replica in self.replicas
+            },
+        }
@@ -1,20 +1,108 @@
+import functools
 import logging
 
-from fastapi import Depends
+from fastapi import Depends, Request
 from sqlalchemy.ext.asyncio import (
     AsyncSession as AsyncSessionType,
 )
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from app.cache.balances import BalanceCache
+from app.cache.results import ResultCache
 from app.db.base import get_db
+from app.db.replicas import CONSISTENCY_TOKEN_HEADER, ReplicaRouter
+from app.db.shards import ShardSet
+from app.enums import OutboxSinkBackend
+from app.health import ReadinessProbe
+from app.metrics import Metrics
+from app.outbox.dispatcher import OutboxDispatcher
 from app.repositories import PaymentRepository
+from app.repositories.coalescing import WriteCoalescer
+from app.repositories.sharded import ShardedPaymentRepository
+from app.repositories.snapshots import SnapshotPolicy
+from app.settings import Settings, get_settings
+from app.streams.balances import BalanceChangeHub
 
 logger = logging.getLogger(__name__)
 
 
+def get_write_coalescer() -> WriteCoalescer | None:
+    """Write coalescing is off unless AppBuilder provides its process-wide coalescer."""
+    return None
+
+
+def get_balance_cache() -> BalanceCache | None:
+    """Balances are read from the DB unless AppBuilder provides its process-wide cache."""
+    return None
+
+
+def get_result_cache() -> ResultCache | None:
+    """Transactions and past balances are read from the DB unless AppBuilder provides its cache."""
+    return None
+
+
+def get_outbox_dispatcher() -> OutboxDispatcher | None:
+    """No events are published unless AppBuilder provides its dispatcher."""
+    return None
+
+
+def get_balance_stream() -> BalanceChangeHub | None:
+    """Balance changes are not pushed unless AppBuilder provides its process-wide hub."""
+    return None
+
+
+def get_metrics() -> Metrics | None:
+    """Nothing is measured unless AppBuilder provides its metrics."""
+    return None
+
+
+def get_readiness_probe() -> ReadinessProbe | None:
+    """Never ready unless AppBuilder provides the probe of its worker."""
+    return None
+
+
+def get_replica_router() -> ReplicaRouter | None:
+    """Everything is read from the primary unless AppBuilder provides its replica router."""
+    return None
+
+
+def get_shards() -> ShardSet | None:
+    """Every user is in the DATABASE_URL database unless AppBuilder provides its shards."""
+    return None
+
+
 def get_payment_repo(
+        request: Request,
         db: async_sessionmaker[AsyncSessionType] = Depends(get_db),
-) -> PaymentRepository:
+        settings: Settings = Depends(get_settings),
+        write_coalescer: WriteCoalescer | None = Depends(get_write_coalescer),
+        balance_cache: BalanceCache | None = Depends(get_balance_cache),
+        result_cache: ResultCache | None = Depends(get_result_cache),
+        replicas: ReplicaRouter | None = Depends(get_replica_router),
+        shards: ShardSet | None = Depends(get_shards),
+) -> PaymentRepository | ShardedPaymentRepository:
+    if shards is not None:
+        return ShardedPaymentRepository(
+            shards,
+            write_coalescer=write_coalescer,
+            write_mode=settings.transaction_write_mode,
+            snapshot_policy=SnapshotPolicy.from_settings(settings),
+            balance_cache=balance_cache,
+            result_cache=result_cache,
+            commit_horizon=settings.commit_horizon(),
+        )
     return PaymentRepository(
         db_session_maker=db,
+        write_mode=settings.transaction_write_mode,
+        write_coalescer=write_coalescer,
+        snapshot_policy=SnapshotPolicy.from_settings(settings),
+        balance_cache=balance_cache,
+        result_cache=result_cache,
+        outbox=settings.outbox_sink != OutboxSinkBackend.NONE,
+        notify_balance_changes=settings.balance_stream,
+        commit_horizon=settings.commit_horizon(),
+        route_reads=(
+            functools.partial(replicas.session_maker, request.headers.get(CONSISTENCY_TOKEN_HEADER))
+            if replicas is not None else None
+        ),
     )
@@ -0,0 +1,257 @@
+"""Hash-sharded accounts, DATABASE_SHARD_URLS.
+
+Each user lives, with all their transactions and snapshots, on one of N
+Postgres databases. A consistent hash ring maps the user ID to its shard:
+every shard name owns SHARD_VIRTUAL_NODES points on the ring, and a user
+belongs to the shard owning the first point at or after the hash of their
+ID. Adding a shard only moves the users that land on its points, about 1/N
+of them, from the other shards.
+
+Every shard runs the same schema. Migrations and partition maintenance run
+against each of them, with DATABASE_URL pointed at the shard. A write
+checks the other shards for its transaction ID first, see
+app.repositories.sharded, only concurrent writes of one ID can still leave
+it on several shards.
+
+After a change of DATABASE_SHARD_URLS, move the users whose shard changed
+with the writers stopped::
+
+    python -m app.db.shards rebalance --dry-run
+    python -m app.db.shards rebalance --drain old=postgresql+asyncpg://...
+
+``--drain`` names shards being removed, whose users all move. Each user is
+copied in one transaction on the target and deleted from the source after
+it committed, an interrupted run is simply run again. A user with a
+transaction ID the target already has for another user stays where it is,
+the run reports it and goes on with the others.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import typing
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession as AsyncSessionType,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from app.exceptions import TransactionIdConflictError
+from app.models import BalancesSnapshots, Transaction, TransactionKey, User
+from app.repositories import PaymentRepository
+from app.settings import get_settings, parse_shard_dsns
+
+logger = logging.getLogger(__name__)
+
+SHARD_VIRTUAL_NODES: typing.Final = 256
+REBALANCE_BATCH_SIZE: typing.Final = 1000
+
+
+def _hash(key: bytes) -> int:
+    # Stable across processes and Python versions, unlike hash().
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, names: typing.Iterable[str], virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        points = sorted(
+            (_hash(f"{name}#{i}".encode()), name) for name in set(names) for i in range(virtual_nodes))
+        if not points:
+            raise ValueError("A hash ring needs at least one shard")
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get(self, user_id: uuid.UUID) -> str:
+        """Name of the shard holding user_id."""
+        index = bisect.bisect_left(self._hashes, _hash(user_id.bytes))
+        return self._names[index % len(self._names)]
+
+
+class Shard(typing.NamedTuple):
+    name: str
+    engine: AsyncEngine
+    session_maker: async_sessionmaker[AsyncSessionType]
+
+
+class ShardSet:
+    def __init__(self, shards: typing.Sequence[Shard], virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        self.shards = {shard.name: shard for shard in shards}
+        self.ring = HashRing(self.shards, virtual_nodes)
+
+    @classmethod
+    def from_engines(cls, engines: typing.Mapping[str, AsyncEngine]) -> "ShardSet":
+        return cls([
+            Shard(name, engine, async_sessionmaker(bind=engine, expire_on_commit=False))
+            for name, engine in engines.items()
+        ])
+
+    def __iter__(self) -> typing.Iterator[Shard]:
+        return iter(self.shards.values())
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def shard_for(self, user_id: uuid.UUID) -> Shard:
+        return self.shards[self.ring.get(user_id)]
+
+    def group(self, user_ids: typing.Iterable[uuid.UUID]) -> dict[str, list[uuid.UUID]]:
+        """The given user IDs by shard name, shards without any are left out."""
+        groups: dict[str, list[uuid.UUID]] = {}
+        for user_id in user_ids:
+            groups.setdefault(self.ring.get(user_id), []).append(user_id)
+        return groups
+
+
+class Rebalanced(typing.NamedTuple):
+    # Users moved per "source -> target".
+    moved: dict[str, int]
+    # Users left in place, their transaction IDs conflict with the target's.
+    conflicts: list[uuid.UUID]
+
+
+async def move_user(
+        source: AsyncEngine,
+        target: AsyncEngine,
+        user_id: uuid.UUID,
+        batch_size: int = REBALANCE_BATCH_SIZE) -> bool:
+    """Move the user and their history from source to target; False if source does not hold them.
+
+    Raises TransactionIdConflictError, before copying anything, when the
+    target has one of their transaction IDs already.
+    """
+    users, transactions = User.__table__, Transaction.__table__
+    keys, snapshots = TransactionKey.__table__, BalancesSnapshots.__table__
+    async with source.begin() as src:
+        user = (await src.execute(sa.select(users).where(users.c.id == user_id).with_for_update())).mappings().first()
+        if user is None:
+            return False
+        async with target.begin() as dst:
+            await _check_transaction_ids(src, dst, user_id, batch_size)
+            # Present after a run interrupted before the source committed: the copy is complete.
+            if await dst.scalar(sa.select(users.c.id).where(users.c.id == user_id)) is None:
+                # Ledger transactions not folded into users.balance yet are folded on the way.
+                _, balance = (await src.execute(PaymentRepository._ledger_balances_query(users.c.id == user_id))).one()
+                await dst.execute(sa.insert(users).values({**user, "balance": balance, "ledger_seq": 0}))
+                await _copy(src, dst, sa.select(transactions).where(transactions.c.user_id == user_id), batch_size,
+                            lambda rows: [
+                                sa.insert(transactions).values([{**row, "seq": None} for row in rows]),
+                                sa.insert(keys).values([{"id": row["id"], "created_at": row["created_at"]}
+                                                        for row in rows]),
+                            ])
+                await _copy(src, dst, sa.select(snapshots).where(snapshots.c.user_id == user_id), batch_size,
+                            lambda rows: [sa.insert(snapshots).values([
+                                {column: value for column, value in row.items() if column != "id"} for row in rows
+                            ])])
+        transaction_ids = sa.select(transactions.c.id).where(transactions.c.user_id == user_id)
+        await src.execute(sa.delete(keys).where(keys.c.id.in_(transaction_ids)))
+        await src.execute(sa.delete(transactions).where(transactions.c.user_id == user_id))
+        await src.execute(sa.delete(snapshots).where(snapshots.c.user_id == user_id))
+        await src.execute(sa.delete(users).where(users.c.id == user_id))
+    return True
+
+
+async def _check_transaction_ids(
+        src: AsyncConnection,
+        dst: AsyncConnection,
+        user_id: uuid.UUID,
+        batch_size: int) -> None:
+    """Raise TransactionIdConflictError if dst has a transaction ID of the user, who is not on dst yet."""
+    users, transactions, keys = User.__table__, Transaction.__table__, TransactionKey.__table__
+    if await dst.scalar(sa.select(users.c.id).where(users.c.id == user_id)) is not None:
+        return
+    query = sa.select(transactions.c.id).where(transactions.c.user_id == user_id)
+    result = await src.stream(query.execution_options(yield_per=batch_size))
+    async for transaction_ids in result.scalars().partitions():
+        conflict = await dst.scalar(sa.select(keys.c.id).where(keys.c.id.in_(transaction_ids)).limit(1))
+        if conflict is not None:
+            raise TransactionIdConflictError(
+                f"Transaction ID {conflict} of user {user_id} already exists on the target shard")
+
+
+async def _copy(
+        src: AsyncConnection,
+        dst: AsyncConnection,
+        query: sa.Select,
+        batch_size: int,
+        statements: typing.Callable[[list[typing.Mapping]], list[sa.Executable]]) -> None:
+    result = await src.stream(query.execution_options(yield_per=batch_size))
+    async for rows in result.mappings().partitions():
+        for statement in statements(rows):
+            await dst.execute(statement)
+
+
+async def rebalance(
+        shards: typing.Mapping[str, AsyncEngine],
+        drain: typing.Mapping[str, AsyncEngine] | None = None,
+        batch_size: int = REBALANCE_BATCH_SIZE,
+        dry_run: bool = False) -> Rebalanced:
+    """Move every user not on their shard of the ring of ``shards``."""
+    ring = HashRing(shards)
+    moved: dict[str, int] = {}
+    conflicts: list[uuid.UUID] = []
+    for source_name, source in {**shards, **(drain or {})}.items():
+        page: list[uuid.UUID] = []
+        while True:
+            query = sa.select(User.id).order_by(User.id).limit(batch_size)
+            if page:
+                query = query.where(User.id > page[-1])
+            async with source.connect() as conn:
+                page = list(await conn.scalars(query))
+            if not page:
+                break
+            for user_id in page:
+                target_name = ring.get(user_id)
+                if target_name == source_name:
+                    continue
+                target = shards[target_name]
+                try:
+                    if dry_run:
+                        async with source.connect() as src, target.connect() as dst:
+                            await _check_transaction_ids(src, dst, user_id, batch_size)
+                    elif not await move_user(source, target, user_id, batch_size):
+                        continue
+                except TransactionIdConflictError as e:
+                    logger.warning("Not moving user %s from %s to %s: %s", user_id, source_name, target_name, e)
+                    conflicts.append(user_id)
+                    continue
+                key = f"{source_name} -> {target_name}"
+                moved[key] = moved.get(key, 0) + 1
+    return Rebalanced(moved, conflicts)
+
+
+async def main(args: argparse.Namespace) -> None:
+    settings = get_settings()
+    if not settings.db_shard_dsns:
+        raise SystemExit("DATABASE_SHARD_URLS is not set")
+    shards = {name: create_async_engine(dsn) for name, dsn in settings.db_shard_dsns.items()}
+    drain = {name: create_async_engine(dsn) for name, dsn in parse_shard_dsns(",".join(args.drain)).items()}
+    try:
+        moved, conflicts = await rebalance(shards, drain, batch_size=args.batch_size, dry_run=args.dry_run)
+    finally:
+        for engine in [*shards.values(), *drain.values()]:
+            await engine.dispose()
+    verb = "Would move" if args.dry_run else "Moved"
+    for route, users in sorted(moved.items()):
+        logger.info("%s %s users: %s", verb, users, route)
+    if conflicts:
+        raise SystemExit(f"{len(conflicts)} users not moved, their transaction IDs exist on the target: "
+                         + ", ".join(map(str, conflicts)))
+    if not moved:
+        logger.info("Every user is on their shard")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Move users to their shard after DATABASE_SHARD_URLS changed.")
+    parser.add_argument("command", choices=["rebalance"])
+    parser.add_argument("--drain", action="append", default=[], metavar="NAME=DSN",
+                        help="shard being removed, all its users move")
+    parser.add_argument("--batch-size", type=int, default=REBALANCE_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="only count the users to move")
+    asyncio.run(main(parser.parse_args()))
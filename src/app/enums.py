@@ -5,3 +5,42 @@ class TransactionType(enum.Enum):
     WITHDRAW = 'WITHDRAW'
     DEPOSIT = 'DEPOSIT'
 
+
+class WriteMode(enum.Enum):
+    LOCKING = 'locking'
+    ATOMIC = 'atomic'
+    LEDGER = 'ledger'
+
+
+class SnapshotMode(enum.Enum):
+    EVERY_TRANSACTION = 'every_transaction'
+    EVERY_N = 'every_n'
+    INTERVAL = 'interval'
+
+
+class BalanceCacheBackend(enum.Enum):
+    NONE = 'none'
+    MEMORY = 'memory'
+    REDIS = 'redis'
+
+
+class ExportFormat(enum.Enum):
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+
+
+class OutboxSinkBackend(enum.Enum):
+    NONE = 'none'
+    MEMORY = 'memory'
+    WEBHOOK = 'webhook'
+
+
+class ReadinessState(enum.Enum):
+    STARTING = 'starting'
+    READY = 'ready'
+    DRAINING = 'draining'
+
+
+class MoneyRepresentation(enum.Enum):
+    DECIMAL = 'decimal'
+    MINOR_UNITS = 'minor_units'
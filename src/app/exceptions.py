@@ -1,4 +1,8 @@
-class InsufficientFundsError(Exception):
+class TransactionError(Exception):
+    """Base for errors that reject a single transaction."""
+
+
+class InsufficientFundsError(TransactionError):
     pass
 
 
@@ -6,17 +10,21 @@ class UserExistsError(Exception):
     pass
 
 
-class UserNotExistsError(Exception):
+class UserNotExistsError(TransactionError):
     pass
 
 
-class TransactionAmountZeroError(Exception):
+class TransactionAmountZeroError(TransactionError):
     pass
 
 
-class TransactionAlreadyExistsError(Exception):
+class TransactionAlreadyExistsError(TransactionError):
     pass
 
 
-class UnknownTransactionTypeError(Exception):
+class UnknownTransactionTypeError(TransactionError):
     pass
+
+
+class TransactionIdConflictError(Exception):
+    """The same transaction ID exists for different users on several shards, see app.db.shards."""
@@ -0,0 +1,126 @@
+"""Readiness of a worker, GET /health/ready.
+
+A worker is ready once AppBuilder started it and until it starts shutting
+down, as long as its pool has free connections (saturation below
+HEALTH_POOL_SATURATION_MAX) and a ``SELECT 1`` comes back within
+HEALTH_DB_LATENCY_MAX_MS. The ping is skipped on a saturated pool, it would
+only queue behind the requests. Results are reused for
+HEALTH_CHECK_CACHE_SECONDS, so frequent probes from several load balancers
+cost at most one ping per interval.
+
+The server stops accepting connections as soon as it is told to shut down,
+too late for load balancers to route around it. Run the pre-stop hook first::
+
+    python -m app.health drain
+
+It creates HEALTH_DRAIN_FILE, which turns every worker unready, then waits
+HEALTH_DRAIN_GRACE_SECONDS for the load balancers to notice before the
+shutdown goes on. The server removes a leftover file when it starts.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import pathlib
+import time
+import typing
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.db.pool import InstrumentedAsyncQueuePool
+from app.enums import ReadinessState
+from app.settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class ReadinessProbe:
+    def __init__(
+            self,
+            pool_saturation_max: float,
+            db_latency_max: float,
+            cache_ttl: float,
+            drain_file: str | None = None):
+        self.pool_saturation_max = pool_saturation_max
+        self.db_latency_max = db_latency_max
+        self.cache_ttl = cache_ttl
+        # Created by the pre-stop hook, see drain().
+        self.drain_file = drain_file
+        self.state = ReadinessState.STARTING
+        self.engine: AsyncEngine | None = None
+        self._report: dict[str, typing.Any] | None = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "ReadinessProbe":
+        return cls(
+            pool_saturation_max=settings.health_pool_saturation_max,
+            db_latency_max=settings.health_db_latency_max_ms / 1000,
+            cache_ttl=settings.health_check_cache_seconds,
+            drain_file=settings.health_drain_file,
+        )
+
+    async def check(self) -> dict[str, typing.Any]:
+        if self.state == ReadinessState.READY and self.drain_file and os.path.exists(self.drain_file):
+            self.state = ReadinessState.DRAINING
+        if self.state != ReadinessState.READY or self.engine is None:
+            return {"ready": False, "state": self.state.value, "checks": {}}
+        async with self._lock:
+            if self._report is None or time.monotonic() - self._checked_at >= self.cache_ttl:
+                self._report = await self._check(self.engine)
+                self._checked_at = time.monotonic()
+        # Shutdown may have started while the checks ran.
+        if self.state != ReadinessState.READY:
+            return {**self._report, "ready": False, "state": self.state.value}
+        return self._report
+
+    async def _check(self, engine: AsyncEngine) -> dict[str, typing.Any]:
+        pool = self._check_pool(engine)
+        db = self._skipped() if not pool["ok"] else await self._check_db(engine)
+        return {"ready": pool["ok"] and db["ok"], "state": self.state.value, "checks": {"pool": pool, "db": db}}
+
+    def _check_pool(self, engine: AsyncEngine) -> dict[str, typing.Any]:
+        if not isinstance(engine.pool, InstrumentedAsyncQueuePool):
+            return {"ok": True}
+        stats = engine.pool.stats()
+        return {
+            "ok": stats["saturation"] < self.pool_saturation_max,
+            "saturation": stats["saturation"],
+            "checked_out": stats["checked_out"],
+            "checkout_timeouts": stats["checkout_timeouts"],
+        }
+
+    async def _check_db(self, engine: AsyncEngine) -> dict[str, typing.Any]:
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._ping(engine), self.db_latency_max)
+        except TimeoutError:
+            return {"ok": False, "error": f"no reply within {self.db_latency_max * 1000:g} ms"}
+        except Exception as exc:
+            return {"ok": False, "error": type(exc).__name__}
+        return {"ok": True, "latency_ms": (time.perf_counter() - start) * 1000}
+
+    @staticmethod
+    async def _ping(engine: AsyncEngine) -> None:
+        async with engine.connect() as conn:
+            await conn.exec_driver_sql("SELECT 1")
+
+    @staticmethod
+    def _skipped() -> dict[str, typing.Any]:
+        return {"ok": False, "error": "skipped, pool saturated"}
+
+
+def drain(settings: Settings) -> None:
+    """Pre-stop hook: turn every worker unready, then give load balancers time to notice."""
+    pathlib.Path(settings.health_drain_file).touch()
+    logger.info("Draining, shutting down in %s seconds", settings.health_drain_grace_seconds)
+    time.sleep(settings.health_drain_grace_seconds)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Readiness of the service.")
+    parser.add_argument("command", choices=["drain"], help="pre-stop hook, fail readiness and wait")
+    parser.parse_args()
+    drain(get_settings())
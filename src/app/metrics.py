@@ -0,0 +1,205 @@
+"""Prometheus metrics, METRICS.
+
+Requests are timed by MetricsMiddleware, a plain ASGI middleware labelled
+with the route template. Queries are timed by engine events and added up per
+request through a context variable. The locking SELECTs (``FOR UPDATE``,
+``FOR NO KEY UPDATE``) are timed separately: they return as soon as the row
+lock is granted, so their duration is the lock wait plus one index lookup.
+
+With several workers, each one keeps its own metrics unless
+PROMETHEUS_MULTIPROC_DIR points to an empty directory shared by them, then
+``/metrics`` aggregates counters and histograms of all workers. Pool stats
+are always those of the worker serving the scrape, labelled with its pid.
+"""
+import contextvars
+import itertools
+import os
+import time
+import typing
+
+import sqlalchemy as sa
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.db.pool import CHECKOUT_WAIT_BUCKETS, InstrumentedAsyncQueuePool
+from app.exceptions import (
+    InsufficientFundsError,
+    TransactionAlreadyExistsError,
+    TransactionAmountZeroError,
+    TransactionError,
+    UnknownTransactionTypeError,
+    UserNotExistsError,
+)
+
+LATENCY_BUCKETS: typing.Final = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS: typing.Final = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+# Routes are labelled by their template, everything unrouted shares one label.
+UNMATCHED_ROUTE: typing.Final = "<unmatched>"
+TRANSACTION_OUTCOMES: typing.Final[dict[type[TransactionError], str]] = {
+    UserNotExistsError: "user_not_found",
+    TransactionAmountZeroError: "zero_amount",
+    TransactionAlreadyExistsError: "duplicate",
+    UnknownTransactionTypeError: "unknown_type",
+    InsufficientFundsError: "insufficient_funds",
+}
+# Labels of db_query_duration_seconds, the first keyword of the statement. WITH covers the
+# single-statement writes of the atomic and ledger modes.
+QUERY_OPERATIONS: typing.Final = frozenset({"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"})
+LOCKING_CLAUSES: typing.Final = (("FOR NO KEY UPDATE", "for_no_key_update"), ("FOR UPDATE", "for_update"))
+
+
+class RequestDbTime:
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.seconds = 0.0
+
+
+_request_db_time: contextvars.ContextVar[RequestDbTime | None] = contextvars.ContextVar(
+    "request_db_time", default=None)
+
+
+class PoolCollector:
+    """Reads InstrumentedAsyncQueuePool.stats() at scrape time, nothing is recorded per checkout."""
+
+    def __init__(self) -> None:
+        self.engine: AsyncEngine | None = None
+
+    def collect(self) -> typing.Iterator[typing.Any]:
+        pool = self.engine.pool if self.engine is not None else None
+        if not isinstance(pool, InstrumentedAsyncQueuePool):
+            return
+        stats = pool.stats()
+        labels = ["pid"], [str(os.getpid())]
+        for name, key, documentation in (
+                ("db_pool_size", "size", "Connections kept open by the pool"),
+                ("db_pool_max_overflow", "max_overflow", "Connections the pool may open beyond its size"),
+                ("db_pool_checked_out", "checked_out", "Connections in use"),
+                ("db_pool_overflow", "overflow", "Connections open beyond the pool size"),
+                ("db_pool_saturation", "saturation", "Checked out connections over the pool capacity"),
+        ):
+            gauge = GaugeMetricFamily(name, documentation, labels=labels[0])
+            gauge.add_metric(labels[1], stats[key])
+            yield gauge
+        timeouts = CounterMetricFamily(
+            "db_pool_checkout_timeouts", "Checkouts that gave up waiting for a connection", labels=labels[0])
+        timeouts.add_metric(labels[1], stats["checkout_timeouts"])
+        yield timeouts
+        metrics = pool.metrics
+        wait = HistogramMetricFamily(
+            "db_pool_checkout_wait_seconds", "Time spent waiting for a pool connection", labels=labels[0])
+        wait.add_metric(
+            labels[1],
+            list(zip(
+                [str(bound) for bound in CHECKOUT_WAIT_BUCKETS] + ["+Inf"],
+                itertools.accumulate(metrics.wait_buckets),
+            )),
+            metrics.wait_seconds_sum,
+        )
+        yield wait
+
+
+class Metrics:
+    def __init__(self, registry: CollectorRegistry | None = None):
+        self.registry = registry or CollectorRegistry()
+        self.pool_collector = PoolCollector()
+        self.registry.register(self.pool_collector)
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "HTTP request latency",
+            ["method", "route", "status"], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.request_db_queries = Histogram(
+            "http_request_db_queries", "DB queries sent while serving one request",
+            ["method", "route"], buckets=QUERY_COUNT_BUCKETS, registry=self.registry)
+        self.request_db_duration = Histogram(
+            "http_request_db_duration_seconds", "Time spent in DB queries while serving one request",
+            ["method", "route"], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.query_duration = Histogram(
+            "db_query_duration_seconds", "DB query latency by the statement's first keyword",
+            ["operation"], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.lock_wait = Histogram(
+            "db_row_lock_wait_seconds", "Duration of row locking SELECTs, mostly waiting for the lock",
+            ["lock"], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.transactions = Counter(
+            "transactions", "Transactions submitted, by type and outcome",
+            ["type", "outcome"], registry=self.registry)
+
+    def instrument_engine(self, engine: AsyncEngine, primary: bool = True) -> None:
+        """Measure the queries of engine, and the pool of the primary one."""
+        if primary:
+            self.pool_collector.engine = engine
+        sa.event.listen(engine.sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        sa.event.listen(engine.sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        sa.event.listen(engine.sync_engine, "handle_error", self._handle_error)
+
+    def observe_transaction(self, transaction_type: typing.Any, result: object) -> None:
+        """Count one submitted transaction, result is the created transaction or its error."""
+        outcome = TRANSACTION_OUTCOMES.get(type(result), "error") if isinstance(result, Exception) else "created"
+        self.transactions.labels(getattr(transaction_type, "name", str(transaction_type)), outcome).inc()
+
+    def render(self) -> bytes:
+        if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+            return generate_latest(self.registry)
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(self.pool_collector)
+        return generate_latest(registry)
+
+    @staticmethod
+    def _before_cursor_execute(conn: typing.Any, cursor: typing.Any, statement: str, *args: typing.Any) -> None:
+        conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn: typing.Any, cursor: typing.Any, statement: str, *args: typing.Any) -> None:
+        seconds = time.perf_counter() - conn.info["query_started_at"].pop()
+        operation = (statement.lstrip()[:7].split() or [""])[0].upper()
+        self.query_duration.labels(operation if operation in QUERY_OPERATIONS else "OTHER").observe(seconds)
+        for clause, lock in LOCKING_CLAUSES:
+            if statement.endswith(clause):
+                self.lock_wait.labels(lock).observe(seconds)
+                break
+        request_db_time = _request_db_time.get()
+        if request_db_time is not None:
+            request_db_time.queries += 1
+            request_db_time.seconds += seconds
+
+    @staticmethod
+    def _handle_error(context: typing.Any) -> None:
+        # A failed query gets no after_cursor_execute, drop its start time.
+        started_at = context.connection.info.get("query_started_at") if context.connection is not None else None
+        if started_at:
+            started_at.pop()
+
+
+class MetricsMiddleware:
+    def __init__(self, app: typing.Any, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope: dict[str, typing.Any], receive: typing.Any, send: typing.Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: dict[str, typing.Any]) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        db_time = RequestDbTime()
+        token = _request_db_time.set(db_time)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_db_time.reset(token)
+            route = scope.get("route")
+            route_path = getattr(route, "path", UNMATCHED_ROUTE)
+            method = scope["method"]
+            self.metrics.request_duration.labels(method, route_path, str(status_code)).observe(elapsed)
+            self.metrics.request_db_queries.labels(method, route_path).observe(db_time.queries)
+            self.metrics.request_db_duration.labels(method, route_path).observe(db_time.seconds)
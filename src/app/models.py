@@ -2,13 +2,13 @@ import logging
 import typing
 import uuid
 from datetime import datetime
-from decimal import Decimal
 from sqlalchemy.schema import Index
 import sqlalchemy as sa
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
 
 from app.enums import TransactionType
+from app.money import MONEY_SQL_TYPE, MoneyValue
 
 logger = logging.getLogger(__name__)
 
@@ -25,36 +25,102 @@ class User(Base):
     id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name: Mapped[str] = mapped_column(sa.String(255), nullable=False)
     created_at: Mapped[datetime] = mapped_column(sa.DateTime, default=datetime.utcnow)
-    balance: Mapped[Decimal] = mapped_column(sa.Numeric(precision=12, scale=2), default=0, server_default="0")
+    balance: Mapped[MoneyValue] = mapped_column(MONEY_SQL_TYPE, default=0, server_default="0")
+    # Bookkeeping for the balance snapshot policy, kept on the row that is locked anyway.
+    transactions_since_snapshot: Mapped[int] = mapped_column(sa.Integer, default=0, server_default="0")
+    snapshot_at: Mapped[typing.Optional[datetime]] = mapped_column(sa.DateTime, nullable=True)
+    # created_at of the user's last transaction outside ledger mode, the next one is stamped strictly later.
+    last_transaction_at: Mapped[typing.Optional[datetime]] = mapped_column(sa.DateTime, nullable=True)
+    # Bumped with every balance change, orders the entries of the balance cache.
+    balance_version: Mapped[int] = mapped_column(sa.BigInteger, default=0, server_default="0", nullable=False)
+    # Ledger mode: balance includes every ledger transaction up to this seq, see app.repositories.ledger.
+    ledger_seq: Mapped[int] = mapped_column(sa.BigInteger, default=0, server_default="0", nullable=False)
 
-    transactions = relationship("Transaction", back_populates="user", lazy="selectin")
-    snapshots = relationship("BalancesSnapshots", back_populates="user", lazy="selectin")
+    # History can be huge for long-lived accounts, so it is never loaded implicitly:
+    # use PaymentRepository.get_user_transactions / get_user_snapshots to page through it.
+    transactions = relationship("Transaction", back_populates="user", lazy="raise")
+    snapshots = relationship("BalancesSnapshots", back_populates="user", lazy="raise")
+
+
+# Transactions and snapshots are range partitioned by month of created_at, see app.db.partitions.
+# Partition keys must be part of every unique constraint, hence the (id, created_at) primary keys.
+PARTITION_BY: typing.Final = "RANGE (created_at)"
+
+# Numbers the transactions written in ledger mode, a user's ledger transactions get increasing numbers.
+TRANSACTIONS_SEQ: typing.Final = sa.Sequence("transactions_seq", metadata=METADATA)
+
+
+class TransactionKey(Base):
+    """Global uniqueness of transaction IDs and the created_at locating their partition."""
+    __tablename__ = "transaction_keys"
+
+    id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    created_at: Mapped[datetime] = mapped_column(sa.DateTime, nullable=False)
 
 
 class Transaction(Base):
     __tablename__ = "transactions"
     __table_args__ = (
-        Index('ix_transactions_user_id', 'user_id'),
+        Index('ix_transactions_user_id_created_at', 'user_id', 'created_at'),
+        # Ledger mode only, other modes leave seq NULL and the indexes empty.
+        Index('ix_transactions_user_id_seq', 'user_id', 'seq', postgresql_where=sa.text('seq IS NOT NULL')),
+        Index('ix_transactions_seq', 'seq', postgresql_where=sa.text('seq IS NOT NULL')),
+        {"postgresql_partition_by": PARTITION_BY},
     )
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), sa.ForeignKey("users.id"), nullable=False)
-    amount: Mapped[Decimal] = mapped_column(sa.Numeric(precision=12, scale=2), nullable=False)
+    amount: Mapped[MoneyValue] = mapped_column(MONEY_SQL_TYPE, nullable=False)
     type: Mapped[TransactionType] = mapped_column(sa.Enum(TransactionType), nullable=False)
-    created_at: Mapped[datetime] = mapped_column(sa.DateTime, default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(sa.DateTime, primary_key=True, default=datetime.utcnow)
+    seq: Mapped[typing.Optional[int]] = mapped_column(sa.BigInteger, nullable=True)
 
-    user = relationship("User", back_populates="transactions")
+    user = relationship("User", back_populates="transactions", lazy="raise")
 
 
 class BalancesSnapshots(Base):
     __tablename__ = "balances_snapshots"
     __table_args__ = (
         Index('ix_balances_snapshots_user_id_created_at_desc', 'user_id', sa.desc('created_at')),
+        {"postgresql_partition_by": PARTITION_BY},
     )
 
-    id: Mapped[int] = mapped_column(sa.Integer, primary_key=True)
+    id: Mapped[int] = mapped_column(sa.Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), sa.ForeignKey("users.id"), nullable=False)
-    balance: Mapped[Decimal] = mapped_column(sa.Numeric(precision=12, scale=2), nullable=False)
-    created_at: Mapped[datetime] = mapped_column(sa.DateTime, default=datetime.utcnow, nullable=False)
+    balance: Mapped[MoneyValue] = mapped_column(MONEY_SQL_TYPE, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        sa.DateTime, primary_key=True, default=datetime.utcnow, nullable=False)
+
+    user = relationship("User", back_populates="snapshots", lazy="raise")
+
+
+class LedgerCheckpoint(Base):
+    """Single row: ledger transactions up to folded_seq are folded into users.balance, see app.repositories.ledger."""
+    __tablename__ = "ledger_checkpoints"
+
+    id: Mapped[int] = mapped_column(sa.SmallInteger, primary_key=True)
+    folded_seq: Mapped[int] = mapped_column(sa.BigInteger, nullable=False, default=0, server_default="0")
+    checkpointed_at: Mapped[datetime] = mapped_column(sa.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class OutboxEvent(Base):
+    """Event written in the DB transaction that caused it, published by app.outbox.dispatcher."""
+    __tablename__ = "outbox_events"
+    __table_args__ = (
+        Index('ix_outbox_events_available_at', 'available_at'),
+    )
+
+    id: Mapped[int] = mapped_column(sa.BigInteger, primary_key=True, autoincrement=True)
+    event_type: Mapped[str] = mapped_column(sa.String(64), nullable=False)
+    payload: Mapped[dict[str, typing.Any]] = mapped_column(JSONB, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(sa.DateTime, nullable=False, default=datetime.utcnow)
+    # Failed events are retried with a backoff, they are not picked up before available_at.
+    available_at: Mapped[datetime] = mapped_column(sa.DateTime, nullable=False, default=datetime.utcnow)
+    attempts: Mapped[int] = mapped_column(sa.Integer, nullable=False, default=0, server_default="0")
+    last_error: Mapped[typing.Optional[str]] = mapped_column(sa.Text, nullable=True)
+
 
-    user = relationship("User", back_populates="snapshots")
+# Tables created through metadata.create_all() (tests, local runs) get a catch-all partition,
+# migrated databases get monthly ones from the migrations and `python -m app.db.partitions`.
+for _table in (Transaction.__table__, BalancesSnapshots.__table__):
+    sa.event.listen(_table, "after_create", sa.DDL("CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT"))
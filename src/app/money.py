@@ -0,0 +1,83 @@
+"""Money amounts, MONEY_REPRESENTATION.
+
+``decimal`` stores amounts as NUMERIC(12, 2) and handles them as Decimal.
+``minor_units`` stores them as BIGINT cents and handles them as int, so the
+hot path skips Decimal parsing, Decimal arithmetic and the NUMERIC codec of
+asyncpg. The API is the same in both modes: amounts are accepted as JSON
+numbers or strings and returned as strings with two decimals. In minor units
+mode the conversion is exact; amounts with more than two decimals are rejected.
+
+Models and schemas pick their types here at import time. Switching an
+existing database from one representation to the other is done by
+``python -m app.db.money``.
+"""
+import re
+import typing
+from decimal import Decimal
+
+import pydantic
+import sqlalchemy as sa
+
+from app.enums import MoneyRepresentation
+from app.settings import Settings
+
+SCALE: typing.Final = 2
+MINOR_UNITS_PER_UNIT: typing.Final = 10 ** SCALE
+
+_AMOUNT: typing.Final = re.compile(rf"([+-]?)(\d+)(?:\.(\d{{0,{SCALE}}})0*)?")
+
+
+def to_minor_units(value: typing.Any) -> int:
+    """Exact number of minor units of an amount given in units, like 10, 10.05, "10.05" or Decimal("10.05")."""
+    if isinstance(value, bool):
+        raise ValueError("Not an amount")
+    if isinstance(value, int):
+        return value * MINOR_UNITS_PER_UNIT
+    if isinstance(value, float):
+        # The shortest repr that parses back to the same float, i.e. the JSON literal.
+        value = repr(value)
+    elif isinstance(value, Decimal):
+        value = format(value, "f")
+    if not isinstance(value, str):
+        raise ValueError("Not an amount")
+    match = _AMOUNT.fullmatch(value.strip())
+    if match is None:
+        raise ValueError(f"Not an amount with at most {SCALE} decimals")
+    sign, units, fraction = match.groups()
+    minor_units = int(units) * MINOR_UNITS_PER_UNIT + int((fraction or "").ljust(SCALE, "0"))
+    return -minor_units if sign == "-" else minor_units
+
+
+def format_minor_units(value: int) -> str:
+    units, minor_units = divmod(abs(value), MINOR_UNITS_PER_UNIT)
+    return f"{'-' if value < 0 else ''}{units}.{minor_units:0{SCALE}d}"
+
+
+# Amounts sent by clients, in units.
+MinorUnitsInput = typing.Annotated[
+    int,
+    pydantic.PlainValidator(to_minor_units),
+    pydantic.WithJsonSchema({"anyOf": [{"type": "number"}, {"type": "string"}]}),
+]
+# Amounts read from the DB, already in minor units, rendered in units.
+MinorUnits = typing.Annotated[
+    int,
+    pydantic.PlainSerializer(format_minor_units, return_type=str, when_used="json"),
+    pydantic.WithJsonSchema({"type": "string"}),
+]
+
+MoneyValue: type
+MoneyInput: typing.Any
+Money: typing.Any
+if Settings.money_representation == MoneyRepresentation.MINOR_UNITS:
+    # Python type of amounts, also parses their str().
+    MoneyValue = int
+    MoneyInput = MinorUnitsInput
+    Money = MinorUnits
+    MONEY_SQL_TYPE: typing.Final[sa.types.TypeEngine[typing.Any]] = sa.BigInteger()
+else:
+    MoneyValue = Decimal
+    MoneyInput = Money = Decimal
+    MONEY_SQL_TYPE = sa.Numeric(precision=12, scale=SCALE)
+
+ZERO: typing.Final = MoneyValue(0)
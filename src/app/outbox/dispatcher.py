@@ -0,0 +1,132 @@
+"""Transactional outbox, OUTBOX_SINK.
+
+Every write path inserts an outbox_events row in the DB transaction that
+creates the transaction, so an event exists exactly when its transaction
+committed. In the atomic and ledger write modes it is one more CTE of the
+statement that is sent anyway, the request pays no extra round trip.
+
+OutboxDispatcher drains the table in the background: it claims a batch of due
+events FOR UPDATE SKIP LOCKED, publishes it to a sink and deletes it in the
+same DB transaction. Dispatchers of several workers claim disjoint batches
+and never wait for each other. A failed batch stays in the table and is
+retried with an exponential backoff. Delivery is at least once and only
+ordered within a batch, consumers deduplicate by event ID.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.models import OutboxEvent
+from app.outbox.sinks import OutboxSink
+
+logger = logging.getLogger(__name__)
+
+LAST_ERROR_MAX_LENGTH = 1000
+
+
+class OutboxStats:
+    def __init__(self) -> None:
+        self.started_at = time.monotonic()
+        self.batches = 0
+        self.published = 0
+        self.failed_batches = 0
+        self.failed_events = 0
+        self.publish_seconds_sum = 0.0
+        # Time from writing an event to publishing it.
+        self.lag_seconds_sum = 0.0
+        self.lag_seconds_max = 0.0
+
+    def observe_published(self, events: list[OutboxEvent], seconds: float, now: datetime) -> None:
+        self.batches += 1
+        self.published += len(events)
+        self.publish_seconds_sum += seconds
+        for event in events:
+            lag = max((now - event.created_at).total_seconds(), 0.0)
+            self.lag_seconds_sum += lag
+            self.lag_seconds_max = max(self.lag_seconds_max, lag)
+
+    def as_dict(self) -> dict[str, int | float]:
+        uptime = time.monotonic() - self.started_at
+        return {
+            "batches": self.batches,
+            "published": self.published,
+            "published_per_second": self.published / uptime if uptime else 0.0,
+            "failed_batches": self.failed_batches,
+            "failed_events": self.failed_events,
+            "publish_seconds_sum": self.publish_seconds_sum,
+            "lag_seconds_avg": self.lag_seconds_sum / self.published if self.published else 0.0,
+            "lag_seconds_max": self.lag_seconds_max,
+        }
+
+
+class OutboxDispatcher:
+    def __init__(
+            self,
+            db_session_maker: async_sessionmaker[AsyncSession],
+            sink: OutboxSink,
+            batch_size: int,
+            poll_interval: float,
+            retry_backoff: float,
+            retry_backoff_max: float):
+        self.db_session_maker = db_session_maker
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.stats = OutboxStats()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                claimed = await self.dispatch()
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+                claimed = 0
+            # A full batch means more may be waiting, drain it without sleeping.
+            if claimed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def dispatch(self) -> int:
+        """Publish one batch of due events, return the number of events claimed."""
+        async with self.db_session_maker() as session:
+            async with session.begin():
+                now = datetime.utcnow()
+                events = list(await session.scalars(
+                    sa.select(OutboxEvent)
+                    .where(OutboxEvent.available_at <= now)
+                    .order_by(OutboxEvent.id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                ))
+                if not events:
+                    return 0
+
+                started = time.perf_counter()
+                try:
+                    await self.sink.publish(events)
+                except Exception as e:
+                    logger.warning("Publishing %s outbox events failed: %r", len(events), e)
+                    self.stats.failed_batches += 1
+                    self.stats.failed_events += len(events)
+                    for event in events:
+                        event.attempts += 1
+                        event.available_at = now + self._backoff(event.attempts)
+                        event.last_error = repr(e)[:LAST_ERROR_MAX_LENGTH]
+                    return len(events)
+
+                self.stats.observe_published(events, time.perf_counter() - started, datetime.utcnow())
+                await session.execute(
+                    sa.delete(OutboxEvent)
+                    .where(OutboxEvent.id.in_([event.id for event in events]))
+                    .execution_options(synchronize_session=False)
+                )
+        return len(events)
+
+    def _backoff(self, attempts: int) -> timedelta:
+        # The exponent is capped as well, the event may have failed for days.
+        return timedelta(seconds=min(self.retry_backoff * 2 ** min(attempts - 1, 32), self.retry_backoff_max))
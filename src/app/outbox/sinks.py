@@ -0,0 +1,70 @@
+import abc
+import collections
+import logging
+import typing
+
+from app.enums import OutboxSinkBackend
+from app.models import OutboxEvent
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+def event_message(event: OutboxEvent) -> dict[str, typing.Any]:
+    """What consumers receive for an event. Delivery is at least once, ``id`` lets them deduplicate."""
+    return {
+        "id": event.id,
+        "type": event.event_type,
+        "created_at": event.created_at.isoformat(),
+        "payload": event.payload,
+    }
+
+
+class OutboxSink(abc.ABC):
+    """Where OutboxDispatcher publishes events: a webhook, a broker producer, a test stub."""
+
+    @abc.abstractmethod
+    async def publish(self, events: typing.Sequence[OutboxEvent]) -> None:
+        """Publish a batch in order. Raising marks the whole batch failed, it is retried later."""
+
+    async def close(self) -> None:
+        """Release the sink's resources."""
+
+
+class MemorySink(OutboxSink):
+    """Keeps the last ``max_size`` messages in the worker, for local runs and tests."""
+
+    def __init__(self, max_size: int = 10_000):
+        self.messages: collections.deque[dict[str, typing.Any]] = collections.deque(maxlen=max_size)
+
+    async def publish(self, events: typing.Sequence[OutboxEvent]) -> None:
+        self.messages.extend(event_message(event) for event in events)
+
+
+class WebhookSink(OutboxSink):
+    """POSTs each batch as one JSON array, any non-2xx answer fails the batch."""
+
+    def __init__(self, client: typing.Any, url: str):
+        self.client = client
+        self.url = url
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float) -> "WebhookSink":
+        import httpx  # optional dependency, only needed for this sink
+
+        return cls(httpx.AsyncClient(timeout=timeout), url)
+
+    async def publish(self, events: typing.Sequence[OutboxEvent]) -> None:
+        response = await self.client.post(self.url, json=[event_message(event) for event in events])
+        response.raise_for_status()
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def create_outbox_sink(settings: Settings) -> OutboxSink | None:
+    if settings.outbox_sink == OutboxSinkBackend.MEMORY:
+        return MemorySink()
+    if settings.outbox_sink == OutboxSinkBackend.WEBHOOK:
+        return WebhookSink.from_url(settings.outbox_webhook_url, settings.outbox_webhook_timeout_seconds)
+    return None
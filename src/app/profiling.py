@@ -0,0 +1,221 @@
+"""Opt-in request profiling, PROFILING_SAMPLE_RATE and PROFILING_TOKEN.
+
+A request is profiled when it is sampled, or when it carries
+``X-Profile: <PROFILING_TOKEN>``. Its CPU profile (cProfile) and SQL
+statements with their durations are written to PROFILING_DIR as
+``<id>.prof``, loadable by pstats or snakeviz, and ``<id>.json``; the
+response carries ``X-Profile-Id``. With ``X-Profile-Output: inline`` as well,
+the JSON report replaces the response body.
+
+cProfile sees the whole thread, so functions of requests served concurrently
+show up too; one request is profiled at a time. Event streams and exports may
+last for hours: their profile ends when the response starts, and their body
+is never replaced by the report. PROFILING_MAX_FILES keeps the newest profiles
+only. AppBuilder only installs the middleware when profiling is configured, it
+costs nothing otherwise.
+"""
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import secrets
+import time
+import typing
+import uuid
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER: typing.Final = b"x-profile"
+PROFILE_OUTPUT_HEADER: typing.Final = b"x-profile-output"
+PROFILE_ID_HEADER: typing.Final = b"x-profile-id"
+TOP_FUNCTIONS: typing.Final = 30
+# Responses whose body is streamed for as long as the client reads, profiled up to their start only.
+STREAMING_CONTENT_TYPES: typing.Final = frozenset({b"text/event-stream", b"application/x-ndjson", b"text/csv"})
+
+
+class RequestProfile:
+    def __init__(self) -> None:
+        self.id = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+        self.profiler = cProfile.Profile()
+        self.statements: list[dict[str, typing.Any]] = []
+        self.finished = False
+
+    def report(self, scope: dict[str, typing.Any], status_code: int, seconds: float) -> dict[str, typing.Any]:
+        stats = io.StringIO()
+        pstats.Stats(self.profiler, stream=stats).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+        return {
+            "id": self.id,
+            "method": scope["method"],
+            "path": scope["path"],
+            "status": status_code,
+            "duration_ms": seconds * 1000,
+            "db_queries": len(self.statements),
+            "db_ms": sum(statement["duration_ms"] for statement in self.statements),
+            "statements": self.statements,
+            "top_functions": stats.getvalue(),
+        }
+
+
+_profile: contextvars.ContextVar[RequestProfile | None] = contextvars.ContextVar("profile", default=None)
+
+
+class Profiler:
+    def __init__(self, sample_rate: float, token: str, directory: str, max_files: int = 1000):
+        self.sample_rate = sample_rate
+        self.token = token.encode()
+        self.directory = directory
+        # Profiles kept in directory, each one is a .prof and a .json file.
+        self.max_files = max_files
+        self.active = False
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "Profiler | None":
+        if settings.profiling_sample_rate <= 0 and not settings.profiling_token:
+            return None
+        return cls(settings.profiling_sample_rate, settings.profiling_token, settings.profiling_dir,
+                   settings.profiling_max_files)
+
+    def instrument_engine(self, engine: AsyncEngine) -> None:
+        sa.event.listen(engine.sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        sa.event.listen(engine.sync_engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def requested(self, headers: dict[bytes, bytes]) -> bool:
+        token = headers.get(PROFILE_HEADER)
+        return bool(self.token) and token is not None and secrets.compare_digest(token, self.token)
+
+    def sampled(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def save(self, profile: RequestProfile, report: dict[str, typing.Any]) -> None:
+        def write() -> None:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.profiler.dump_stats(os.path.join(self.directory, f"{profile.id}.prof"))
+            with open(os.path.join(self.directory, f"{profile.id}.json"), "w") as f:
+                json.dump(report, f, indent=2)
+            self._remove_oldest()
+
+        await asyncio.to_thread(write)
+
+    def _remove_oldest(self) -> None:
+        # IDs start with their timestamp, so they sort oldest first.
+        ids = sorted({
+            name.rpartition(".")[0] for name in os.listdir(self.directory) if name.endswith((".prof", ".json"))})
+        for profile_id in ids[:max(len(ids) - self.max_files, 0)]:
+            for extension in (".prof", ".json"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, profile_id + extension))
+
+    @staticmethod
+    def _before_cursor_execute(conn: typing.Any, cursor: typing.Any, statement: str, parameters: typing.Any,
+                               context: typing.Any, executemany: bool) -> None:
+        if _profile.get() is not None:
+            context.profile_started_at = time.perf_counter()
+
+    @staticmethod
+    def _after_cursor_execute(conn: typing.Any, cursor: typing.Any, statement: str, parameters: typing.Any,
+                              context: typing.Any, executemany: bool) -> None:
+        profile = _profile.get()
+        started_at = getattr(context, "profile_started_at", None)
+        if profile is not None and not profile.finished and started_at is not None:
+            # Statements only, parameters carry account data.
+            profile.statements.append({
+                "sql": statement,
+                "executemany": executemany,
+                "duration_ms": (time.perf_counter() - started_at) * 1000,
+            })
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: typing.Any, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope: dict[str, typing.Any], receive: typing.Any, send: typing.Any) -> None:
+        if scope["type"] != "http" or self.profiler.active:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        requested = self.profiler.requested(headers)
+        if not requested and not self.profiler.sampled():
+            await self.app(scope, receive, send)
+            return
+
+        inline = requested and headers.get(PROFILE_OUTPUT_HEADER) == b"inline"
+        profile = RequestProfile()
+        status_code = 500
+        start = time.perf_counter()
+        elapsed = 0.0
+
+        def stop() -> None:
+            nonlocal elapsed
+            profile.profiler.disable()
+            profile.finished = True
+            elapsed = time.perf_counter() - start
+            self.profiler.active = False
+
+        async def save() -> dict[str, typing.Any]:
+            report = profile.report(scope, status_code, elapsed)
+            try:
+                await self.profiler.save(profile, report)
+            except OSError:
+                logger.exception("Saving profile %s failed", profile.id)
+            return report
+
+        async def send_profiled(message: dict[str, typing.Any]) -> None:
+            nonlocal status_code, inline
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                content_type = dict(message.get("headers", [])).get(b"content-type", b"")
+                if content_type.partition(b";")[0].strip() in STREAMING_CONTENT_TYPES:
+                    # Sent as is, the stream may outlive any profile worth reading.
+                    inline = False
+                    stop()
+                    await save()
+                if inline:
+                    return
+                message = {
+                    **message,
+                    "headers": [*message.get("headers", []), (PROFILE_ID_HEADER, profile.id.encode())],
+                }
+            elif inline:
+                return
+            await send(message)
+
+        self.profiler.active = True
+        token = _profile.set(profile)
+        profile.profiler.enable()
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            _profile.reset(token)
+            streamed = profile.finished
+            if not streamed:
+                stop()
+        if streamed:
+            return
+
+        report = await save()
+        if inline:
+            body = json.dumps(report).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (PROFILE_ID_HEADER, profile.id.encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+import typing
+import uuid
+
+from app.exceptions import TransactionError
+from app.models import Transaction
+from app.schemas import TransactionCreate
+
+ApplyBatch = typing.Callable[[list[TransactionCreate]], typing.Awaitable[list[Transaction | TransactionError]]]
+
+
+class _PendingWrites:
+    def __init__(self) -> None:
+        self.items: list[tuple[TransactionCreate, asyncio.Future[Transaction]]] = []
+        self.full = asyncio.Event()
+
+
+class WriteCoalescer:
+    """Merges concurrent transactions of the same user into one DB transaction.
+
+    The first write for a user waits up to ``max_wait`` seconds for company, then
+    up to ``max_batch_size`` queued writes are applied together in arrival order.
+    Writes arriving while a batch is in flight form the next batch, so a hot
+    account takes its row lock once per batch instead of once per request.
+    """
+
+    def __init__(self, apply_batch: ApplyBatch, max_batch_size: int, max_wait: float):
+        self.apply_batch = apply_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending: dict[uuid.UUID, _PendingWrites] = {}
+        self._workers: set[asyncio.Task[None]] = set()
+
+    async def submit(self, data: TransactionCreate) -> Transaction:
+        pending = self._pending.get(data.user_id)
+        if pending is None:
+            pending = self._pending[data.user_id] = _PendingWrites()
+            worker = asyncio.create_task(self._drain(data.user_id, pending))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+        future: asyncio.Future[Transaction] = asyncio.get_running_loop().create_future()
+        pending.items.append((data, future))
+        if len(pending.items) >= self.max_batch_size:
+            pending.full.set()
+
+        # Shielded: once queued the write is applied anyway, a cancelled caller only stops waiting.
+        return await asyncio.shield(future)
+
+    async def close(self) -> None:
+        """Wait for every queued write to be applied."""
+        while self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def _drain(self, user_id: uuid.UUID, pending: _PendingWrites) -> None:
+        with contextlib.suppress(TimeoutError):
+            await asyncio.wait_for(pending.full.wait(), self.max_wait)
+
+        while pending.items:
+            batch = pending.items[:self.max_batch_size]
+            del pending.items[:self.max_batch_size]
+            if len(pending.items) < self.max_batch_size:
+                pending.full.clear()
+
+            try:
+                results = await self.apply_batch([data for data, _ in batch])
+            except Exception as e:  # noqa: BLE001
+                results = [e] * len(batch)
+
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+        del self._pending[user_id]
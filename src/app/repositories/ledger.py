@@ -0,0 +1,187 @@
+"""Append-only ledger storage, WriteMode.LEDGER.
+
+Transactions written in ledger mode take a ``seq`` from the global
+transactions_seq sequence, so the ledger transactions of a user carry
+increasing numbers. users.balance becomes a checkpoint: it includes every
+ledger transaction up to users.ledger_seq, and the current balance adds the
+tail of transactions after it.
+
+Deposits only append a row, they never lock the user row. Withdrawals lock it
+FOR NO KEY UPDATE, which the foreign key checks of concurrent deposits do not
+wait for, and check the overdraft against the derived balance. Concurrent
+deposits can only raise it.
+
+LedgerCheckpointer folds tails into users.balance periodically, so tails stay
+short. Every worker runs one, they take turns under an advisory lock and
+resume from the position stored in ledger_checkpoints. Switching from ledger mode to another mode requires a last checkpoint
+once ledger writes stopped, because the other modes read users.balance alone::
+
+    python -m app.repositories.ledger checkpoint
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import time
+import typing
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app.models import LedgerCheckpoint
+from app.money import MONEY_SQL_TYPE
+from app.settings import get_settings
+from app.streams.balances import BALANCE_CHANGES_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# Appends one ledger transaction. :available is the derived balance of a locked user
+# for withdrawals, NULL for deposits which need no overdraft check. A NULL :event
+# writes no outbox event, see app.outbox.dispatcher, a NULL :notification no
+# balance change notification, see app.streams.balances.
+_MONEY: typing.Final = MONEY_SQL_TYPE.compile(dialect=postgresql.dialect())
+LEDGER_APPEND_SQL: typing.Final = sa.text(f"""
+    WITH inserted AS (
+        INSERT INTO transaction_keys (id, created_at)
+        SELECT :id, CAST(:created_at AS timestamp)
+        WHERE EXISTS (SELECT 1 FROM users WHERE id = :user_id)
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+    ), transaction AS (
+        INSERT INTO transactions (id, user_id, amount, type, created_at, seq)
+        SELECT :id, :user_id, :amount, CAST(:type AS transactiontype), CAST(:created_at AS timestamp),
+            nextval('transactions_seq')
+        FROM inserted
+        WHERE CAST(:available AS {_MONEY}) IS NULL OR CAST(:available AS {_MONEY}) >= :amount
+        RETURNING seq
+    ), event AS (
+        INSERT INTO outbox_events (event_type, payload, created_at, available_at)
+        SELECT :event_type, CAST(:event AS jsonb), CAST(:created_at AS timestamp), CAST(:created_at AS timestamp)
+        FROM transaction
+        WHERE CAST(:event AS jsonb) IS NOT NULL
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM users WHERE id = :user_id) AS user_exists,
+        EXISTS (SELECT 1 FROM inserted) AS inserted,
+        (SELECT seq FROM transaction) AS seq,
+        (
+            SELECT pg_notify('{BALANCE_CHANGES_CHANNEL}', CAST(:notification AS text))
+            FROM transaction
+            WHERE CAST(:notification AS text) IS NOT NULL
+        ) AS notified
+""")
+
+# Highest seq handed out so far, 0 before the first one.
+LEDGER_SEQ_SAMPLE_SQL: typing.Final = sa.text(
+    "SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM transactions_seq"
+)
+
+# Key of the advisory lock held by the worker folding, any bigint unused by other advisory locks.
+LEDGER_CHECKPOINT_LOCK_ID: typing.Final = 0x6C6564676572  # "ledger"
+LEDGER_CHECKPOINT_ROW_ID: typing.Final = 1
+
+ApplyCheckpoint = typing.Callable[[int, int, datetime], typing.Awaitable[int]]
+
+
+class LedgerCheckpointer:
+    """Periodically folds the settled part of ledger tails into users.balance.
+
+    A ledger transaction takes its seq after its created_at and commits within
+    ``horizon`` of it, so every seq handed out more than ``horizon`` ago is
+    settled: its transaction committed or rolled back. Each run samples the
+    sequence and folds up to the newest sample older than the horizon, then
+    snapshots the balances of the folded users as of ``horizon`` ago.
+
+    The fold starts from ledger_checkpoints.folded_seq and stores the new
+    position. It runs under a transaction level advisory lock, a run finding
+    it taken by another worker skips the fold.
+    """
+
+    def __init__(
+            self,
+            db_session_maker: async_sessionmaker[AsyncSession],
+            apply_checkpoint: ApplyCheckpoint,
+            interval: float,
+            horizon: timedelta):
+        self.db_session_maker = db_session_maker
+        self.apply_checkpoint = apply_checkpoint
+        self.interval = interval
+        self.horizon = horizon
+        self._samples: collections.deque[tuple[float, int]] = collections.deque()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.checkpoint()
+            except Exception:
+                logger.exception("Ledger checkpoint failed")
+            await asyncio.sleep(self.interval)
+
+    async def checkpoint(self) -> int:
+        """Sample the sequence and fold what has settled, return the number of users checkpointed."""
+        async with self.db_session_maker() as session:
+            self._samples.append((time.monotonic(), await session.scalar(LEDGER_SEQ_SAMPLE_SQL)))
+
+        settled_seq = self._settled_seq()
+        if settled_seq == 0:
+            return 0
+        async with self.db_session_maker() as session:
+            async with session.begin():
+                # Released when this transaction ends, after the new position is stored.
+                locked = await session.scalar(sa.select(sa.func.pg_try_advisory_xact_lock(LEDGER_CHECKPOINT_LOCK_ID)))
+                if not locked:
+                    return 0
+                folded_seq = await session.scalar(
+                    sa.select(LedgerCheckpoint.folded_seq).where(LedgerCheckpoint.id == LEDGER_CHECKPOINT_ROW_ID))
+                if settled_seq <= (folded_seq or 0):
+                    return 0
+                checkpointed = await self.apply_checkpoint(
+                    folded_seq or 0, settled_seq, datetime.utcnow() - self.horizon)
+                position = {"folded_seq": settled_seq, "checkpointed_at": datetime.utcnow()}
+                await session.execute(
+                    postgresql.insert(LedgerCheckpoint)
+                    .values(id=LEDGER_CHECKPOINT_ROW_ID, **position)
+                    .on_conflict_do_update(index_elements=[LedgerCheckpoint.id], set_=position)
+                )
+        return checkpointed
+
+    def _settled_seq(self) -> int:
+        settled_before = time.monotonic() - self.horizon.total_seconds()
+        while len(self._samples) > 1 and self._samples[1][0] <= settled_before:
+            self._samples.popleft()
+        sampled_at, seq = self._samples[0]
+        return seq if sampled_at <= settled_before else 0
+
+
+async def main() -> None:
+    from app.enums import WriteMode
+    from app.repositories.payments import PaymentRepository
+
+    settings = get_settings()
+    horizon = settings.commit_horizon()
+    engine = create_async_engine(settings.db_dsn)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    checkpointer = LedgerCheckpointer(
+        session_maker,
+        PaymentRepository(session_maker, write_mode=WriteMode.LEDGER).checkpoint_ledger,
+        interval=0,
+        horizon=horizon,
+    )
+    try:
+        await checkpointer.checkpoint()
+        logger.info("Waiting %s for in-flight ledger transactions to settle", horizon)
+        await asyncio.sleep(horizon.total_seconds())
+        logger.info("checkpoint: %s users", await checkpointer.checkpoint())
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain ledger checkpoints.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("checkpoint", help="fold every settled ledger transaction into users.balance")
+    parser.parse_args()
+    asyncio.run(main())
@@ -1,25 +1,167 @@
+import contextlib
+import functools
 import uuid
-from datetime import datetime
-from decimal import Decimal
-from typing import Optional, Type
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Final, Iterable, Optional, Sequence, Type
 
 import sqlalchemy as sa
 from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import aliased
 from sqlalchemy.ext.asyncio import (
     async_sessionmaker,
     AsyncSession as AsyncSessionType, AsyncSession,
 )
 
-from app.enums import TransactionType
+from app.cache.balances import BalanceCache
+from app.cache.results import MISSING, ResultCache
+from app.enums import TransactionType, WriteMode
 from app.exceptions import UserExistsError, InsufficientFundsError, UserNotExistsError, TransactionAmountZeroError, \
-    TransactionAlreadyExistsError, UnknownTransactionTypeError
-from app.models import User, Transaction, BalancesSnapshots
+    TransactionAlreadyExistsError, UnknownTransactionTypeError, TransactionError
+from app import schemas
+from app.money import ZERO, MoneyValue
+from app.models import User, Transaction, BalancesSnapshots, TransactionKey, OutboxEvent, TRANSACTIONS_SEQ
+from app.repositories.coalescing import WriteCoalescer
+from app.repositories.ledger import LEDGER_APPEND_SQL
+from app.repositories.snapshots import SNAPSHOT_DUE_SQL, SnapshotPolicy
 from app.schemas import UserCreate, TransactionCreate
+from app.streams.balances import BALANCE_CHANGES_CHANNEL, balance_change_payload
+
+HISTORY_PAGE_SIZE: Final = 100
+HISTORY_PAGE_SIZE_MAX: Final = 1000
+EXPORT_FETCH_SIZE: Final = 1000
+LEDGER_CHECKPOINT_BATCH_SIZE: Final = 1000
+TRANSACTION_CREATED_EVENT: Final = "transaction.created"
+# Balances as of a moment older than the commit horizon are final: every transaction stamped
+# before it has committed. It must exceed the longest time between stamping a transaction and
+# its commit, which is bounded by the statement timeout, see Settings.commit_horizon().
+# This is its value for the default settings.
+COMMIT_HORIZON: Final = timedelta(seconds=60)
+
+SIGNED_AMOUNT: Final = sa.case(
+    (Transaction.type == TransactionType.WITHDRAW, -Transaction.amount),
+    else_=Transaction.amount,
+)
+
+# Overdraft check, balance change, idempotency check and both inserts in one round trip.
+# The users row stays locked only from the stamp until the COMMIT right after the statement.
+ATOMIC_CREATE_TRANSACTION_SQL: Final = sa.text(f"""
+    WITH duplicate AS (
+        SELECT 1 FROM transaction_keys WHERE id = :id
+    ), stamped AS (
+        -- Stamped once the row lock is held, so a user's transactions commit in timestamp order.
+        SELECT id, GREATEST(
+            clock_timestamp() AT TIME ZONE 'utc', last_transaction_at + interval '1 microsecond'
+        ) AS stamp
+        FROM users
+        WHERE id = :user_id
+        FOR NO KEY UPDATE
+    ), updated AS (
+        UPDATE users SET
+            balance = balance + :delta,
+            balance_version = balance_version + 1,
+            last_transaction_at = stamp,
+            transactions_since_snapshot = CASE WHEN {SNAPSHOT_DUE_SQL} THEN 0
+                ELSE transactions_since_snapshot + 1 END,
+            snapshot_at = CASE WHEN {SNAPSHOT_DUE_SQL} THEN stamp
+                ELSE snapshot_at END
+        FROM stamped
+        WHERE users.id = stamped.id AND balance + :delta >= 0 AND NOT EXISTS (SELECT 1 FROM duplicate)
+        RETURNING users.id, balance, balance_version, transactions_since_snapshot = 0 AS snapshot_due,
+            last_transaction_at AS created_at
+    ), inserted AS (
+        INSERT INTO transaction_keys (id, created_at)
+        SELECT :id, updated.created_at FROM updated
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+    ), transaction AS (
+        INSERT INTO transactions (id, user_id, amount, type, created_at)
+        SELECT :id, updated.id, :amount, CAST(:type AS transactiontype), updated.created_at
+        FROM updated JOIN inserted ON true
+    ), event AS (
+        INSERT INTO outbox_events (event_type, payload, created_at, available_at)
+        -- created_at formatted like datetime.isoformat(), as in the payloads of the other write paths.
+        SELECT :event_type, jsonb_set(CAST(:event AS jsonb), '{{created_at}}', to_jsonb(
+            to_char(updated.created_at, 'YYYY-MM-DD"T"HH24:MI:SS') || CASE
+                WHEN date_trunc('second', updated.created_at) = updated.created_at THEN ''
+                ELSE to_char(updated.created_at, '.US') END
+        )), updated.created_at, updated.created_at
+        FROM updated JOIN inserted ON true
+        WHERE CAST(:event AS jsonb) IS NOT NULL
+    ), snapshot AS (
+        INSERT INTO balances_snapshots (user_id, balance, created_at)
+        SELECT updated.id, updated.balance, updated.created_at
+        FROM updated JOIN inserted ON true
+        WHERE updated.snapshot_due
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM stamped) AS user_exists,
+        EXISTS (SELECT 1 FROM duplicate) AS duplicate,
+        EXISTS (SELECT 1 FROM updated) AS updated,
+        EXISTS (SELECT 1 FROM inserted) AS inserted,
+        (SELECT balance FROM updated) AS balance,
+        (SELECT balance_version FROM updated) AS balance_version,
+        (SELECT created_at FROM updated) AS created_at,
+        (
+            SELECT pg_notify('{BALANCE_CHANGES_CHANNEL}',
+                json_build_object('user_id', updated.id, 'balance', updated.balance::text)::text)
+            FROM updated JOIN inserted ON true
+            WHERE CAST(:notify AS boolean)
+        ) AS notified
+""")
+
+
+NOTIFY_BALANCE_CHANGES_SQL: Final = sa.text(
+    f"SELECT pg_notify('{BALANCE_CHANGES_CHANNEL}', payload) FROM unnest(CAST(:payloads AS text[])) AS payload"
+)
 
 
 class PaymentRepository:
-    def __init__(self, db_session_maker: async_sessionmaker[AsyncSessionType]):
+    def __init__(
+            self,
+            db_session_maker: async_sessionmaker[AsyncSessionType],
+            write_mode: WriteMode = WriteMode.LOCKING,
+            write_coalescer: Optional[WriteCoalescer] = None,
+            snapshot_policy: Optional[SnapshotPolicy] = None,
+            balance_cache: Optional[BalanceCache] = None,
+            result_cache: Optional[ResultCache] = None,
+            outbox: bool = False,
+            notify_balance_changes: bool = False,
+            route_reads: Optional[Callable[[], async_sessionmaker[AsyncSessionType]]] = None,
+            commit_horizon: timedelta = COMMIT_HORIZON):
         self.db_session_maker = db_session_maker
+        # Picks the session maker of reads that tolerate replication lag, see app.db.replicas.
+        self.route_reads = route_reads
+        self.write_mode = write_mode
+        self.write_coalescer = write_coalescer
+        self.snapshot_policy = snapshot_policy or SnapshotPolicy()
+        self.balance_cache = balance_cache
+        self.result_cache = result_cache
+        # Write a transaction.created outbox event along with every transaction.
+        self.outbox = outbox
+        # pg_notify every balance change for app.streams.balances.
+        self.notify_balance_changes = notify_balance_changes
+        self.commit_horizon = commit_horizon
+
+    @functools.cached_property
+    def read_session_maker(self) -> async_sessionmaker[AsyncSessionType]:
+        """Session maker of the reads that tolerate lag, chosen on first use; writes use db_session_maker."""
+        return self.route_reads() if self.route_reads is not None else self.db_session_maker
+
+    async def warm_up(self) -> None:
+        """Run the hot statements once for a user that does not exist.
+
+        Nothing is written, but the connection behind db_session_maker keeps
+        the statements prepared, see app.db.base.warm_up_pool.
+        """
+        missing_user = uuid.UUID(int=0)
+        await self.get_transaction(missing_user)
+        for transaction_type in TransactionType:
+            with contextlib.suppress(UserNotExistsError):
+                await self.create_transaction(TransactionCreate(
+                    id=uuid.uuid4(), user_id=missing_user, amount=1, type=transaction_type))
+        with contextlib.suppress(UserNotExistsError):
+            await self.get_user_balance(missing_user)
 
     async def create_user(self, data: UserCreate) -> User:
         async with self.db_session_maker() as session:
@@ -33,76 +175,740 @@ class PaymentRepository:
             return new_user
 
     async def create_transaction(self, data: TransactionCreate) -> Transaction:
+        if self.write_coalescer is not None:
+            transaction = await self.write_coalescer.submit(data)
+        elif self.write_mode == WriteMode.ATOMIC:
+            transaction = await self._create_transaction_atomic(data)
+        elif self.write_mode == WriteMode.LEDGER:
+            transaction = await self._create_transaction_ledger(data)
+        else:
+            transaction = await self._create_transaction_locking(data)
+        self._forget_missing_transactions([transaction])
+        return transaction
+
+    async def _create_transaction_locking(self, data: TransactionCreate) -> Transaction:
         async with self.db_session_maker() as sql_tx:
             async with sql_tx.begin():
                 user = await sql_tx.get(User, data.user_id, with_for_update=True)
                 await self._check_new_transaction_input_data(sql_tx, data, user)
                 await self._update_user_balance(user, data.amount, data.type)
-                await self._create_balances_snapshots(sql_tx, user)
+                # Taken under the row lock, so timestamps of one user follow commit order.
+                created_at = self._stamp(user)
+                if self.snapshot_policy.apply(user, created_at):
+                    await self._create_balances_snapshots(sql_tx, user, created_at)
 
                 transaction = Transaction(
                     id=data.id,
                     user_id=data.user_id,
                     amount=data.amount,
                     type=data.type,
+                    created_at=created_at,
                 )
+                sql_tx.add(TransactionKey(id=data.id, created_at=created_at))
                 sql_tx.add(transaction)
+                if self.outbox:
+                    sql_tx.add(OutboxEvent(**self._outbox_row(transaction)))
+                await self._notify(sql_tx, [balance_change_payload(user.id, user.balance)])
                 await sql_tx.commit()
 
-                return transaction
+        await self._cache_balance(user.id, user.balance, user.balance_version)
+        return transaction
 
-    async def get_transaction(self, transaction_id: uuid.UUID) -> Optional[Transaction]:
+    async def _create_transaction_atomic(self, data: TransactionCreate) -> Transaction:
+        if data.type == TransactionType.WITHDRAW:
+            delta = -data.amount
+        elif data.type == TransactionType.DEPOSIT:
+            delta = data.amount
+        else:
+            raise UnknownTransactionTypeError(f"Unknown transaction type: {data.type}")
+
+        async with self.db_session_maker() as sql_tx:
+            if data.amount == 0:
+                # Keep the error precedence of the locking path: unknown user first.
+                if await sql_tx.get(User, data.user_id) is None:
+                    raise UserNotExistsError(f"User with ID {data.user_id} does not exist")
+                raise TransactionAmountZeroError("Zero transaction amount")
+
+            async with sql_tx.begin():
+                # created_at is stamped by the statement, under the row lock.
+                transaction = Transaction(
+                    id=data.id,
+                    user_id=data.user_id,
+                    amount=data.amount,
+                    type=data.type,
+                )
+                result = await sql_tx.execute(ATOMIC_CREATE_TRANSACTION_SQL, {
+                    "id": data.id,
+                    "user_id": data.user_id,
+                    "amount": data.amount,
+                    "delta": delta,
+                    "type": data.type.name,
+                    "notify": self.notify_balance_changes,
+                    **self._outbox_sql_params(transaction),
+                    **self.snapshot_policy.sql_params(),
+                })
+                outcome = result.one()
+                if not outcome.user_exists:
+                    raise UserNotExistsError(f"User with ID {data.user_id} does not exist")
+                # A concurrent insert of the same ID may win between our snapshot and the INSERT,
+                # raising here rolls back the balance change made by the UPDATE.
+                if outcome.duplicate or (outcome.updated and not outcome.inserted):
+                    raise TransactionAlreadyExistsError(f"Transaction with ID {data.id} already exists")
+                if not outcome.updated:
+                    raise InsufficientFundsError("Insufficient funds")
+
+        transaction.created_at = outcome.created_at
+        await self._cache_balance(data.user_id, outcome.balance, outcome.balance_version)
+        return transaction
+
+    async def _create_transaction_ledger(self, data: TransactionCreate) -> Transaction:
+        if data.type not in (TransactionType.WITHDRAW, TransactionType.DEPOSIT):
+            raise UnknownTransactionTypeError(f"Unknown transaction type: {data.type}")
+
+        async with self.db_session_maker() as sql_tx:
+            if data.amount == 0:
+                if await sql_tx.get(User, data.user_id) is None:
+                    raise UserNotExistsError(f"User with ID {data.user_id} does not exist")
+                raise TransactionAmountZeroError("Zero transaction amount")
+
+            async with sql_tx.begin():
+                available = None
+                if data.type == TransactionType.WITHDRAW:
+                    # Only withdrawals serialize, deposits can only raise the balance checked here.
+                    balances = await self._lock_ledger_balances(sql_tx, {data.user_id})
+                    if data.user_id not in balances:
+                        raise UserNotExistsError(f"User with ID {data.user_id} does not exist")
+                    available = balances[data.user_id]
+
+                transaction = Transaction(
+                    id=data.id,
+                    user_id=data.user_id,
+                    amount=data.amount,
+                    type=data.type,
+                    created_at=datetime.utcnow(),
+                )
+                result = await sql_tx.execute(LEDGER_APPEND_SQL, {
+                    "id": data.id,
+                    "user_id": data.user_id,
+                    "amount": data.amount,
+                    "type": data.type.name,
+                    "created_at": transaction.created_at,
+                    "available": available,
+                    # The balance is not known here, listeners read it.
+                    "notification": balance_change_payload(data.user_id) if self.notify_balance_changes else None,
+                    **self._outbox_sql_params(transaction),
+                })
+                outcome = result.one()
+                if not outcome.user_exists:
+                    raise UserNotExistsError(f"User with ID {data.user_id} does not exist")
+                if not outcome.inserted:
+                    raise TransactionAlreadyExistsError(f"Transaction with ID {data.id} already exists")
+                if outcome.seq is None:
+                    raise InsufficientFundsError("Insufficient funds")
+
+        transaction.seq = outcome.seq
+        return transaction
+
+    async def create_transactions_bulk(
+            self,
+            items: Sequence[TransactionCreate]) -> list[Transaction | TransactionError]:
+        """Apply a batch of transactions in one DB transaction.
+
+        Every user row is locked once, in user ID order, and items are applied in the given order.
+        Returns one entry per item: the created transaction, or the error that rejected it.
+        """
+        if not items:
+            return []
+        if self.write_mode == WriteMode.LEDGER:
+            results = await self._create_transactions_bulk_ledger(items)
+        else:
+            results = await self._create_transactions_bulk_locking(items)
+        self._forget_missing_transactions(results)
+        return results
+
+    async def _create_transactions_bulk_locking(
+            self,
+            items: Sequence[TransactionCreate]) -> list[Transaction | TransactionError]:
+        results: list[Transaction | TransactionError] = []
+        async with self.db_session_maker() as sql_tx:
+            async with sql_tx.begin():
+                users = await self._lock_users(sql_tx, {item.user_id for item in items})
+                existing_ids = set(await sql_tx.scalars(
+                    sa.select(TransactionKey.id).where(TransactionKey.id.in_({item.id for item in items}))
+                ))
+                transaction_rows, snapshot_rows = [], []
+                updated_users: dict[uuid.UUID, User] = {}
+                created_at = datetime.min
+                for item in items:
+                    user = users.get(item.user_id)
+                    try:
+                        self._check_user_and_amount(item, user)
+                        if item.id in existing_ids:
+                            raise TransactionAlreadyExistsError(f"Transaction with ID {item.id} already exists")
+                        await self._update_user_balance(user, item.amount, item.type)
+                    except TransactionError as e:
+                        results.append(e)
+                        continue
+
+                    # Keep timestamps strictly increasing so snapshots of one user stay ordered.
+                    created_at = self._stamp(user, created_at)
+                    existing_ids.add(item.id)
+                    updated_users[user.id] = user
+                    transaction = Transaction(
+                        id=item.id,
+                        user_id=item.user_id,
+                        amount=item.amount,
+                        type=item.type,
+                        created_at=created_at,
+                    )
+                    results.append(transaction)
+                    transaction_rows.append({
+                        "id": item.id,
+                        "user_id": item.user_id,
+                        "amount": item.amount,
+                        "type": item.type,
+                        "created_at": created_at,
+                    })
+                    if self.snapshot_policy.apply(user, created_at):
+                        snapshot_rows.append({"user_id": user.id, "balance": user.balance, "created_at": created_at})
+
+                if transaction_rows:
+                    await sql_tx.execute(sa.insert(TransactionKey), [
+                        {"id": row["id"], "created_at": row["created_at"]} for row in transaction_rows
+                    ])
+                    await sql_tx.execute(sa.insert(Transaction), transaction_rows)
+                if snapshot_rows:
+                    await sql_tx.execute(sa.insert(BalancesSnapshots), snapshot_rows)
+                await self._create_outbox_events(sql_tx, results)
+                await self._notify(sql_tx, [
+                    balance_change_payload(user.id, user.balance) for user in updated_users.values()
+                ])
+
+        for user in updated_users.values():
+            await self._cache_balance(user.id, user.balance, user.balance_version)
+        return results
+
+    async def _create_transactions_bulk_ledger(
+            self,
+            items: Sequence[TransactionCreate]) -> list[Transaction | TransactionError]:
+        results: list[Transaction | TransactionError] = []
+        async with self.db_session_maker() as sql_tx:
+            async with sql_tx.begin():
+                user_ids = {item.user_id for item in items}
+                withdrawing = {item.user_id for item in items if item.type == TransactionType.WITHDRAW}
+                # Running derived balances of the users that withdraw, the others are not locked.
+                balances = await self._lock_ledger_balances(sql_tx, withdrawing)
+                known_users = set(balances) | set(await sql_tx.scalars(
+                    sa.select(User.id).where(User.id.in_(user_ids - withdrawing))
+                ))
+                existing_ids = set(await sql_tx.scalars(
+                    sa.select(TransactionKey.id).where(TransactionKey.id.in_({item.id for item in items}))
+                ))
+                transaction_rows = []
+                created_at = datetime.min
+                for item in items:
+                    try:
+                        if item.user_id not in known_users:
+                            raise UserNotExistsError(f"User with ID {item.user_id} does not exist")
+                        if item.amount == 0:
+                            raise TransactionAmountZeroError("Zero transaction amount")
+                        if item.id in existing_ids:
+                            raise TransactionAlreadyExistsError(f"Transaction with ID {item.id} already exists")
+                        if item.type == TransactionType.WITHDRAW:
+                            if balances[item.user_id] < item.amount:
+                                raise InsufficientFundsError("Insufficient funds")
+                            balances[item.user_id] -= item.amount
+                        elif item.type == TransactionType.DEPOSIT:
+                            if item.user_id in balances:
+                                balances[item.user_id] += item.amount
+                        else:
+                            raise UnknownTransactionTypeError(f"Unknown transaction type: {item.type}")
+                    except TransactionError as e:
+                        results.append(e)
+                        continue
+
+                    created_at = max(datetime.utcnow(), created_at + timedelta(microseconds=1))
+                    existing_ids.add(item.id)
+                    results.append(Transaction(
+                        id=item.id,
+                        user_id=item.user_id,
+                        amount=item.amount,
+                        type=item.type,
+                        created_at=created_at,
+                    ))
+                    transaction_rows.append({
+                        "id": item.id,
+                        "user_id": item.user_id,
+                        "amount": item.amount,
+                        "type": item.type,
+                        "created_at": created_at,
+                    })
+
+                if transaction_rows:
+                    await sql_tx.execute(sa.insert(TransactionKey), [
+                        {"id": row["id"], "created_at": row["created_at"]} for row in transaction_rows
+                    ])
+                    seqs = await sql_tx.scalars(
+                        sa.insert(Transaction).values(seq=TRANSACTIONS_SEQ.next_value()).returning(
+                            Transaction.seq, sort_by_parameter_order=True),
+                        transaction_rows,
+                    )
+                    for transaction, seq in zip(
+                            (r for r in results if isinstance(r, Transaction)), seqs.all()):
+                        transaction.seq = seq
+                await self._create_outbox_events(sql_tx, results)
+                await self._notify(sql_tx, [
+                    balance_change_payload(user_id)
+                    for user_id in {r.user_id for r in results if isinstance(r, Transaction)}
+                ])
+
+        return results
+
+    async def _lock_ledger_balances(
+            self,
+            sql_tx: AsyncSession,
+            user_ids: set[uuid.UUID]) -> dict[uuid.UUID, MoneyValue]:
+        """Lock users (fixed order, as _lock_users) and return their derived balances."""
+        locked = await self._lock_users(sql_tx, user_ids, key_share=True) if user_ids else {}
+        if not locked:
+            return {}
+        # A separate statement: its snapshot is taken after the lock, so it sees the
+        # transactions committed by whoever held the lock before.
+        result = await sql_tx.execute(self._ledger_balances_query(User.id.in_(locked)))
+        return dict(result.all())
+
+    @staticmethod
+    def _ledger_balances_query(requested: sa.ColumnElement[bool]) -> sa.Select:
+        """Current balances in ledger mode: the checkpoint plus the tail after it."""
+        tail = (
+            sa.select(sa.func.coalesce(sa.func.sum(SIGNED_AMOUNT), 0))
+            .where(Transaction.user_id == User.id)
+            .where(Transaction.seq > User.ledger_seq)
+            .scalar_subquery()
+        )
+        return sa.select(User.id, sa.cast(sa.func.coalesce(User.balance, 0) + tail, User.balance.type)).where(requested)
+
+    async def checkpoint_ledger(self, folded_seq: int, settled_seq: int, snapshot_at: datetime) -> int:
+        """Fold ledger transactions up to settled_seq into users.balance, see LedgerCheckpointer.
+
+        Every ledger transaction up to folded_seq is already folded, and every one
+        created up to snapshot_at has committed. Returns the number of users folded.
+        """
         async with self.db_session_maker() as session:
+            user_ids = (await session.scalars(
+                sa.select(Transaction.user_id)
+                .where(Transaction.seq > folded_seq)
+                .where(Transaction.seq <= settled_seq)
+                .distinct()
+            )).all()
+
+        folded = 0
+        for chunk_start in range(0, len(user_ids), LEDGER_CHECKPOINT_BATCH_SIZE):
+            chunk = user_ids[chunk_start:chunk_start + LEDGER_CHECKPOINT_BATCH_SIZE]
+            async with self.db_session_maker() as sql_tx:
+                async with sql_tx.begin():
+                    await self._lock_users(sql_tx, set(chunk), key_share=True)
+                    locked = aliased(User)
+                    tail = (
+                        sa.select(Transaction.user_id, sa.func.sum(SIGNED_AMOUNT).label("amount"))
+                        .join(locked, locked.id == Transaction.user_id)
+                        .where(Transaction.user_id.in_(chunk))
+                        .where(Transaction.seq > locked.ledger_seq)
+                        .where(Transaction.seq <= settled_seq)
+                        .group_by(Transaction.user_id)
+                        .subquery("tail")
+                    )
+                    checkpointed = (await sql_tx.scalars(
+                        sa.update(User)
+                        .where(User.id == tail.c.user_id)
+                        .values(balance=User.balance + tail.c.amount, ledger_seq=settled_seq)
+                        .returning(User.id)
+                        .execution_options(synchronize_session=False)
+                    )).all()
+                    if checkpointed:
+                        # Sparse snapshots keep balance-as-of queries fast, ledger writes do not write any.
+                        balances = self._balances_at_query(User.id.in_(checkpointed), snapshot_at).subquery()
+                        await sql_tx.execute(
+                            sa.insert(BalancesSnapshots).from_select(
+                                ["user_id", "balance", "created_at"],
+                                sa.select(*balances.c, sa.literal(snapshot_at, sa.DateTime)),
+                            )
+                        )
+                    folded += len(checkpointed)
+        return folded
+
+    def _outbox_row(self, transaction: Transaction) -> dict:
+        return {
+            "event_type": TRANSACTION_CREATED_EVENT,
+            "payload": schemas.Transaction.model_validate(transaction).model_dump(mode="json"),
+            "created_at": transaction.created_at,
+            "available_at": transaction.created_at,
+        }
+
+    def _outbox_sql_params(self, transaction: Transaction) -> dict:
+        """Parameters of the event CTE, a NULL event inserts nothing.
+
+        A transaction without created_at leaves it out of the payload, for the statement to fill in.
+        """
+        if not self.outbox:
+            return {"event_type": None, "event": None}
+        if transaction.created_at is None:
+            fields = {name: getattr(transaction, name) for name in schemas.Transaction.model_fields}
+            event = schemas.Transaction.model_construct(**fields).model_dump_json(exclude={"created_at"})
+        else:
+            event = schemas.Transaction.model_validate(transaction).model_dump_json()
+        return {"event_type": TRANSACTION_CREATED_EVENT, "event": event}
+
+    async def _create_outbox_events(
+            self,
+            sql_tx: AsyncSession,
+            results: Sequence[Transaction | TransactionError]) -> None:
+        if not self.outbox:
+            return
+        rows = [self._outbox_row(r) for r in results if isinstance(r, Transaction)]
+        if rows:
+            await sql_tx.execute(sa.insert(OutboxEvent), rows)
+
+    async def _notify(self, sql_tx: AsyncSession, payloads: list[str]) -> None:
+        # Delivered by Postgres on commit, so listeners never see a change that rolled back.
+        if self.notify_balance_changes and payloads:
+            await sql_tx.execute(NOTIFY_BALANCE_CHANGES_SQL, {"payloads": payloads})
+
+    @staticmethod
+    async def _lock_users(
+            sql_tx: AsyncSession,
+            user_ids: set[uuid.UUID],
+            key_share: bool = False) -> dict[uuid.UUID, User]:
+        # A fixed lock order keeps concurrent batches touching the same users from deadlocking.
+        result = await sql_tx.scalars(
+            sa.select(User)
+            .where(User.id.in_(user_ids))
+            .order_by(User.id)
+            .with_for_update(key_share=key_share)
+        )
+        return {user.id: user for user in result}
+
+    async def get_transaction(self, transaction_id: uuid.UUID) -> Optional[Transaction]:
+        # Transactions are never updated, only "not found" may change.
+        cache_key = ("transaction", transaction_id)
+        if self.result_cache is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not MISSING:
+                return cached
+
+        transaction = await self._read_transaction(self.read_session_maker, transaction_id)
+        if transaction is None and self.read_session_maker is not self.db_session_maker:
+            # The replica may not have replayed it yet.
+            transaction = await self._read_transaction(self.db_session_maker, transaction_id)
+
+        if self.result_cache is not None:
+            self.result_cache.set(cache_key, transaction)
+        return transaction
+
+    def _forget_missing_transactions(self, results: Iterable[Transaction | TransactionError]) -> None:
+        # Called after the commit: earlier reads may have cached these IDs as not found.
+        if self.result_cache is not None:
+            for result in results:
+                if isinstance(result, Transaction):
+                    self.result_cache.delete(("transaction", result.id))
+
+    @staticmethod
+    async def _existing_transaction_ids(
+            session_maker: async_sessionmaker[AsyncSessionType],
+            transaction_ids: Iterable[uuid.UUID]) -> set[uuid.UUID]:
+        async with session_maker() as session:
+            return set(await session.scalars(
+                sa.select(TransactionKey.id).where(TransactionKey.id.in_(set(transaction_ids)))
+            ))
+
+    @staticmethod
+    async def _read_transaction(
+            session_maker: async_sessionmaker[AsyncSessionType],
+            transaction_id: uuid.UUID) -> Optional[Transaction]:
+        async with session_maker() as session:
+            # Comparing created_at to the key lets Postgres prune the scan down to one partition.
+            created_at = (
+                sa.select(TransactionKey.created_at)
+                .where(TransactionKey.id == transaction_id)
+                .scalar_subquery()
+            )
             result = await session.execute(
-                select(Transaction).where(Transaction.id == transaction_id)
+                select(Transaction)
+                .where(Transaction.id == transaction_id)
+                .where(Transaction.created_at == created_at)
             )
-            transaction = result.scalar_one_or_none()
-
-            return transaction
+            return result.scalar_one_or_none()
 
     async def get_user_balance(
             self,
             user_id: uuid.UUID,
-            ts: datetime = None) -> Decimal:
-        async with self.db_session_maker() as session:
+            ts: datetime = None) -> MoneyValue:
+        if ts is None and self.write_mode != WriteMode.LEDGER and self.balance_cache is not None:
+            cached = await self.balance_cache.get(user_id)
+            if cached is not None:
+                return cached.balance
+
+        cache_key = ("balance", user_id, ts)
+        cacheable = self.result_cache is not None and ts is not None and self._is_final(ts)
+        if cacheable:
+            cached = self.result_cache.get(cache_key)
+            if cached is None:
+                raise UserNotExistsError(f"User with ID {user_id} does not exist")
+            if cached is not MISSING:
+                return cached
+
+        try:
+            try:
+                balance = await self._read_user_balance(self.read_session_maker, user_id, ts)
+            except UserNotExistsError:
+                if self.read_session_maker is self.db_session_maker:
+                    raise
+                # The replica may not have replayed the user's creation yet.
+                balance = await self._read_user_balance(self.db_session_maker, user_id, ts)
+        except UserNotExistsError:
+            if cacheable:
+                self.result_cache.set(cache_key, None)
+            raise
+        if cacheable:
+            self.result_cache.set(cache_key, balance)
+        return balance
+
+    async def _read_user_balance(
+            self,
+            session_maker: async_sessionmaker[AsyncSessionType],
+            user_id: uuid.UUID,
+            ts: Optional[datetime]) -> MoneyValue:
+        async with session_maker() as session:
+            if ts is None and self.write_mode == WriteMode.LEDGER:
+                result = await session.execute(self._ledger_balances_query(User.id == user_id))
+                row = result.one_or_none()
+                if row is None:
+                    raise UserNotExistsError(f"User with ID {user_id} does not exist")
+                return row[1]
+
             user = await session.get(User, user_id)
             if not user:
                 raise UserNotExistsError(f"User with ID {user_id} does not exist")
 
             if ts is None:
-                return user.balance or Decimal(0)
+                balance = user.balance or ZERO
+                await self._cache_balance(user_id, balance, user.balance_version)
+                return balance
             else:
-                query = (
-                    sa.select(BalancesSnapshots.balance)
-                    .where(BalancesSnapshots.user_id == user_id)
-                    .where(BalancesSnapshots.created_at <= ts)
-                    .order_by(BalancesSnapshots.created_at.desc())
-                    .limit(1)
-                )
-                result = await session.execute(query)
-                balance = result.scalar()
+                result = await session.execute(self._balance_at_query(user_id, ts))
+                return result.scalar_one()
+
+    async def get_user_balances(
+            self,
+            user_ids: Iterable[uuid.UUID],
+            ts: datetime = None) -> AsyncIterator[tuple[uuid.UUID, MoneyValue]]:
+        """Stream (user ID, balance) of the given users in one query, unknown users are skipped."""
+        # One array parameter instead of one parameter per ID keeps a single prepared statement.
+        requested = User.id == sa.any_(sa.bindparam(
+            "user_ids", list(set(user_ids)), type_=postgresql.ARRAY(User.id.type)))
+        if ts is None and self.write_mode == WriteMode.LEDGER:
+            query = self._ledger_balances_query(requested)
+        elif ts is None:
+            query = sa.select(User.id, sa.func.coalesce(User.balance, 0)).where(requested)
+        else:
+            query = self._balances_at_query(requested, ts)
+        async with self.read_session_maker() as session:
+            result = await session.stream(query)
+            async for user_id, balance in result:
+                yield user_id, balance
+
+    def _is_final(self, ts: datetime) -> bool:
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        return ts < datetime.utcnow() - self.commit_horizon
 
-                return balance or Decimal(0)
+    async def _cache_balance(self, user_id: uuid.UUID, balance: MoneyValue, version: int) -> None:
+        # Called after the commit only: the cache never holds a balance that may still roll back.
+        if self.balance_cache is not None:
+            await self.balance_cache.set(user_id, balance, version)
+
+    @staticmethod
+    def _balance_at_query(user_id: uuid.UUID, ts: datetime) -> sa.Select:
+        """Balance as of ts: the last snapshot at or before ts plus the transactions after it.
+
+        A snapshot shares created_at with the transaction that produced it, so it already
+        includes every transaction up to and including its own timestamp.
+        """
+        snapshot = (
+            sa.select(BalancesSnapshots.balance, BalancesSnapshots.created_at)
+            .where(BalancesSnapshots.user_id == user_id)
+            .where(BalancesSnapshots.created_at <= ts)
+            .order_by(BalancesSnapshots.created_at.desc())
+            .limit(1)
+            .cte("snapshot")
+        )
+        tail = (
+            sa.select(sa.func.coalesce(sa.func.sum(SIGNED_AMOUNT), 0))
+            .where(Transaction.user_id == user_id)
+            .where(Transaction.created_at <= ts)
+            .where(Transaction.created_at > sa.func.coalesce(
+                sa.select(snapshot.c.created_at).scalar_subquery(),
+                sa.literal_column("'-infinity'::timestamp"),
+            ))
+            .scalar_subquery()
+        )
+        balance = sa.func.coalesce(sa.select(snapshot.c.balance).scalar_subquery(), 0) + tail
+        return sa.select(sa.cast(balance, BalancesSnapshots.balance.type))
+
+    @staticmethod
+    def _balances_at_query(requested: sa.ColumnElement[bool], ts: datetime) -> sa.Select:
+        """Set-based _balance_at_query: one index lookup for the last snapshot of each user, then the tail sum."""
+        users = sa.select(User.id).where(requested).subquery("requested_users")
+        snapshot = (
+            sa.select(BalancesSnapshots.balance, BalancesSnapshots.created_at)
+            .where(BalancesSnapshots.user_id == users.c.id)
+            .where(BalancesSnapshots.created_at <= ts)
+            .order_by(BalancesSnapshots.created_at.desc())
+            .limit(1)
+            .lateral("snapshot")
+        )
+        tail = (
+            sa.select(sa.func.coalesce(sa.func.sum(SIGNED_AMOUNT), 0).label("amount"))
+            .where(Transaction.user_id == users.c.id)
+            .where(Transaction.created_at <= ts)
+            .where(Transaction.created_at > sa.func.coalesce(
+                snapshot.c.created_at,
+                sa.literal_column("'-infinity'::timestamp"),
+            ))
+            .lateral("tail")
+        )
+        balance = sa.func.coalesce(snapshot.c.balance, 0) + tail.c.amount
+        return (
+            sa.select(users.c.id, sa.cast(balance, BalancesSnapshots.balance.type))
+            .select_from(users)
+            .outerjoin(snapshot, sa.true())
+            .join(tail, sa.true())
+        )
+
+    async def get_user_transactions(
+            self,
+            user_id: uuid.UUID,
+            limit: int = HISTORY_PAGE_SIZE,
+            before: Optional[tuple[datetime, uuid.UUID]] = None,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> Sequence[Transaction]:
+        """Return one page of the user's transactions created in [since, until), newest first.
+
+        ``before`` is the (created_at, id) of the last transaction of the previous page.
+        """
+        return await self._get_user_history_page(Transaction, user_id, limit, before, since, until)
+
+    async def get_user_snapshots(
+            self,
+            user_id: uuid.UUID,
+            limit: int = HISTORY_PAGE_SIZE,
+            before: Optional[tuple[datetime, int]] = None,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> Sequence[BalancesSnapshots]:
+        """Return one page of the user's balance snapshots created in [since, until), newest first."""
+        return await self._get_user_history_page(BalancesSnapshots, user_id, limit, before, since, until)
+
+    async def _get_user_history_page(
+            self,
+            model: type[Transaction] | type[BalancesSnapshots],
+            user_id: uuid.UUID,
+            limit: int,
+            before: Optional[tuple],
+            since: Optional[datetime],
+            until: Optional[datetime]) -> Sequence:
+        limit = max(1, min(limit, HISTORY_PAGE_SIZE_MAX))
+        query = self._user_history_query(model, user_id, since, until)
+        if before is not None:
+            # Keyset pagination: the index seek costs the same on the first page and on the last one.
+            query = query.where(sa.tuple_(model.created_at, model.id) < before)
+        query = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit)
+        async with self.read_session_maker() as session:
+            result = await session.execute(query)
+            page = result.scalars().all()
+            # An empty page is ambiguous, only then pay for the existence check.
+            if not page and await self._user_missing(session, user_id):
+                raise UserNotExistsError(f"User with ID {user_id} does not exist")
+
+            return page
+
+    async def stream_user_transactions(
+            self,
+            user_id: uuid.UUID,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> AsyncIterator[sa.Row]:
+        """Stream all the user's transactions created in [since, until), oldest first.
+
+        Rows are fetched from a server-side cursor EXPORT_FETCH_SIZE at a time, so memory
+        use does not depend on the size of the history. Raises UserNotExistsError before
+        the first row for an unknown user.
+        """
+        query = (
+            self._user_history_query(Transaction, user_id, since, until)
+            # Plain rows, exports do not need ORM instances.
+            .with_only_columns(*Transaction.__table__.c)
+            .order_by(Transaction.created_at, Transaction.id)
+            .execution_options(yield_per=EXPORT_FETCH_SIZE)
+        )
+        async with self.read_session_maker() as session:
+            if await self._user_missing(session, user_id):
+                raise UserNotExistsError(f"User with ID {user_id} does not exist")
+            result = await session.stream(query)
+            async for row in result:
+                yield row
+
+    async def _user_missing(self, session: AsyncSession, user_id: uuid.UUID) -> bool:
+        """Whether the user does not exist, session reads from read_session_maker."""
+        if await session.get(User, user_id) is not None:
+            return False
+        if self.read_session_maker is self.db_session_maker:
+            return True
+        # The replica may not have replayed the user's creation yet.
+        async with self.db_session_maker() as primary_session:
+            return await primary_session.get(User, user_id) is None
+
+    @staticmethod
+    def _user_history_query(
+            model: type[Transaction] | type[BalancesSnapshots],
+            user_id: uuid.UUID,
+            since: Optional[datetime],
+            until: Optional[datetime]) -> sa.Select:
+        query = sa.select(model).where(model.user_id == user_id)
+        if since is not None:
+            query = query.where(model.created_at >= since)
+        if until is not None:
+            query = query.where(model.created_at < until)
+        return query
 
     @staticmethod
     async def _check_new_transaction_input_data(
             sql_tx: AsyncSession,
             data: TransactionCreate,
             user: Optional[Type[User]]) -> None:
+        PaymentRepository._check_user_and_amount(data, user)
+
+        existing_transaction = await sql_tx.get(TransactionKey, data.id)
+        if existing_transaction is not None:
+            raise TransactionAlreadyExistsError(f"Transaction with ID {data.id} already exists")
+
+    @staticmethod
+    def _check_user_and_amount(data: TransactionCreate, user: Optional[Type[User]]) -> None:
         if not user:
             raise UserNotExistsError(f"User with ID {data.user_id} does not exist")
 
-        if data.amount.is_zero():
+        if data.amount == 0:
             raise TransactionAmountZeroError("Zero transaction amount")
 
-        existing_transaction = await sql_tx.get(Transaction, data.id)
-        if existing_transaction is not None:
-            raise TransactionAlreadyExistsError(f"Transaction with ID {data.id} already exists")
+    @staticmethod
+    def _stamp(user: User, after: datetime = datetime.min) -> datetime:
+        """created_at of the locked user's next transaction, strictly later than ``after`` and their last one."""
+        last = max(after, user.last_transaction_at or datetime.min)
+        user.last_transaction_at = max(datetime.utcnow(), last + timedelta(microseconds=1))
+        return user.last_transaction_at
 
     @staticmethod
     async def _update_user_balance(
             user: Type[User],
-            amount: Decimal,
+            amount: MoneyValue,
             transaction_type: TransactionType) -> None:
         if transaction_type == TransactionType.WITHDRAW:
             if user.balance < amount:
@@ -112,13 +918,16 @@ class PaymentRepository:
             user.balance += amount
         else:
             raise UnknownTransactionTypeError(f"Unknown transaction type: {transaction_type}")
+        user.balance_version += 1
 
     @staticmethod
     async def _create_balances_snapshots(
             sql_tx: AsyncSession,
-            user: Type[User]) -> None:
+            user: Type[User],
+            created_at: datetime) -> None:
         snapshot = BalancesSnapshots(
             user_id=user.id,
             balance=user.balance,
+            created_at=created_at,
         )
         sql_tx.add(snapshot)
@@ -0,0 +1,206 @@
+import asyncio
+import contextlib
+import uuid
+from datetime import datetime
+from typing import Any, AsyncGenerator, AsyncIterator, Iterable, Optional, Sequence
+
+from app.cache.results import MISSING
+from app.db.shards import ShardSet
+from app.exceptions import TransactionAlreadyExistsError, TransactionError, TransactionIdConflictError
+from app.models import BalancesSnapshots, Transaction, User
+from app.money import MoneyValue
+from app.repositories.coalescing import WriteCoalescer
+from app.repositories.payments import HISTORY_PAGE_SIZE, PaymentRepository
+from app.schemas import TransactionCreate, UserCreate
+
+
+class ShardedPaymentRepository:
+    """PaymentRepository of users spread over the shards of app.db.shards.
+
+    Everything about a user goes to the PaymentRepository of their shard,
+    built with ``repository_options``. Reads and batches spanning several
+    users run on their shards in parallel.
+
+    Before a write, the other shards are asked whether they already have its
+    transaction ID, so an ID used for a user of another shard is rejected
+    like any other existing one. Two concurrent writes of one ID for users of
+    different shards can still both pass, get_transaction then raises
+    TransactionIdConflictError.
+    """
+
+    def __init__(
+            self,
+            shards: ShardSet,
+            write_coalescer: Optional[WriteCoalescer] = None,
+            **repository_options: Any):
+        self.shards = shards
+        self.write_coalescer = write_coalescer
+        self.result_cache = repository_options.get("result_cache")
+        self.repository_options = repository_options
+        self._repositories: dict[str, PaymentRepository] = {}
+
+    def repository(self, shard_name: str) -> PaymentRepository:
+        if shard_name not in self._repositories:
+            self._repositories[shard_name] = PaymentRepository(
+                self.shards.shards[shard_name].session_maker, **self.repository_options)
+        return self._repositories[shard_name]
+
+    def for_user(self, user_id: uuid.UUID) -> PaymentRepository:
+        return self.repository(self.shards.ring.get(user_id))
+
+    async def warm_up(self) -> None:
+        await asyncio.gather(*(self.repository(shard.name).warm_up() for shard in self.shards))
+
+    async def create_user(self, data: UserCreate) -> User:
+        return await self.for_user(data.id).create_user(data)
+
+    async def create_transaction(self, data: TransactionCreate) -> Transaction:
+        if await self._taken_on_other_shards([data]):
+            raise TransactionAlreadyExistsError(f"Transaction with ID {data.id} already exists")
+        if self.write_coalescer is None:
+            return await self.for_user(data.user_id).create_transaction(data)
+        transaction = await self.write_coalescer.submit(data)
+        self.for_user(data.user_id)._forget_missing_transactions([transaction])
+        return transaction
+
+    async def create_transactions_bulk(
+            self,
+            items: Sequence[TransactionCreate]) -> list[Transaction | TransactionError]:
+        """PaymentRepository.create_transactions_bulk, in one DB transaction per shard.
+
+        The shards apply their part concurrently. If one of them fails, the
+        parts of the others may still commit.
+        """
+        results: list[Transaction | TransactionError] = [None] * len(items)  # type: ignore[list-item]
+        taken = await self._taken_on_other_shards(items)
+        positions: dict[str, list[int]] = {}
+        for position, item in enumerate(items):
+            if item.id in taken:
+                results[position] = TransactionAlreadyExistsError(f"Transaction with ID {item.id} already exists")
+            else:
+                positions.setdefault(self.shards.ring.get(item.user_id), []).append(position)
+
+        async def apply(shard_name: str, shard_positions: list[int]) -> None:
+            shard_results = await self.repository(shard_name).create_transactions_bulk(
+                [items[position] for position in shard_positions])
+            for position, result in zip(shard_positions, shard_results):
+                results[position] = result
+
+        await asyncio.gather(*(apply(shard_name, shard_positions) for shard_name, shard_positions in positions.items()))
+        return results
+
+    async def _taken_on_other_shards(self, items: Sequence[TransactionCreate]) -> set[uuid.UUID]:
+        """IDs of the items that a shard other than the one of their user already has."""
+        transaction_ids: dict[str, set[uuid.UUID]] = {}
+        for item in items:
+            user_shard = self.shards.ring.get(item.user_id)
+            for shard in self.shards:
+                if shard.name != user_shard:
+                    transaction_ids.setdefault(shard.name, set()).add(item.id)
+        found = await asyncio.gather(*(
+            PaymentRepository._existing_transaction_ids(self.shards.shards[shard_name].session_maker, shard_ids)
+            for shard_name, shard_ids in transaction_ids.items()
+        ))
+        return set().union(*found)
+
+    async def get_transaction(self, transaction_id: uuid.UUID) -> Optional[Transaction]:
+        # Only the ID is known: ask every shard. Cached here, a shard missing it must not cache "not found".
+        cache_key = ("transaction", transaction_id)
+        if self.result_cache is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not MISSING:
+                return cached
+
+        found = [transaction for transaction in await asyncio.gather(*(
+            PaymentRepository._read_transaction(shard.session_maker, transaction_id) for shard in self.shards
+        )) if transaction is not None]
+        if len(found) > 1:
+            # Left by concurrent writes racing the check of create_transaction, any hit could be the one asked for.
+            raise TransactionIdConflictError(f"Transaction ID {transaction_id} exists on {len(found)} shards")
+        transaction = found[0] if found else None
+
+        if self.result_cache is not None:
+            self.result_cache.set(cache_key, transaction)
+        return transaction
+
+    async def get_user_balance(self, user_id: uuid.UUID, ts: datetime = None) -> MoneyValue:
+        return await self.for_user(user_id).get_user_balance(user_id, ts=ts)
+
+    async def get_user_balances(
+            self,
+            user_ids: Iterable[uuid.UUID],
+            ts: datetime = None) -> AsyncIterator[tuple[uuid.UUID, MoneyValue]]:
+        """Stream (user ID, balance) of the given users from all their shards at once, in no particular order."""
+        streams = [
+            self.repository(shard_name).get_user_balances(shard_user_ids, ts=ts)
+            for shard_name, shard_user_ids in self.shards.group(set(user_ids)).items()
+        ]
+        async for item in merge(streams):
+            yield item
+
+    async def get_user_transactions(
+            self,
+            user_id: uuid.UUID,
+            limit: int = HISTORY_PAGE_SIZE,
+            before: Optional[tuple[datetime, uuid.UUID]] = None,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> Sequence[Transaction]:
+        return await self.for_user(user_id).get_user_transactions(
+            user_id, limit=limit, before=before, since=since, until=until)
+
+    async def get_user_snapshots(
+            self,
+            user_id: uuid.UUID,
+            limit: int = HISTORY_PAGE_SIZE,
+            before: Optional[tuple[datetime, int]] = None,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> Sequence[BalancesSnapshots]:
+        return await self.for_user(user_id).get_user_snapshots(
+            user_id, limit=limit, before=before, since=since, until=until)
+
+    def stream_user_transactions(
+            self,
+            user_id: uuid.UUID,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> AsyncIterator[Any]:
+        return self.for_user(user_id).stream_user_transactions(user_id, since=since, until=until)
+
+
+async def merge(iterators: Sequence[AsyncGenerator[Any, None]]) -> AsyncIterator[Any]:
+    """Items of all the iterators as they come, each one consumed by its own task."""
+    if len(iterators) == 1:
+        async with contextlib.aclosing(iterators[0]):
+            async for item in iterators[0]:
+                yield item
+        return
+
+    # (error, item) pairs, done marks the end of an iterator.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=len(iterators))
+    done = object()
+
+    async def consume(iterator: AsyncGenerator[Any, None]) -> None:
+        try:
+            # Closed on cancellation too, releasing its connection.
+            async with contextlib.aclosing(iterator):
+                async for item in iterator:
+                    await queue.put((None, item))
+        except Exception as exc:
+            await queue.put((exc, done))
+        else:
+            await queue.put((None, done))
+
+    tasks = [asyncio.create_task(consume(iterator)) for iterator in iterators]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            error, item = await queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+from typing import Final, Optional
+
+from app.enums import SnapshotMode
+from app.models import User
+from app.settings import Settings
+
+# Same rule as SnapshotPolicy.is_due, evaluated against the users row being updated
+# for a transaction stamped ``stamp``.
+SNAPSHOT_DUE_SQL: Final = """(
+    (CAST(:snapshot_every_n AS integer) > 0 AND transactions_since_snapshot + 1 >= :snapshot_every_n)
+    OR (CAST(:snapshot_interval AS interval) IS NOT NULL AND (
+        snapshot_at IS NULL
+        OR snapshot_at <= stamp - CAST(:snapshot_interval AS interval)
+    ))
+)"""
+
+
+class SnapshotPolicy:
+    """Decides which transactions also write a balance snapshot.
+
+    A snapshot is due once ``every_n`` transactions were applied since the last
+    one, or once ``interval`` has passed since it. ``None`` disables a criterion.
+    """
+
+    def __init__(self, every_n: Optional[int] = 1, interval: Optional[timedelta] = None):
+        self.every_n = every_n
+        self.interval = interval
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "SnapshotPolicy":
+        if settings.snapshot_mode == SnapshotMode.EVERY_N:
+            return cls(every_n=settings.snapshot_every_n)
+        if settings.snapshot_mode == SnapshotMode.INTERVAL:
+            return cls(every_n=None, interval=timedelta(seconds=settings.snapshot_interval_seconds))
+        return cls()
+
+    def is_due(self, user: User, created_at: datetime) -> bool:
+        if self.every_n is not None and user.transactions_since_snapshot + 1 >= self.every_n:
+            return True
+        if self.interval is not None and (user.snapshot_at is None or created_at - user.snapshot_at >= self.interval):
+            return True
+        return False
+
+    def apply(self, user: User, created_at: datetime) -> bool:
+        """Update the user's snapshot bookkeeping for one more transaction, return whether to snapshot."""
+        if self.is_due(user, created_at):
+            user.transactions_since_snapshot = 0
+            user.snapshot_at = created_at
+            return True
+        user.transactions_since_snapshot += 1
+        return False
+
+    def sql_params(self) -> dict[str, object]:
+        """Parameters for the SNAPSHOT_DUE_SQL condition of the single-statement write path."""
+        return {"snapshot_every_n": self.every_n or 0, "snapshot_interval": self.interval}
@@ -1,10 +1,11 @@
 import uuid
 from datetime import datetime
-from decimal import Decimal
 
 import pydantic
 from pydantic import BaseModel
 from app.enums import TransactionType
+from app.money import Money, MoneyInput
+from app.settings import Settings
 
 
 class Base(BaseModel):
@@ -20,13 +21,19 @@ class User(BaseModel):
 class Transaction(BaseModel):
     id: uuid.UUID
     user_id: uuid.UUID
-    amount: Decimal
+    amount: Money
     type: TransactionType
     created_at: datetime
 
     model_config = pydantic.ConfigDict(from_attributes=True)
 
 
+class TransactionPage(BaseModel):
+    items: list[Transaction]
+    # Pass it back as ``cursor`` to get the next page, None on the last page.
+    next_cursor: str | None = None
+
+
 class UserCreate(BaseModel):
     id: uuid.UUID
     name: str
@@ -35,9 +42,27 @@ class UserCreate(BaseModel):
 class TransactionCreate(BaseModel):
     id: uuid.UUID
     user_id: uuid.UUID
-    amount: Decimal
+    amount: MoneyInput
     type: TransactionType
 
 
+class TransactionBatchItemResult(BaseModel):
+    id: uuid.UUID
+    status_code: int
+    detail: str | None = None
+    transaction: Transaction | None = None
+
+
 class UserBalance(BaseModel):
-    balance: Decimal
+    balance: Money
+
+
+class UserBalancesQuery(BaseModel):
+    user_ids: list[uuid.UUID] = pydantic.Field(min_length=1, max_length=Settings.balances_batch_size_max)
+    ts: datetime | None = None
+
+
+class UserBalanceItem(BaseModel):
+    user_id: uuid.UUID
+    # None for unknown users
+    balance: Money | None
@@ -1,21 +1,163 @@
 import os
+from datetime import timedelta
 
 import dotenv
 from pydantic import PostgresDsn
 
+from app.enums import BalanceCacheBackend, MoneyRepresentation, OutboxSinkBackend, SnapshotMode, WriteMode
+
 dotenv.load_dotenv()
 
 
+def _cpu_count() -> int:
+    # Respects CPU affinity (taskset, cgroup cpusets), unlike os.cpu_count().
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def parse_shard_dsns(value: str) -> dict[str, str]:
+    """``name=dsn,name=dsn`` to {name: dsn}."""
+    shards = {}
+    for item in value.split(","):
+        if not item:
+            continue
+        name, separator, dsn = item.partition("=")
+        if not separator or not name or not dsn:
+            raise ValueError(f"Expected name=dsn, got {item!r}")
+        shards[name] = dsn
+    return shards
+
+
 class Settings:
     service_name: str = "Balance Service"
     debug: bool = os.getenv("DEBUG", "false").lower() in ("true", "1")
     app_port: int = int(os.getenv("APP_PORT", 8000))
     log_level: str = os.getenv("LOG_LEVEL", "info")
 
+    # Granian settings
+    app_workers: int = int(os.getenv("APP_WORKERS", _cpu_count()))
+    app_runtime_threads: int = int(os.getenv("APP_RUNTIME_THREADS", 1))
+    app_backlog: int = int(os.getenv("APP_BACKLOG", 1024))
+    # Max concurrent requests per worker, granian defaults it to backlog / workers.
+    app_backpressure: int | None = int(os.environ["APP_BACKPRESSURE"]) if os.getenv("APP_BACKPRESSURE") else None
+    app_http: str = os.getenv("APP_HTTP", "auto")  # "auto", "1" or "2"
+
     # Database settings
     db_dsn: PostgresDsn = os.getenv(
         "DATABASE_URL",
     )
+    db_echo: bool = os.getenv("DB_ECHO", "false").lower() in ("true", "1")
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", 10))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", 5))
+    db_pool_timeout: float = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    db_pool_pre_ping: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1")
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    db_statement_timeout_ms: int = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 30000))
+    # Added to the statement timeout to bound how long a stamped transaction may take to commit,
+    # see commit_horizon().
+    commit_horizon_margin_seconds: float = float(os.getenv("COMMIT_HORIZON_MARGIN_SECONDS", 30))
+    db_prepared_statement_cache_size: int = int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", 100))
+    # Connections opened at startup, with the hot statements prepared on each. 0 opens them on demand.
+    db_pool_warmup: int = int(os.getenv("DB_POOL_WARMUP", 0))
+    # Ceiling for connections opened by all workers together, keep it below Postgres max_connections.
+    db_max_connections: int = int(os.getenv("DB_MAX_CONNECTIONS", 90))
+    # Comma separated streaming replicas serving reads that tolerate lag, see app.db.replicas.
+    # Each one gets a pool like the primary's. The max lag must stay below COMMIT_HORIZON_MARGIN_SECONDS,
+    # results older than the commit horizon are cached as final.
+    db_replica_dsns: list[str] = [dsn for dsn in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if dsn]
+    db_replica_max_lag_ms: float = float(os.getenv("DB_REPLICA_MAX_LAG_MS", 1000))
+    db_replica_check_interval_ms: float = float(os.getenv("DB_REPLICA_CHECK_INTERVAL_MS", 100))
+    # Databases holding the users by consistent hashing of their ID, "name=dsn,name=dsn", see
+    # app.db.shards. Each one gets a pool like the primary's and DATABASE_URL is not used. Names
+    # place the shards on the hash ring: keep them when a DSN changes.
+    db_shard_dsns: dict[str, str] = parse_shard_dsns(os.getenv("DATABASE_SHARD_URLS", ""))
+
+    # "locking" reads the user row FOR UPDATE and writes through the ORM,
+    # "atomic" applies the whole transaction in a single statement,
+    # "ledger" appends deposits without locking and derives balances, see app.repositories.ledger.
+    transaction_write_mode: WriteMode = WriteMode(os.getenv("TRANSACTION_WRITE_MODE", "locking"))
+    # Ledger mode: how often settled ledger transactions are folded into users.balance.
+    # Ledger mode writes balance snapshots at each checkpoint instead of per SNAPSHOT_MODE.
+    ledger_checkpoint_interval_seconds: float = float(os.getenv("LEDGER_CHECKPOINT_INTERVAL_SECONDS", 10))
+    # "decimal" stores amounts as NUMERIC(12, 2) and computes with Decimal, "minor_units" stores
+    # BIGINT cents and computes with int, see app.money. Switching needs `python -m app.db.money`.
+    money_representation: MoneyRepresentation = MoneyRepresentation(os.getenv("MONEY_REPRESENTATION", "decimal"))
+    transactions_batch_size_max: int = int(os.getenv("TRANSACTIONS_BATCH_SIZE_MAX", 1000))
+    balances_batch_size_max: int = int(os.getenv("BALANCES_BATCH_SIZE_MAX", 10_000))
+    # Merge concurrent writes to the same account into one DB transaction.
+    write_coalescing: bool = os.getenv("WRITE_COALESCING", "false").lower() in ("true", "1")
+    write_coalescing_max_batch_size: int = int(os.getenv("WRITE_COALESCING_MAX_BATCH_SIZE", 100))
+    write_coalescing_max_wait_ms: float = float(os.getenv("WRITE_COALESCING_MAX_WAIT_MS", 2))
+
+    # How often a balance snapshot is written: "every_transaction", "every_n" or "interval".
+    # Balances as of a timestamp are rebuilt from the last snapshot plus the transactions after it.
+    snapshot_mode: SnapshotMode = SnapshotMode(os.getenv("SNAPSHOT_MODE", "every_transaction"))
+    snapshot_every_n: int = int(os.getenv("SNAPSHOT_EVERY_N", 10))
+    snapshot_interval_seconds: float = float(os.getenv("SNAPSHOT_INTERVAL_SECONDS", 60))
+
+    # Cache of current balances: "none", "memory" (per worker) or "redis" (shared by all workers).
+    # Memory entries live at most balance_cache_ttl_seconds, which bounds how stale
+    # a worker can be about writes served by another worker.
+    balance_cache: BalanceCacheBackend = BalanceCacheBackend(os.getenv("BALANCE_CACHE", "none"))
+    balance_cache_size: int = int(os.getenv("BALANCE_CACHE_SIZE", 100_000))
+    balance_cache_ttl_seconds: float = float(os.getenv("BALANCE_CACHE_TTL_SECONDS", 5))
+    balance_cache_url: str = os.getenv("BALANCE_CACHE_URL", "redis://localhost:6379/0")
+
+    # Cache of transactions and past balances, which never change once read. 0 disables it.
+    result_cache_max_bytes: int = int(os.getenv("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    # How long "not found" answers are cached, the row may be created in the meantime.
+    result_cache_negative_ttl_seconds: float = float(os.getenv("RESULT_CACHE_NEGATIVE_TTL_SECONDS", 5))
+
+    # Prometheus metrics at /metrics, see app.metrics.
+    metrics_enabled: bool = os.getenv("METRICS", "true").lower() in ("true", "1")
+
+    # Request profiling, see app.profiling. Off unless a sample rate or a token is set:
+    # a share of requests is profiled, and requests sending "X-Profile: <token>" are.
+    profiling_sample_rate: float = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+    profiling_token: str = os.getenv("PROFILING_TOKEN", "")
+    profiling_dir: str = os.getenv("PROFILING_DIR", "profiles")
+    # Older profiles are deleted from PROFILING_DIR beyond this many.
+    profiling_max_files: int = int(os.getenv("PROFILING_MAX_FILES", 1000))
+
+    # GET /health/ready fails while more of the pool than this is checked out,
+    # or when SELECT 1 takes longer than the max latency, see app.health.
+    health_pool_saturation_max: float = float(os.getenv("HEALTH_POOL_SATURATION_MAX", 0.9))
+    health_db_latency_max_ms: float = float(os.getenv("HEALTH_DB_LATENCY_MAX_MS", 250))
+    health_check_cache_seconds: float = float(os.getenv("HEALTH_CHECK_CACHE_SECONDS", 1))
+    # The pre-stop hook `python -m app.health drain` creates the file, failing readiness of every
+    # worker, and waits the grace period before the shutdown goes on.
+    health_drain_file: str = os.getenv("HEALTH_DRAIN_FILE", "/tmp/balance-service.draining")  # noqa: S108
+    health_drain_grace_seconds: float = float(os.getenv("HEALTH_DRAIN_GRACE_SECONDS", 10))
+
+    # Push balance changes to GET /api/users/{id}/balance/stream, see app.streams.balances.
+    # Each worker holds one more DB connection, outside the pool, to LISTEN.
+    balance_stream: bool = os.getenv("BALANCE_STREAM", "false").lower() in ("true", "1")
+
+    # Transaction events for other services (the ad engine), see app.outbox.dispatcher.
+    # "none" writes no events, "memory" keeps them in the worker (local runs), "webhook" POSTs batches.
+    outbox_sink: OutboxSinkBackend = OutboxSinkBackend(os.getenv("OUTBOX_SINK", "none"))
+    outbox_webhook_url: str = os.getenv("OUTBOX_WEBHOOK_URL", "http://localhost:8080/events")
+    outbox_webhook_timeout_seconds: float = float(os.getenv("OUTBOX_WEBHOOK_TIMEOUT_SECONDS", 5))
+    outbox_batch_size: int = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+    # How long an idle dispatcher waits before polling the outbox again.
+    outbox_poll_interval_seconds: float = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", 0.5))
+    # Failed batches are retried after backoff * 2 ** (attempts - 1), capped at the max.
+    outbox_retry_backoff_seconds: float = float(os.getenv("OUTBOX_RETRY_BACKOFF_SECONDS", 1))
+    outbox_retry_backoff_max_seconds: float = float(os.getenv("OUTBOX_RETRY_BACKOFF_MAX_SECONDS", 300))
+
+    def db_pool_limits(self) -> tuple[int, int]:
+        """Pool size and overflow of one worker, shrunk to its share of db_max_connections."""
+        budget = max(self.db_max_connections // max(self.app_workers, 1), 1)
+        pool_size = min(self.db_pool_size, budget)
+        max_overflow = min(self.db_max_overflow, budget - pool_size)
+        return pool_size, max_overflow
+
+    def commit_horizon(self) -> timedelta:
+        """Age after which every transaction stamped before it has committed, see app.repositories.payments."""
+        if self.db_statement_timeout_ms <= 0:
+            raise ValueError("DB_STATEMENT_TIMEOUT_MS must be set: without it commits have no horizon")
+        return timedelta(milliseconds=self.db_statement_timeout_ms, seconds=self.commit_horizon_margin_seconds)
 
     class Config:
         env_file = ".env"
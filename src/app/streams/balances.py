@@ -0,0 +1,158 @@
+"""Balance changes pushed to subscribers, BALANCE_STREAM.
+
+Write paths call pg_notify on the balance_changes channel inside the DB
+transaction of the change, Postgres delivers the notification on commit and
+never for a rolled back transaction. Notifications carry the new balance when
+the writer knows it; ledger mode writers do not, their notifications carry the
+user ID only and the balance is read once per notification and worker.
+
+Each worker runs one BalanceChangeHub: one dedicated connection LISTENs for
+every user, and notifications are fanned out in process to the subscribers of
+that user. Subscribers hold a one-slot queue that keeps the latest balance
+only, a slow client skips intermediate balances instead of buffering them.
+
+Notifying takes a database-wide lock at commit, which serializes the commits
+of notifying transactions. Enable it when the polling it replaces costs more.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import typing
+import uuid
+
+from app.money import MoneyValue
+
+logger = logging.getLogger(__name__)
+
+BALANCE_CHANGES_CHANNEL: typing.Final = "balance_changes"
+# How often the idle listener connection is checked, a dead one is replaced.
+LISTENER_PING_INTERVAL: typing.Final = 30.0
+LISTENER_RECONNECT_INTERVAL: typing.Final = 1.0
+
+FetchBalance = typing.Callable[[uuid.UUID], typing.Awaitable[MoneyValue]]
+Connect = typing.Callable[[], typing.Awaitable[typing.Any]]
+
+
+def balance_change_payload(user_id: uuid.UUID, balance: MoneyValue | None = None) -> str:
+    """Notification payload, without a balance when the writer does not know it."""
+    message: dict[str, str] = {"user_id": str(user_id)}
+    if balance is not None:
+        message["balance"] = str(balance)
+    return json.dumps(message)
+
+
+class BalanceStreamStats:
+    def __init__(self) -> None:
+        self.connects = 0
+        self.notifications = 0
+        # Notifications without a balance, or a reconnect, that required reading it.
+        self.refreshes = 0
+        self.published = 0
+        # Balances replaced in a subscriber queue before the subscriber read them.
+        self.conflated = 0
+
+    def as_dict(self, subscribers: int) -> dict[str, int]:
+        return {
+            "subscribers": subscribers,
+            "connects": self.connects,
+            "notifications": self.notifications,
+            "refreshes": self.refreshes,
+            "published": self.published,
+            "conflated": self.conflated,
+        }
+
+
+class BalanceChangeHub:
+    def __init__(self, connect: Connect, fetch_balance: FetchBalance):
+        self.connect = connect
+        self.fetch_balance = fetch_balance
+        self.stats = BalanceStreamStats()
+        self._subscribers: dict[uuid.UUID, set[asyncio.Queue[MoneyValue]]] = {}
+        self._refreshing: dict[uuid.UUID, asyncio.Task[None]] = {}
+        self._stale: set[uuid.UUID] = set()
+
+    @contextlib.contextmanager
+    def subscribe(self, user_id: uuid.UUID) -> typing.Iterator[asyncio.Queue[MoneyValue]]:
+        """Queue receiving the user's balance after every committed change."""
+        queue: asyncio.Queue[MoneyValue] = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self._subscribers[user_id]
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def subscriber_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except Exception:
+                logger.exception("Balance change listener failed")
+            await asyncio.sleep(LISTENER_RECONNECT_INTERVAL)
+
+    async def _listen(self) -> None:
+        connection = await self.connect()
+        try:
+            await connection.add_listener(BALANCE_CHANGES_CHANNEL, self._on_notification)
+            self.stats.connects += 1
+            # Changes committed while nobody listened were missed, read them instead.
+            for user_id in list(self._subscribers):
+                self._schedule_refresh(user_id)
+            while not connection.is_closed():
+                await asyncio.sleep(LISTENER_PING_INTERVAL)
+                await connection.fetchval("SELECT 1")
+        finally:
+            if not connection.is_closed():
+                await connection.close()
+
+    def _on_notification(self, connection: typing.Any, pid: int, channel: str, payload: str) -> None:
+        self.stats.notifications += 1
+        message = json.loads(payload)
+        user_id = uuid.UUID(message["user_id"])
+        if user_id not in self._subscribers:
+            return
+        if "balance" not in message:
+            self._schedule_refresh(user_id)
+            return
+        if user_id in self._refreshing:
+            # The read in flight may predate this change, it reads again once done.
+            self._stale.add(user_id)
+        self._publish(user_id, MoneyValue(message["balance"]))
+
+    def _schedule_refresh(self, user_id: uuid.UUID) -> None:
+        if user_id in self._refreshing:
+            self._stale.add(user_id)
+            return
+        self._refreshing[user_id] = asyncio.create_task(self._refresh(user_id))
+
+    async def _refresh(self, user_id: uuid.UUID) -> None:
+        try:
+            while True:
+                self._stale.discard(user_id)
+                self.stats.refreshes += 1
+                balance = await self.fetch_balance(user_id)
+                self._publish(user_id, balance)
+                if user_id not in self._stale:
+                    return
+        except Exception:
+            logger.exception("Reading the balance of %s failed", user_id)
+        finally:
+            del self._refreshing[user_id]
+
+    def _publish(self, user_id: uuid.UUID, balance: MoneyValue) -> None:
+        for queue in self._subscribers.get(user_id, ()):
+            if queue.full():
+                queue.get_nowait()
+                self.stats.conflated += 1
+            queue.put_nowait(balance)
+            self.stats.published += 1
+
+    async def close(self) -> None:
+        for task in list(self._refreshing.values()):
+            task.cancel()
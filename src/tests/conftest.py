@@ -1,17 +1,23 @@
 import os
 import uuid
+from decimal import Decimal
 
 import dotenv
 import pytest
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
+from app.enums import TransactionType
 from app.models import Base
 from app.repositories import PaymentRepository
-from app.schemas import UserCreate
+from app.schemas import TransactionCreate, UserCreate
 
 dotenv.load_dotenv()
 
 
+def make_transaction(user_id, amount, transaction_type=TransactionType.DEPOSIT):
+    return TransactionCreate(id=uuid.uuid4(), user_id=user_id, amount=Decimal(amount), type=transaction_type)
+
+
 @pytest.fixture(scope="function")
 async def db_session():
     engine = create_async_engine(os.getenv("TEST_DATABASE_URL"), echo=True, future=True)
@@ -34,4 +40,4 @@ async def user(db_session) -> UserCreate:
     user_data = UserCreate(id=uuid.uuid4(), name="Test User")
     await repo.create_user(user_data)
 
-    return user_data
\ No newline at end of file
+    return user_data
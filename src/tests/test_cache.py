@@ -0,0 +1,221 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+import sqlalchemy as sa
+
+from app.cache.balances import CachedBalance, InMemoryBalanceCache, RedisBalanceCache
+from app.cache.results import MISSING, ResultCache, approximate_size
+from app.enums import TransactionType, WriteMode
+from app.exceptions import UserNotExistsError
+from app.repositories import PaymentRepository
+from app.repositories.payments import COMMIT_HORIZON
+from tests.conftest import make_transaction
+
+
+def count_statements(db_session):
+    statements = []
+    sa.event.listen(
+        db_session.kw["bind"].sync_engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    return statements
+
+
+@pytest.fixture
+def redis_cache():
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisBalanceCache(fakeredis.FakeAsyncRedis(), ttl=60)
+
+
+class TestInMemoryBalanceCache:
+    @pytest.mark.asyncio
+    async def test_success_keeps_newest_version(self):
+        cache = InMemoryBalanceCache(max_size=10, ttl=60)
+        user_id = uuid.uuid4()
+
+        await cache.set(user_id, Decimal('10'), 2)
+        await cache.set(user_id, Decimal('5'), 1)
+
+        assert (await cache.get(user_id)).balance == Decimal('10')
+        assert await cache.get(uuid.uuid4()) is None
+        stats = cache.stats.as_dict()
+        assert (stats["sets"], stats["stale_sets"], stats["hits"], stats["misses"]) == (1, 1, 1, 1)
+
+    @pytest.mark.asyncio
+    async def test_success_evicts_least_recently_used(self):
+        cache = InMemoryBalanceCache(max_size=2, ttl=60)
+        first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+        await cache.set(first, Decimal('1'), 1)
+        await cache.set(second, Decimal('2'), 1)
+        await cache.get(first)
+        await cache.set(third, Decimal('3'), 1)
+
+        assert await cache.get(second) is None
+        assert await cache.get(first) is not None
+        assert cache.stats.evictions == 1
+
+    @pytest.mark.asyncio
+    async def test_success_expires_entries(self):
+        cache = InMemoryBalanceCache(max_size=10, ttl=60)
+        user_id = uuid.uuid4()
+        await cache._set(user_id, CachedBalance(Decimal('1'), 1, time.time() - 61))
+
+        assert await cache.get(user_id) is None
+        assert cache.stats.expirations == 1
+
+
+class TestRedisBalanceCache:
+    @pytest.mark.asyncio
+    async def test_success_keeps_newest_version(self, redis_cache):
+        user_id = uuid.uuid4()
+
+        await redis_cache.set(user_id, Decimal('10.50'), 2)
+        await redis_cache.set(user_id, Decimal('5.00'), 1)
+
+        cached = await redis_cache.get(user_id)
+        assert (cached.balance, cached.version) == (Decimal('10.50'), 2)
+        assert redis_cache.stats.stale_sets == 1
+        assert await redis_cache.get(uuid.uuid4()) is None
+
+
+class TestCachedBalances:
+    @pytest.mark.asyncio
+    async def test_success_reads_through(self, db_session, user):
+        repo = PaymentRepository(db_session, balance_cache=InMemoryBalanceCache(max_size=10, ttl=60))
+        statements = count_statements(db_session)
+
+        assert await repo.get_user_balance(user.id) == Decimal(0)
+        assert await repo.get_user_balance(user.id) == Decimal(0)
+
+        assert len(statements) == 1
+        assert repo.balance_cache.stats.as_dict()["hit_ratio"] == 0.5
+
+    @pytest.mark.parametrize("write", [WriteMode.LOCKING, WriteMode.ATOMIC, "bulk"])
+    @pytest.mark.parametrize("backend", ["memory", "redis"])
+    @pytest.mark.asyncio
+    async def test_success_writes_update_cache(self, db_session, user, write, backend, request):
+        cache = InMemoryBalanceCache(max_size=10, ttl=60) if backend == "memory" else request.getfixturevalue(
+            "redis_cache")
+        write_mode = write if isinstance(write, WriteMode) else WriteMode.LOCKING
+        repo = PaymentRepository(db_session, write_mode=write_mode, balance_cache=cache)
+        assert await repo.get_user_balance(user.id) == Decimal(0)
+
+        for amount, transaction_type in (('100', TransactionType.DEPOSIT), ('30', TransactionType.WITHDRAW)):
+            transaction = make_transaction(user.id, amount, transaction_type)
+            if write == "bulk":
+                await repo.create_transactions_bulk([transaction])
+            else:
+                await repo.create_transaction(transaction)
+
+        cached = await cache.get(user.id)
+        assert (cached.balance, cached.version) == (Decimal('70.00'), 2)
+        # A read that started before the writes can not put its older balance back.
+        await cache.set(user.id, Decimal(0), 0)
+        assert await repo.get_user_balance(user.id) == Decimal('70.00')
+
+    @pytest.mark.asyncio
+    async def test_success_cache_failure_falls_back_to_db(self, db_session, user):
+        class BrokenCache(InMemoryBalanceCache):
+            async def _get(self, user_id):
+                raise ConnectionError
+
+            async def _set(self, user_id, entry):
+                raise ConnectionError
+
+        repo = PaymentRepository(db_session, balance_cache=BrokenCache(max_size=10, ttl=60))
+
+        await repo.create_transaction(make_transaction(user.id, '10'))
+
+        assert await repo.get_user_balance(user.id) == Decimal('10')
+        assert repo.balance_cache.stats.errors == 3
+
+    @pytest.mark.asyncio
+    async def test_fail_unknown_user_is_not_cached(self, db_session):
+        repo = PaymentRepository(db_session, balance_cache=InMemoryBalanceCache(max_size=10, ttl=60))
+        user_id = uuid.uuid4()
+
+        for _ in range(2):
+            with pytest.raises(UserNotExistsError):
+                await repo.get_user_balance(user_id)
+        assert repo.balance_cache.stats.misses == 2
+
+
+class TestResultCache:
+    def test_success_evicts_by_size(self):
+        value = ("x" * 100,)
+        entry_size = approximate_size(("key", 0)) + approximate_size(value)
+        cache = ResultCache(max_bytes=entry_size * 2, negative_ttl=60)
+
+        for i in range(3):
+            cache.set(("key", i), value)
+
+        assert cache.get(("key", 0)) is MISSING
+        assert cache.get(("key", 2)) == value
+        stats = cache.stats()
+        assert (stats["entries"], stats["evictions"]) == (2, 1)
+        assert stats["size_bytes"] <= stats["max_bytes"]
+
+    def test_success_negative_results_expire(self):
+        cache = ResultCache(max_bytes=1024 * 1024, negative_ttl=0.01)
+        cache.set("missing", None)
+
+        assert cache.get("missing") is None
+        time.sleep(0.02)
+        assert cache.get("missing") is MISSING
+        stats = cache.stats()
+        assert (stats["negative_hits"], stats["expirations"], stats["size_bytes"]) == (1, 1, 0)
+
+
+class TestCachedResults:
+    @pytest.mark.asyncio
+    async def test_success_transactions_served_from_memory(self, db_session, user):
+        repo = PaymentRepository(db_session, result_cache=ResultCache(max_bytes=1024 * 1024, negative_ttl=60))
+        transaction = await repo.create_transaction(make_transaction(user.id, '10'))
+        missing_id = uuid.uuid4()
+        statements = count_statements(db_session)
+
+        for _ in range(10):
+            assert (await repo.get_transaction(transaction.id)).amount == Decimal('10')
+            assert await repo.get_transaction(missing_id) is None
+
+        assert len(statements) == 2
+        assert repo.result_cache.stats()["hit_ratio"] == 0.9
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("write_mode", [WriteMode.LOCKING, WriteMode.LEDGER])
+    @pytest.mark.parametrize("bulk", [False, True])
+    async def test_success_created_transaction_is_not_missing(self, db_session, user, write_mode, bulk):
+        repo = PaymentRepository(
+            db_session, write_mode=write_mode, result_cache=ResultCache(max_bytes=1024 * 1024, negative_ttl=60))
+        data = make_transaction(user.id, '10')
+        assert await repo.get_transaction(data.id) is None
+
+        if bulk:
+            await repo.create_transactions_bulk([data])
+        else:
+            await repo.create_transaction(data)
+
+        assert (await repo.get_transaction(data.id)).amount == Decimal('10')
+
+    @pytest.mark.asyncio
+    async def test_success_only_final_balances_are_cached(self, db_session, user):
+        repo = PaymentRepository(db_session, result_cache=ResultCache(max_bytes=1024 * 1024, negative_ttl=60))
+        await repo.create_transaction(make_transaction(user.id, '10'))
+        past = datetime.utcnow() - COMMIT_HORIZON - timedelta(seconds=1)
+        recent = datetime.utcnow()
+        statements = count_statements(db_session)
+
+        for _ in range(3):
+            assert await repo.get_user_balance(user.id, past) == Decimal(0)
+            assert await repo.get_user_balance(user.id, recent) == Decimal('10')
+            with pytest.raises(UserNotExistsError):
+                await repo.get_user_balance(uuid.uuid4(), past)
+
+        # past and the unknown users once each (two statements), recent on every call
+        past_reads, unknown_reads, recent_reads = 2, 3, 3 * 2
+        assert len(statements) == past_reads + unknown_reads + recent_reads
@@ -0,0 +1,79 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+import sqlalchemy as sa
+
+from app.enums import TransactionType
+from app.exceptions import InsufficientFundsError, TransactionAlreadyExistsError
+from app.repositories import PaymentRepository
+from app.repositories.coalescing import WriteCoalescer
+from tests.conftest import make_transaction
+
+
+def make_repo(db_session, max_batch_size=100, max_wait=0.01):
+    coalescer = WriteCoalescer(
+        apply_batch=PaymentRepository(db_session).create_transactions_bulk,
+        max_batch_size=max_batch_size,
+        max_wait=max_wait,
+    )
+    return PaymentRepository(db_session, write_coalescer=coalescer), coalescer
+
+
+class TestWriteCoalescer:
+    @pytest.mark.asyncio
+    async def test_success_merges_concurrent_writes(self, db_session, user):
+        repo, _ = make_repo(db_session)
+        locks = []
+        sa.event.listen(
+            db_session.kw["bind"].sync_engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: "FOR UPDATE" in statement and locks.append(statement),
+        )
+
+        transactions = await asyncio.gather(*(repo.create_transaction(make_transaction(user.id, '1.00'))
+                                              for _ in range(20)))
+
+        assert len({t.id for t in transactions}) == 20
+        assert len(locks) == 1
+        assert await repo.get_user_balance(user.id) == Decimal('20.00')
+
+    @pytest.mark.asyncio
+    async def test_success_errors_resolved_per_caller_in_arrival_order(self, db_session, user):
+        repo, _ = make_repo(db_session)
+        deposit = make_transaction(user.id, '10.00')
+
+        results = await asyncio.gather(
+            repo.create_transaction(make_transaction(user.id, '5.00', TransactionType.WITHDRAW)),
+            repo.create_transaction(deposit),
+            repo.create_transaction(deposit),
+            repo.create_transaction(make_transaction(user.id, '5.00', TransactionType.WITHDRAW)),
+            return_exceptions=True,
+        )
+
+        assert isinstance(results[0], InsufficientFundsError)
+        assert results[1].id == deposit.id
+        assert isinstance(results[2], TransactionAlreadyExistsError)
+        assert results[3].amount == Decimal('5.00')
+        assert await repo.get_user_balance(user.id) == Decimal('5.00')
+
+    @pytest.mark.asyncio
+    async def test_success_max_batch_size(self, db_session, user):
+        repo, coalescer = make_repo(db_session, max_batch_size=3, max_wait=10)
+        batches = []
+        apply_batch = coalescer.apply_batch
+
+        async def record_batch(items):
+            batches.append(len(items))
+            return await apply_batch(items)
+
+        coalescer.apply_batch = record_batch
+
+        await asyncio.wait_for(
+            asyncio.gather(*(repo.create_transaction(make_transaction(user.id, '1.00')) for _ in range(6))),
+            timeout=5,
+        )
+        await coalescer.close()
+
+        assert batches == [3, 3]
+        assert await repo.get_user_balance(user.id) == Decimal('6.00')
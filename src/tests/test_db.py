@@ -0,0 +1,117 @@
+import asyncio
+import os
+from datetime import timedelta
+
+import pytest
+import sqlalchemy as sa
+
+from app.db.base import create_engine, get_db, get_engine, warm_up_pool
+from app.enums import WriteMode
+from app.models import Transaction, TransactionKey
+from app.repositories import PaymentRepository
+from app.settings import Settings
+
+
+@pytest.fixture(scope="function")
+async def engine():
+    settings = Settings()
+    settings.db_dsn = os.getenv("TEST_DATABASE_URL")
+    settings.app_workers = 1
+    settings.db_pool_size = 2
+    settings.db_max_overflow = 1
+    settings.db_statement_timeout_ms = 1234
+    engine = create_engine(settings)
+
+    yield engine
+
+    await engine.dispose()
+
+
+class TestEngine:
+    @pytest.mark.asyncio
+    async def test_success_server_settings(self, engine):
+        async with engine.connect() as conn:
+            statement_timeout = await conn.scalar(sa.text("SHOW statement_timeout"))
+
+        assert statement_timeout == "1234ms"
+
+    @pytest.mark.asyncio
+    async def test_success_pool_stats(self, engine):
+        async def hold_connection(release: asyncio.Event):
+            async with engine.connect() as conn:
+                await conn.execute(sa.text("SELECT 1"))
+                await release.wait()
+
+        release = asyncio.Event()
+        holders = [asyncio.create_task(hold_connection(release)) for _ in range(3)]
+        await asyncio.sleep(0.2)
+        stats = engine.pool.stats()
+        release.set()
+        await asyncio.gather(*holders)
+
+        assert stats["checked_out"] == 3
+        assert stats["overflow"] == 1
+        assert stats["saturation"] == 1.0
+        assert engine.pool.stats()["checkouts"] == 3
+        assert engine.pool.stats()["checked_out"] == 0
+
+    @pytest.mark.parametrize("placeholder", [get_engine, get_db])
+    @pytest.mark.asyncio
+    async def test_fail_placeholder_outside_app_builder(self, placeholder):
+        with pytest.raises(RuntimeError, match="AppBuilder"):
+            await placeholder()
+
+
+class TestPoolWarmUp:
+    @pytest.mark.parametrize("write_mode", list(WriteMode))
+    @pytest.mark.asyncio
+    async def test_success_prepares_without_writing(self, db_session, engine, write_mode):
+        async def prepare(session_maker):
+            await PaymentRepository(session_maker, write_mode=write_mode).warm_up()
+
+        await warm_up_pool(engine, 2, prepare)
+
+        assert engine.pool.stats()["checked_in"] == 2
+        assert engine.pool.stats()["checkouts"] == 2
+        async with engine.connect() as first, engine.connect() as second:
+            for conn in (first, second):
+                assert await conn.scalar(sa.text("SELECT count(*) FROM pg_prepared_statements")) >= 3
+            assert await first.scalar(sa.select(sa.func.count()).select_from(Transaction)) == 0
+            assert await first.scalar(sa.select(sa.func.count()).select_from(TransactionKey)) == 0
+        assert engine.pool.stats()["checkouts"] == 4
+
+
+class TestPoolLimits:
+    @pytest.mark.parametrize(
+        ("workers", "max_connections", "expected"),
+        [
+            (1, 90, (10, 5)),
+            (8, 90, (10, 1)),
+            (16, 90, (5, 0)),
+            (200, 90, (1, 0)),
+        ],
+    )
+    def test_success_pool_fits_connection_budget(self, workers, max_connections, expected):
+        settings = Settings()
+        settings.app_workers = workers
+        settings.db_max_connections = max_connections
+        settings.db_pool_size = 10
+        settings.db_max_overflow = 5
+
+        assert settings.db_pool_limits() == expected
+
+
+class TestCommitHorizon:
+    def test_success_follows_statement_timeout(self):
+        settings = Settings()
+        settings.db_statement_timeout_ms = 90_000
+        settings.commit_horizon_margin_seconds = 30
+
+        assert settings.commit_horizon() == timedelta(minutes=2)
+
+    def test_fail_without_statement_timeout(self):
+        settings = Settings()
+        settings.db_statement_timeout_ms = 0
+
+        with pytest.raises(ValueError, match="DB_STATEMENT_TIMEOUT_MS"):
+            settings.commit_horizon()
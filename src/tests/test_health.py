@@ -0,0 +1,124 @@
+import asyncio
+import os
+
+import fastapi
+import httpx
+import pytest
+
+from app.api import health
+from app.db.base import create_engine
+from app.db.resources import get_readiness_probe
+from app.enums import ReadinessState
+from app.health import ReadinessProbe, drain
+from app.settings import Settings
+
+
+@pytest.fixture
+async def engine():
+    settings = Settings()
+    settings.db_dsn = os.getenv("TEST_DATABASE_URL")
+    settings.db_pool_size, settings.db_max_overflow = 2, 0
+    engine = create_engine(settings)
+    yield engine
+    await engine.dispose()
+
+
+def make_probe(engine, pool_saturation_max=0.9, db_latency_max=1.0, cache_ttl=0.0, drain_file=None):
+    probe = ReadinessProbe(pool_saturation_max, db_latency_max, cache_ttl, drain_file)
+    probe.engine = engine
+    probe.state = ReadinessState.READY
+    return probe
+
+
+def make_client(probe):
+    app = fastapi.FastAPI()
+    app.include_router(health.ROUTER)
+    app.dependency_overrides[get_readiness_probe] = lambda: probe
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+
+class TestReadinessProbe:
+    @pytest.mark.asyncio
+    async def test_success_ready(self, engine):
+        report = await make_probe(engine).check()
+
+        assert report["ready"] and report["state"] == "ready"
+        assert report["checks"]["pool"]["ok"] and report["checks"]["db"]["latency_ms"] >= 0
+
+    @pytest.mark.parametrize("state", [ReadinessState.STARTING, ReadinessState.DRAINING])
+    @pytest.mark.asyncio
+    async def test_fail_starting_or_draining(self, engine, state):
+        probe = make_probe(engine)
+        probe.state = state
+
+        assert await probe.check() == {"ready": False, "state": state.value, "checks": {}}
+
+    @pytest.mark.asyncio
+    async def test_fail_pool_saturated(self, engine):
+        probe = make_probe(engine, pool_saturation_max=0.5)
+
+        async with engine.connect() as conn:
+            await conn.exec_driver_sql("SELECT 1")
+            report = await probe.check()
+
+        assert not report["ready"]
+        assert report["checks"]["pool"] == {"ok": False, "saturation": 0.5, "checked_out": 1, "checkout_timeouts": 0}
+        assert report["checks"]["db"]["error"] == "skipped, pool saturated"
+        assert (await probe.check())["ready"]
+
+    @pytest.mark.asyncio
+    async def test_fail_slow_db(self, engine):
+        probe = make_probe(engine, db_latency_max=0.2)
+
+        async with engine.connect() as first, engine.connect() as second:
+            await first.exec_driver_sql("SELECT 1")
+            await second.exec_driver_sql("SELECT 1")
+            # Both connections are taken, the ping waits for one.
+            probe.pool_saturation_max = 2
+            report = await probe.check()
+
+        assert not report["ready"]
+        assert report["checks"]["db"] == {"ok": False, "error": "no reply within 200 ms"}
+
+    @pytest.mark.asyncio
+    async def test_success_cached(self, engine):
+        probe = make_probe(engine, cache_ttl=60)
+
+        reports = await asyncio.gather(*(probe.check() for _ in range(5)))
+
+        assert all(report is reports[0] for report in reports)
+
+
+class TestHealthApi:
+    @pytest.mark.asyncio
+    async def test_success_endpoints(self, engine):
+        probe = make_probe(engine)
+        probe.state = ReadinessState.STARTING
+        app = fastapi.FastAPI()
+        app.include_router(health.ROUTER)
+        app.dependency_overrides[get_readiness_probe] = lambda: probe
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            assert (await client.get("/health/live")).json() == {"status": "ok"}
+            assert (await client.get("/health/ready")).status_code == 503
+            probe.state = ReadinessState.READY
+            ready = await client.get("/health/ready")
+
+        assert ready.status_code == 200 and ready.json()["ready"]
+
+    @pytest.mark.asyncio
+    async def test_success_drain(self, engine, tmp_path):
+        settings = Settings()
+        settings.health_drain_file = str(tmp_path / "draining")
+        settings.health_drain_grace_seconds = 0
+        # One probe per worker, all of them watch the same file.
+        clients = [make_client(make_probe(engine, drain_file=settings.health_drain_file)) for _ in range(2)]
+
+        assert [(await client.get("/health/ready")).status_code for client in clients] == [200, 200]
+        drain(settings)
+        responses = [await client.get("/health/ready") for client in clients]
+        for client in clients:
+            await client.aclose()
+
+        assert [response.status_code for response in responses] == [503, 503]
+        assert [response.json()["state"] for response in responses] == ["draining", "draining"]
@@ -0,0 +1,214 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+import sqlalchemy as sa
+
+from app.enums import TransactionType, WriteMode
+from app.exceptions import (
+    InsufficientFundsError,
+    TransactionAlreadyExistsError,
+    TransactionAmountZeroError,
+    UserNotExistsError,
+)
+from app.models import LedgerCheckpoint, Transaction, User
+from app.repositories import PaymentRepository
+from app.repositories.ledger import LEDGER_CHECKPOINT_LOCK_ID, LedgerCheckpointer
+from tests.conftest import make_transaction
+
+
+def make_checkpointer(db_session, horizon=timedelta(0)):
+    repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+    return LedgerCheckpointer(db_session, repo.checkpoint_ledger, interval=0, horizon=horizon)
+
+
+class TestLedgerWrites:
+    @pytest.mark.asyncio
+    async def test_success_balance_is_derived(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+
+        deposit = await repo.create_transaction(make_transaction(user.id, '100.00'))
+        withdrawal = await repo.create_transaction(make_transaction(user.id, '30.00', TransactionType.WITHDRAW))
+
+        assert 0 < deposit.seq < withdrawal.seq
+        assert await repo.get_user_balance(user.id) == Decimal('70.00')
+        assert (await repo.get_transaction(withdrawal.id)).seq == withdrawal.seq
+        async with db_session() as session:
+            stored = await session.get(User, user.id)
+        # Nothing is folded into the users row until a checkpoint.
+        assert (stored.balance, stored.ledger_seq) == (Decimal(0), 0)
+
+    @pytest.mark.asyncio
+    async def test_fail_errors(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+
+        with pytest.raises(UserNotExistsError):
+            await repo.create_transaction(make_transaction(uuid.uuid4(), '0'))
+        with pytest.raises(UserNotExistsError):
+            await repo.create_transaction(make_transaction(uuid.uuid4(), '1'))
+        with pytest.raises(UserNotExistsError):
+            await repo.create_transaction(make_transaction(uuid.uuid4(), '1', TransactionType.WITHDRAW))
+        with pytest.raises(TransactionAmountZeroError):
+            await repo.create_transaction(make_transaction(user.id, '0'))
+        with pytest.raises(InsufficientFundsError):
+            await repo.create_transaction(make_transaction(user.id, '1', TransactionType.WITHDRAW))
+
+        deposit = make_transaction(user.id, '5')
+        await repo.create_transaction(deposit)
+        with pytest.raises(TransactionAlreadyExistsError):
+            await repo.create_transaction(deposit)
+        with pytest.raises(TransactionAlreadyExistsError):
+            await repo.create_transaction(deposit.model_copy(update={"type": TransactionType.WITHDRAW}))
+
+        assert await repo.get_user_balance(user.id) == Decimal('5')
+        with pytest.raises(UserNotExistsError):
+            await repo.get_user_balance(uuid.uuid4())
+
+    @pytest.mark.asyncio
+    async def test_success_deposits_do_not_wait_for_withdrawals(self, db_session, user):
+        ledger_repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        locking_repo = PaymentRepository(db_session)
+
+        async with db_session() as session, session.begin():
+            # Held the way a ledger withdrawal holds it.
+            await session.get(User, user.id, with_for_update={"key_share": True})
+
+            await asyncio.wait_for(ledger_repo.create_transaction(make_transaction(user.id, '1')), 5)
+            with pytest.raises(TimeoutError):
+                await asyncio.wait_for(locking_repo.create_transaction(make_transaction(user.id, '1')), 0.5)
+
+        assert await ledger_repo.get_user_balance(user.id) == Decimal('1')
+
+    @pytest.mark.asyncio
+    async def test_success_concurrent_withdrawals_never_overdraw(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        await repo.create_transaction(make_transaction(user.id, '100'))
+
+        results = await asyncio.gather(
+            *(repo.create_transaction(make_transaction(user.id, '30', TransactionType.WITHDRAW)) for _ in range(5)),
+            *(repo.create_transaction(make_transaction(user.id, '1')) for _ in range(5)),
+            return_exceptions=True,
+        )
+
+        withdrawn = sum(isinstance(r, Transaction) for r in results[:5])
+        assert all(isinstance(r, (Transaction, InsufficientFundsError)) for r in results)
+        assert withdrawn == 3
+        assert await repo.get_user_balance(user.id) == Decimal(100 - 30 * withdrawn + 5)
+
+    @pytest.mark.asyncio
+    async def test_success_bulk(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        depositor = uuid.uuid4()
+        await repo.create_user(user.model_copy(update={"id": depositor}))
+        duplicate = make_transaction(user.id, '10')
+        items = [
+            make_transaction(user.id, '50'),
+            make_transaction(user.id, '60', TransactionType.WITHDRAW),
+            make_transaction(user.id, '20', TransactionType.WITHDRAW),
+            duplicate,
+            duplicate,
+            make_transaction(depositor, '7'),
+            make_transaction(uuid.uuid4(), '1'),
+            make_transaction(user.id, '0'),
+        ]
+
+        results = await repo.create_transactions_bulk(items)
+
+        assert [type(r) for r in results] == [
+            Transaction, InsufficientFundsError, Transaction, Transaction, TransactionAlreadyExistsError,
+            Transaction, UserNotExistsError, TransactionAmountZeroError,
+        ]
+        seqs = [r.seq for r in results if isinstance(r, Transaction)]
+        assert seqs == sorted(seqs)
+        balances = {user_id: balance async for user_id, balance in repo.get_user_balances([user.id, depositor])}
+        assert balances == {user.id: Decimal('40'), depositor: Decimal('7')}
+
+
+class TestLedgerCheckpointer:
+    @pytest.mark.asyncio
+    async def test_success_folds_tails(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        checkpointer = make_checkpointer(db_session)
+        for amount in ('100', '-30', '5'):
+            await repo.create_transaction(make_transaction(
+                user.id, amount.lstrip('-'),
+                TransactionType.WITHDRAW if amount.startswith('-') else TransactionType.DEPOSIT,
+            ))
+        before_checkpoint = datetime.utcnow()
+
+        assert await checkpointer.checkpoint() == 1
+        assert await checkpointer.checkpoint() == 0
+        await repo.create_transaction(make_transaction(user.id, '1'))
+
+        async with db_session() as session:
+            stored = await session.get(User, user.id)
+        assert stored.balance == Decimal('75')
+        assert stored.ledger_seq > 0
+        assert await repo.get_user_balance(user.id) == Decimal('76')
+        snapshots = await repo.get_user_snapshots(user.id)
+        assert [s.balance for s in snapshots] == [Decimal('75')]
+        assert await repo.get_user_balance(user.id, before_checkpoint) == Decimal('75')
+
+    @pytest.mark.asyncio
+    async def test_success_skips_unsettled_transactions(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        checkpointer = make_checkpointer(db_session, horizon=timedelta(seconds=0.2))
+        await repo.create_transaction(make_transaction(user.id, '10'))
+
+        assert await checkpointer.checkpoint() == 0
+        await repo.create_transaction(make_transaction(user.id, '5'))
+        await asyncio.sleep(0.25)
+        # Folds up to the first sample only, the second deposit came after it.
+        assert await checkpointer.checkpoint() == 1
+
+        async with db_session() as session:
+            stored = await session.get(User, user.id)
+        assert stored.balance == Decimal('10')
+        assert await repo.get_user_balance(user.id) == Decimal('15')
+
+    @pytest.mark.asyncio
+    async def test_success_workers_share_the_position(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        first, second = make_checkpointer(db_session), make_checkpointer(db_session)
+        await repo.create_transaction(make_transaction(user.id, '10'))
+
+        assert await first.checkpoint() == 1
+        # Resumes from the stored position instead of folding the same transactions again.
+        assert await second.checkpoint() == 0
+        await repo.create_transaction(make_transaction(user.id, '5'))
+        assert await second.checkpoint() == 1
+        assert await first.checkpoint() == 0
+
+        async with db_session() as session:
+            stored = await session.get(User, user.id)
+            assert await session.scalar(sa.select(LedgerCheckpoint.folded_seq)) == stored.ledger_seq
+        assert stored.balance == Decimal('15')
+
+    @pytest.mark.asyncio
+    async def test_success_one_worker_folds_at_a_time(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        checkpointer = make_checkpointer(db_session)
+        await repo.create_transaction(make_transaction(user.id, '10'))
+
+        async with db_session() as session:
+            async with session.begin():
+                await session.execute(sa.select(sa.func.pg_advisory_xact_lock(LEDGER_CHECKPOINT_LOCK_ID)))
+                assert await checkpointer.checkpoint() == 0
+        assert await checkpointer.checkpoint() == 1
+
+    @pytest.mark.asyncio
+    async def test_success_other_modes_after_final_checkpoint(self, db_session, user):
+        ledger_repo = PaymentRepository(db_session, write_mode=WriteMode.LEDGER)
+        await ledger_repo.create_transaction(make_transaction(user.id, '10'))
+        await make_checkpointer(db_session).checkpoint()
+
+        locking_repo = PaymentRepository(db_session)
+        await locking_repo.create_transaction(make_transaction(user.id, '4', TransactionType.WITHDRAW))
+
+        assert await locking_repo.get_user_balance(user.id) == Decimal('6')
+        assert await ledger_repo.get_user_balance(user.id) == Decimal('6')
+        async with db_session() as session:
+            seqs = (await session.scalars(sa.select(Transaction.seq).order_by(Transaction.created_at))).all()
+        assert seqs[0] is not None and seqs[1] is None
@@ -0,0 +1,91 @@
+import os
+import uuid
+
+import fastapi
+import httpx
+import pytest
+
+from app.db.base import create_engine
+from app.enums import TransactionType, WriteMode
+from app.exceptions import InsufficientFundsError
+from app.metrics import Metrics, MetricsMiddleware
+from app.repositories import PaymentRepository
+from app.settings import Settings
+from tests.conftest import make_transaction
+
+
+@pytest.fixture
+def metrics(db_session):
+    metrics = Metrics()
+    metrics.instrument_engine(db_session.kw["bind"])
+    return metrics
+
+
+class TestDbMetrics:
+    @pytest.mark.parametrize(("write_mode", "lock"), [
+        (WriteMode.LOCKING, "for_update"),
+        (WriteMode.LEDGER, "for_no_key_update"),
+    ])
+    @pytest.mark.asyncio
+    async def test_success_row_lock_wait(self, db_session, user, metrics, write_mode, lock):
+        repo = PaymentRepository(db_session, write_mode=write_mode)
+        await repo.create_transaction(make_transaction(user.id, '10'))
+        await repo.create_transaction(make_transaction(user.id, '1', TransactionType.WITHDRAW))
+
+        expected_locks = 2 if write_mode == WriteMode.LOCKING else 1
+        assert metrics.registry.get_sample_value("db_row_lock_wait_seconds_count", {"lock": lock}) == expected_locks
+        assert metrics.registry.get_sample_value("db_query_duration_seconds_count", {"operation": "SELECT"}) >= 2
+
+    @pytest.mark.asyncio
+    async def test_success_pool_stats(self):
+        settings = Settings()
+        settings.db_dsn = os.getenv("TEST_DATABASE_URL")
+        engine = create_engine(settings)
+        metrics = Metrics()
+        metrics.instrument_engine(engine)
+        try:
+            async with engine.connect() as conn:
+                await conn.exec_driver_sql("SELECT 1")
+                exposition = metrics.render().decode()
+        finally:
+            await engine.dispose()
+
+        assert f'db_pool_checked_out{{pid="{os.getpid()}"}} 1.0' in exposition
+        assert f'db_pool_checkout_wait_seconds_count{{pid="{os.getpid()}"}} 1.0' in exposition
+
+
+class TestMetricsMiddleware:
+    @pytest.mark.asyncio
+    async def test_success_requests_by_route_with_db_time(self, db_session, user, metrics):
+        app = fastapi.FastAPI()
+        app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+        @app.get("/users/{user_id}/balance")
+        async def get_balance(user_id: uuid.UUID) -> dict:
+            return {"balance": str(await PaymentRepository(db_session).get_user_balance(user_id))}
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            for _ in range(2):
+                assert (await client.get(f"/users/{user.id}/balance")).status_code == 200
+            assert (await client.get("/missing")).status_code == 404
+
+        route = {"method": "GET", "route": "/users/{user_id}/balance"}
+        sample = metrics.registry.get_sample_value
+        assert sample("http_request_duration_seconds_count", {**route, "status": "200"}) == 2
+        assert sample("http_request_duration_seconds_count",
+                      {"method": "GET", "route": "<unmatched>", "status": "404"}) == 1
+        assert sample("http_request_db_queries_sum", route) == 2
+        assert sample("http_request_db_duration_seconds_sum", route) > 0
+
+
+class TestBusinessMetrics:
+    def test_success_transaction_outcomes(self):
+        metrics = Metrics()
+
+        metrics.observe_transaction(TransactionType.DEPOSIT, object())
+        metrics.observe_transaction(TransactionType.WITHDRAW, InsufficientFundsError("Insufficient funds"))
+        metrics.observe_transaction(TransactionType.WITHDRAW, InsufficientFundsError("Insufficient funds"))
+
+        sample = metrics.registry.get_sample_value
+        assert sample("transactions_total", {"type": "DEPOSIT", "outcome": "created"}) == 1
+        assert sample("transactions_total", {"type": "WITHDRAW", "outcome": "insufficient_funds"}) == 2
@@ -0,0 +1,108 @@
+import contextlib
+import uuid
+from datetime import date
+
+import pytest
+import sqlalchemy as sa
+
+from app.db.migrations import (
+    backfill_in_batches,
+    create_index_concurrently,
+    drop_index_concurrently,
+    include_object,
+    set_not_null,
+)
+from app.db.partitions import create_partitions
+
+
+@contextlib.asynccontextmanager
+async def autocommit(db_session):
+    async with db_session.kw["bind"].connect() as conn:
+        yield await conn.execution_options(isolation_level="AUTOCOMMIT")
+
+
+async def index_states(conn, name):
+    rows = await conn.execute(sa.text("""
+        SELECT table_class.relname, index_class.relname, pg_index.indisvalid
+        FROM pg_index
+        JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+        JOIN pg_class table_class ON table_class.oid = pg_index.indrelid
+        WHERE pg_index.indexrelid = to_regclass(:name)
+            OR pg_index.indexrelid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(:name))
+    """), {"name": name})
+    return {table: (index, valid) for table, index, valid in rows}
+
+
+class TestIndexes:
+    @pytest.mark.asyncio
+    async def test_success_partitioned(self, db_session):
+        async with autocommit(db_session) as conn:
+            await conn.run_sync(create_partitions, 0, date(2030, 1, 1))
+            # Left over by an interrupted run: built on one partition, not attached.
+            await conn.execute(sa.text("CREATE INDEX ix_transactions_amount ON ONLY transactions (amount)"))
+            await conn.execute(sa.text(
+                "CREATE INDEX transactions_2030_01_amount ON transactions_2030_01 (amount)"))
+
+            for _ in range(2):
+                await conn.run_sync(create_index_concurrently, "ix_transactions_amount", "transactions", ["amount"])
+            states = await index_states(conn, "ix_transactions_amount")
+
+        assert states == {
+            "transactions": ("ix_transactions_amount", True),
+            "transactions_2030_01": ("transactions_2030_01_amount", True),
+            "transactions_default": ("transactions_default_amount", True),
+        }
+
+    @pytest.mark.asyncio
+    async def test_success_plain_table_and_drop(self, db_session):
+        async with autocommit(db_session) as conn:
+            await conn.run_sync(create_index_concurrently, "ix_users_name", "users", ["name"], "balance > 0")
+            created = await index_states(conn, "ix_users_name")
+            await conn.run_sync(create_index_concurrently, "ix_transactions_amount", "transactions", ["amount"])
+
+            for name in ("ix_users_name", "ix_transactions_amount", "ix_missing"):
+                await conn.run_sync(drop_index_concurrently, name)
+            dropped = await conn.scalar(sa.text(
+                "SELECT count(*) FROM pg_class WHERE relname LIKE '%\\_amount' OR relname = 'ix_users_name'"))
+
+        assert created == {"users": ("ix_users_name", True)}
+        assert dropped == 0
+
+
+class TestBackfills:
+    @pytest.mark.asyncio
+    async def test_success_in_batches_then_not_null(self, db_session):
+        async with autocommit(db_session) as conn:
+            # As created by the migrations before they matched the models.
+            await conn.execute(sa.text("ALTER TABLE users ALTER COLUMN transactions_since_snapshot DROP NOT NULL"))
+            await conn.execute(
+                sa.text("INSERT INTO users (id, name, created_at, transactions_since_snapshot) "
+                        "VALUES (:id, 'u', now(), NULL)"),
+                [{"id": uuid.uuid4()} for _ in range(25)],
+            )
+            backfilled = await conn.run_sync(backfill_in_batches, sa.text("""
+                UPDATE users SET transactions_since_snapshot = 0
+                WHERE id IN (SELECT id FROM users WHERE transactions_since_snapshot IS NULL LIMIT :batch_size)
+            """), 10)
+            await conn.run_sync(set_not_null, "users", "transactions_since_snapshot")
+            nullable = await conn.scalar(sa.text("""
+                SELECT is_nullable FROM information_schema.columns
+                WHERE table_name = 'users' AND column_name = 'transactions_since_snapshot'
+            """))
+
+        assert backfilled == 25
+        assert nullable == "NO"
+
+    @pytest.mark.asyncio
+    async def test_fail_in_transaction(self, db_session):
+        async with db_session.kw["bind"].connect() as conn:
+            with pytest.raises(RuntimeError):
+                await conn.run_sync(backfill_in_batches, sa.text("SELECT 1"))
+
+
+class TestAutogenerate:
+    def test_success_partitions_excluded(self):
+        assert not include_object(None, "transactions_2030_01", "table", True, None)
+        assert not include_object(None, "balances_snapshots_default", "table", True, None)
+        assert include_object(None, "transactions", "table", True, object())
+        assert include_object(None, "users_archive", "table", True, None)
@@ -0,0 +1,169 @@
+import os
+import subprocess
+import sys
+import textwrap
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+import pydantic
+import pytest
+import sqlalchemy as sa
+
+from app.db.money import MONEY_COLUMNS, prepare_column, swap_columns
+from app.enums import MoneyRepresentation
+from app.money import MinorUnits, MinorUnitsInput, format_minor_units, to_minor_units
+from app.settings import Settings
+
+
+class TestMinorUnits:
+    @pytest.mark.parametrize("value, expected", [
+        (10, 1000),
+        (10.05, 1005),
+        (0.1, 10),
+        ("10.05", 1005),
+        ("10.5", 1050),
+        ("10.500", 1050),
+        ("-0.01", -1),
+        (Decimal("10.05"), 1005),
+        (Decimal("1E+2"), 10000),
+    ])
+    def test_success_to_minor_units(self, value, expected):
+        assert to_minor_units(value) == expected
+
+    @pytest.mark.parametrize("value", ["10.005", 10.005, "1e2", "", "abc", True, None])
+    def test_fail_to_minor_units(self, value):
+        with pytest.raises(ValueError):
+            to_minor_units(value)
+
+    @pytest.mark.parametrize("value, expected", [(1005, "10.05"), (0, "0.00"), (-1, "-0.01"), (10000, "100.00")])
+    def test_success_format(self, value, expected):
+        assert format_minor_units(value) == expected
+
+    def test_success_api_types(self):
+        assert pydantic.TypeAdapter(MinorUnitsInput).validate_json('10.05') == 1005
+        assert pydantic.TypeAdapter(MinorUnitsInput).validate_python("0.5") == 50
+        assert pydantic.TypeAdapter(MinorUnits).dump_json(1005) == b'"10.05"'
+        assert pydantic.TypeAdapter(MinorUnits).dump_python(1005) == 1005
+        with pytest.raises(pydantic.ValidationError):
+            pydantic.TypeAdapter(MinorUnitsInput).validate_json('"10.001"')
+
+
+# Runs in a fresh interpreter, models and schemas pick the money types at import time.
+MINOR_UNITS_SCENARIO = textwrap.dedent("""
+    import asyncio
+    import os
+    import uuid
+
+    import pydantic_core
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    from app import schemas
+    from app.enums import TransactionType, WriteMode
+    from app.models import Base
+    from app.repositories import PaymentRepository
+
+
+    async def main():
+        engine = create_async_engine(os.environ["TEST_DATABASE_URL"])
+        session_maker = async_sessionmaker(engine, expire_on_commit=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        try:
+            for write_mode in WriteMode:
+                repo = PaymentRepository(session_maker, write_mode=write_mode)
+                user = schemas.UserCreate(id=uuid.uuid4(), name="Test User")
+                await repo.create_user(user)
+
+                def item(amount, type_):
+                    return schemas.TransactionCreate.model_validate_json(
+                        f'{{"id": "{uuid.uuid4()}", "user_id": "{user.id}", "amount": {amount}, "type": "{type_}"}}')
+
+                deposit = await repo.create_transaction(item('"10.05"', "DEPOSIT"))
+                await repo.create_transaction(item("0.05", "WITHDRAW"))
+                await repo.create_transactions_bulk([item("1", "DEPOSIT"), item("1.5", "WITHDRAW")])
+                balance = await repo.get_user_balance(user.id)
+
+                assert balance == 950, (write_mode, balance)
+                assert deposit.amount == 1005, (write_mode, deposit.amount)
+                assert pydantic_core.to_json(schemas.UserBalance(balance=balance)) == b'{"balance":"9.50"}'
+                assert schemas.Transaction.model_validate(deposit).model_dump(mode="json")["amount"] == "10.05"
+        finally:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.drop_all)
+            await engine.dispose()
+
+
+    asyncio.run(main())
+""")
+
+
+class TestMinorUnitsMode:
+    def test_success_write_modes(self):
+        result = subprocess.run(
+            [sys.executable, "-c", MINOR_UNITS_SCENARIO],
+            env={**os.environ, "MONEY_REPRESENTATION": MoneyRepresentation.MINOR_UNITS.value},
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+
+
+AMOUNTS = {MoneyRepresentation.DECIMAL: Decimal("10.05"), MoneyRepresentation.MINOR_UNITS: 1005}
+
+
+async def swap(engine, target):
+    async with engine.begin() as conn:
+        swapped = await conn.run_sync(swap_columns, target)
+    # Statements prepared before the swap are invalid, like in every worker after it.
+    await engine.dispose()
+    return swapped
+
+
+async def money_values(engine, user_id):
+    async with engine.connect() as conn:
+        return [
+            await conn.scalar(sa.text(f"SELECT {column} FROM {table} WHERE {key} = :user_id"), {"user_id": user_id})
+            for (table, column, *_), key in zip(MONEY_COLUMNS, ("id", "user_id", "user_id"))
+        ]
+
+
+class TestConversion:
+    @pytest.mark.asyncio
+    async def test_success_round_trip(self, db_session, user):
+        current = Settings.money_representation
+        other = next(representation for representation in MoneyRepresentation if representation != current)
+        engine = db_session.kw["bind"]
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(sa.text("UPDATE users SET balance = :amount WHERE id = :id"),
+                               {"amount": AMOUNTS[current], "id": user.id})
+            await conn.execute(sa.text("""
+                INSERT INTO transactions (id, user_id, amount, type, created_at)
+                VALUES (:id, :user_id, :amount, 'DEPOSIT', :created_at)
+            """), {"id": uuid.uuid4(), "user_id": user.id, "amount": AMOUNTS[current], "created_at": datetime.utcnow()})
+
+            for money_column in MONEY_COLUMNS[:2]:
+                assert await conn.run_sync(prepare_column, money_column, other, 1)
+            # Written by a writer still running in the current representation: converted by the trigger.
+            await conn.execute(sa.text("""
+                INSERT INTO balances_snapshots (user_id, balance, created_at) VALUES (:user_id, :amount, :created_at)
+            """), {"user_id": user.id, "amount": AMOUNTS[current], "created_at": datetime.utcnow()})
+            assert await conn.run_sync(prepare_column, MONEY_COLUMNS[2], other, 1)
+            assert not await conn.run_sync(prepare_column, MONEY_COLUMNS[0], current)
+
+        assert len(await swap(engine, other)) == 3
+        assert await money_values(engine, user.id) == [AMOUNTS[other]] * 3
+
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            for money_column in MONEY_COLUMNS:
+                await conn.run_sync(prepare_column, money_column, current)
+        assert len(await swap(engine, current)) == 3
+        assert not await swap(engine, current)
+        assert await money_values(engine, user.id) == [AMOUNTS[current]] * 3
+        async with engine.connect() as conn:
+            default = await conn.scalar(sa.text(
+                "SELECT column_default FROM information_schema.columns "
+                "WHERE table_name = 'users' AND column_name = 'balance'"))
+        assert default is not None
@@ -0,0 +1,181 @@
+import asyncio
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import httpx
+import pytest
+import sqlalchemy as sa
+
+from app.enums import TransactionType, WriteMode
+from app.exceptions import InsufficientFundsError
+from app.models import OutboxEvent
+from app.outbox.dispatcher import OutboxDispatcher
+from app.outbox.sinks import MemorySink, WebhookSink
+from app.repositories import PaymentRepository
+from app.repositories.payments import TRANSACTION_CREATED_EVENT
+from tests.conftest import make_transaction
+
+
+def make_dispatcher(db_session, sink, batch_size=100):
+    return OutboxDispatcher(
+        db_session, sink, batch_size=batch_size, poll_interval=0, retry_backoff=60, retry_backoff_max=600)
+
+
+async def get_events(db_session):
+    async with db_session() as session:
+        return (await session.scalars(sa.select(OutboxEvent).order_by(OutboxEvent.id))).all()
+
+
+class FailingSink(MemorySink):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    async def publish(self, events):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("sink is down")
+        await super().publish(events)
+
+
+class TestOutboxWrites:
+    @pytest.mark.parametrize("write", [WriteMode.LOCKING, WriteMode.ATOMIC, WriteMode.LEDGER, "bulk", "ledger_bulk"])
+    @pytest.mark.asyncio
+    async def test_success_one_event_per_transaction(self, db_session, user, write):
+        write_mode = {"bulk": WriteMode.LOCKING, "ledger_bulk": WriteMode.LEDGER}.get(write, write)
+        repo = PaymentRepository(db_session, write_mode=write_mode, outbox=True)
+        items = [
+            make_transaction(user.id, '100'),
+            make_transaction(user.id, '500', TransactionType.WITHDRAW),
+            make_transaction(user.id, '30', TransactionType.WITHDRAW),
+        ]
+
+        if isinstance(write, str):
+            results = await repo.create_transactions_bulk(items)
+        else:
+            results = []
+            for item in items:
+                try:
+                    results.append(await repo.create_transaction(item))
+                except InsufficientFundsError as e:
+                    results.append(e)
+
+        created = [r for r in results if not isinstance(r, Exception)]
+        assert [t.amount for t in created] == [Decimal('100'), Decimal('30')]
+        events = await get_events(db_session)
+        assert [e.event_type for e in events] == [TRANSACTION_CREATED_EVENT] * 2
+        assert [e.payload for e in events] == [
+            {
+                "id": str(t.id),
+                "user_id": str(user.id),
+                "amount": str(t.amount),
+                "type": t.type.name,
+                "created_at": t.created_at.isoformat(),
+            }
+            for t in created
+        ]
+        assert all(e.available_at == e.created_at for e in events)
+
+    @pytest.mark.asyncio
+    async def test_success_disabled_by_default(self, db_session, user):
+        for write_mode in WriteMode:
+            await PaymentRepository(db_session, write_mode=write_mode).create_transaction(
+                make_transaction(user.id, '1'))
+
+        assert await get_events(db_session) == []
+
+
+class TestOutboxDispatcher:
+    @pytest.mark.asyncio
+    async def test_success_publishes_and_deletes(self, db_session, user):
+        repo = PaymentRepository(db_session, outbox=True)
+        transactions = [await repo.create_transaction(make_transaction(user.id, '1')) for _ in range(5)]
+        sink = MemorySink()
+        dispatcher = make_dispatcher(db_session, sink, batch_size=2)
+
+        assert [await dispatcher.dispatch() for _ in range(4)] == [2, 2, 1, 0]
+
+        assert [m["payload"]["id"] for m in sink.messages] == [str(t.id) for t in transactions]
+        assert len({m["id"] for m in sink.messages}) == 5
+        assert await get_events(db_session) == []
+        stats = dispatcher.stats.as_dict()
+        assert (stats["batches"], stats["published"], stats["failed_batches"]) == (3, 5, 0)
+
+    @pytest.mark.asyncio
+    async def test_fail_batch_is_retried_after_backoff(self, db_session, user):
+        repo = PaymentRepository(db_session, outbox=True)
+        await repo.create_transaction(make_transaction(user.id, '1'))
+        sink = FailingSink(failures=1)
+        dispatcher = make_dispatcher(db_session, sink)
+
+        assert await dispatcher.dispatch() == 1
+        # Not due before the backoff passed.
+        assert await dispatcher.dispatch() == 0
+        [event] = await get_events(db_session)
+        assert event.attempts == 1
+        assert "sink is down" in event.last_error
+        assert event.available_at - datetime.utcnow() > timedelta(seconds=50)
+
+        async with db_session() as session, session.begin():
+            await session.execute(sa.update(OutboxEvent).values(available_at=datetime.utcnow()))
+        assert await dispatcher.dispatch() == 1
+        assert len(sink.messages) == 1
+        assert await get_events(db_session) == []
+        assert dispatcher.stats.failed_events == 1
+
+    def test_success_backoff_is_capped(self, db_session):
+        dispatcher = make_dispatcher(db_session, MemorySink())
+
+        assert dispatcher._backoff(1) == timedelta(seconds=60)
+        assert dispatcher._backoff(2) == timedelta(seconds=120)
+        assert dispatcher._backoff(10_000) == timedelta(seconds=600)
+
+    @pytest.mark.asyncio
+    async def test_success_concurrent_dispatchers_skip_claimed_events(self, db_session, user):
+        repo = PaymentRepository(db_session, outbox=True)
+        await repo.create_transactions_bulk([make_transaction(user.id, '1') for _ in range(4)])
+        published = []
+
+        class SlowSink(MemorySink):
+            async def publish(self, events):
+                await asyncio.sleep(0.2)
+                published.extend(event.id for event in events)
+
+        dispatchers = [make_dispatcher(db_session, SlowSink(), batch_size=2) for _ in range(2)]
+
+        assert await asyncio.wait_for(asyncio.gather(*(d.dispatch() for d in dispatchers)), 1) == [2, 2]
+        assert len(published) == len(set(published)) == 4
+
+
+class TestWebhookSink:
+    @pytest.mark.asyncio
+    async def test_success_posts_batch(self, db_session, user):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(204)
+
+        await PaymentRepository(db_session, outbox=True).create_transaction(make_transaction(user.id, '1'))
+        sink = WebhookSink(httpx.AsyncClient(transport=httpx.MockTransport(handler)), "http://ads/events")
+
+        assert await make_dispatcher(db_session, sink).dispatch() == 1
+
+        [request] = requests
+        assert request.url == "http://ads/events"
+        [message] = httpx.Response(200, content=request.content).json()
+        assert message["type"] == TRANSACTION_CREATED_EVENT
+        assert message["payload"]["user_id"] == str(user.id)
+
+    @pytest.mark.asyncio
+    async def test_fail_error_status_fails_batch(self, db_session, user):
+        await PaymentRepository(db_session, outbox=True).create_transaction(make_transaction(user.id, '1'))
+        sink = WebhookSink(
+            httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(503))), "http://ads/events")
+        dispatcher = make_dispatcher(db_session, sink)
+
+        await dispatcher.dispatch()
+
+        [event] = await get_events(db_session)
+        assert event.attempts == 1
+        assert dispatcher.stats.failed_batches == 1
@@ -0,0 +1,58 @@
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+import sqlalchemy as sa
+
+from app.db.partitions import create_partitions, detach_partitions, list_partitions, month_start
+from app.enums import TransactionType
+from app.models import Transaction, TransactionKey
+from app.repositories import PaymentRepository
+
+
+class TestPartitions:
+    def test_success_month_start(self):
+        assert month_start(date(2030, 1, 31)) == date(2030, 1, 1)
+        assert month_start(date(2030, 1, 31), 13) == date(2031, 2, 1)
+        assert month_start(date(2030, 1, 1), -1) == date(2029, 12, 1)
+
+    @pytest.mark.asyncio
+    async def test_success_create_and_detach(self, db_session, user):
+        engine = db_session.kw["bind"]
+        async with engine.begin() as conn:
+            created = await conn.run_sync(create_partitions, 2, date(2030, 1, 15))
+            assert await conn.run_sync(create_partitions, 2, date(2030, 1, 15)) == []
+            partitions = await conn.run_sync(list_partitions, "transactions")
+
+        assert sorted(created) == sorted(
+            f"{table}_2030_{month:02}" for table in ("transactions", "balances_snapshots") for month in (1, 2, 3)
+        )
+        assert sorted(partitions) == [date(2030, 1, 1), date(2030, 2, 1), date(2030, 3, 1)]
+
+        async with db_session() as session, session.begin():
+            for amount, created_at in [(1, datetime(2030, 1, 20)), (2, datetime(2030, 3, 5))]:
+                transaction_id = uuid.uuid4()
+                session.add(TransactionKey(id=transaction_id, created_at=created_at))
+                session.add(Transaction(id=transaction_id, user_id=user.id, amount=Decimal(amount),
+                                        type=TransactionType.DEPOSIT, created_at=created_at))
+        async with db_session() as session:
+            location = await session.scalar(
+                sa.select(sa.literal_column("tableoid::regclass::text")).select_from(Transaction)
+                .where(Transaction.created_at == datetime(2030, 1, 20))
+            )
+        assert location == "transactions_2030_01"
+
+        async with engine.begin() as conn:
+            detached = await conn.run_sync(detach_partitions, 2, "archive", date(2030, 4, 10))
+            archived = await conn.scalar(sa.text("SELECT to_regclass('archive.transactions_2030_01')::text"))
+            await conn.execute(sa.text("DROP SCHEMA archive CASCADE"))
+
+        assert sorted(detached) == ["balances_snapshots_2030_01", "transactions_2030_01"]
+        assert archived == "archive.transactions_2030_01"
+        # Carried forward to the cutoff: later balances still include the detached deposit.
+        repo = PaymentRepository(db_session)
+        assert await repo.get_user_balance(user.id, ts=datetime(2030, 2, 1)) == Decimal(1)
+        assert await repo.get_user_balance(user.id, ts=datetime(2030, 3, 10)) == Decimal(3)
+        async with engine.begin() as conn:
+            assert await conn.run_sync(detach_partitions, 2, None, date(2030, 4, 10)) == []
@@ -1,12 +1,20 @@
 import asyncio
+import base64
+import csv
+import io
+import json
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 
+import fastapi
+import httpx
 import pytest
 import sqlalchemy as sa
 
-from app.enums import TransactionType
+from app.api import payments
+from app.db.base import get_db
+from app.enums import TransactionType, WriteMode
 from app.exceptions import (
     TransactionAmountZeroError,
     UserExistsError,
@@ -16,6 +24,7 @@ from app.exceptions import (
 )
 from app.models import BalancesSnapshots, Transaction
 from app.repositories.payments import PaymentRepository
+from app.repositories.snapshots import SnapshotPolicy
 from app.schemas import TransactionCreate, UserCreate
 
 
@@ -315,6 +324,151 @@ class TestCreateTransaction:
             assert count == 1
 
 
+class TestCreateTransactionAtomic:
+    @staticmethod
+    def _transaction(user_id, amount, transaction_type=TransactionType.DEPOSIT):
+        return TransactionCreate(id=uuid.uuid4(), user_id=user_id, amount=Decimal(amount), type=transaction_type)
+
+    @pytest.mark.asyncio
+    async def test_success(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.ATOMIC)
+
+        transaction = await repo.create_transaction(self._transaction(user.id, '100.00'))
+        await repo.create_transaction(self._transaction(user.id, '30.00', TransactionType.WITHDRAW))
+
+        assert await repo.get_user_balance(user.id) == Decimal('70.00')
+        stored = await repo.get_transaction(transaction.id)
+        assert stored.amount == Decimal('100.00')
+        assert stored.created_at == transaction.created_at
+        snapshots = await repo.get_user_snapshots(user.id)
+        assert [s.balance for s in snapshots] == [Decimal('70.00'), Decimal('100.00')]
+
+    @pytest.mark.asyncio
+    async def test_fail_errors(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.ATOMIC)
+
+        with pytest.raises(UserNotExistsError):
+            await repo.create_transaction(self._transaction(uuid.uuid4(), '0'))
+        with pytest.raises(UserNotExistsError):
+            await repo.create_transaction(self._transaction(uuid.uuid4(), '1'))
+        with pytest.raises(TransactionAmountZeroError):
+            await repo.create_transaction(self._transaction(user.id, '0'))
+        with pytest.raises(InsufficientFundsError):
+            await repo.create_transaction(self._transaction(user.id, '1', TransactionType.WITHDRAW))
+
+        deposit = self._transaction(user.id, '5')
+        await repo.create_transaction(deposit)
+        with pytest.raises(TransactionAlreadyExistsError):
+            await repo.create_transaction(deposit)
+
+        assert await repo.get_user_balance(user.id) == Decimal('5')
+        assert len(await repo.get_user_snapshots(user.id)) == 1
+
+    @pytest.mark.asyncio
+    async def test_success_concurrent_withdrawals_and_duplicates(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.ATOMIC)
+        await repo.create_transaction(self._transaction(user.id, '100.00'))
+        withdrawal = self._transaction(user.id, '60.00', TransactionType.WITHDRAW)
+        duplicate = self._transaction(user.id, '10.00')
+
+        results = await asyncio.gather(
+            repo.create_transaction(withdrawal),
+            repo.create_transaction(self._transaction(user.id, '60.00', TransactionType.WITHDRAW)),
+            repo.create_transaction(duplicate),
+            repo.create_transaction(duplicate),
+            return_exceptions=True,
+        )
+
+        assert sum(isinstance(r, InsufficientFundsError) for r in results[:2]) == 1
+        assert sum(isinstance(r, TransactionAlreadyExistsError) for r in results[2:]) == 1
+        assert await repo.get_user_balance(user.id) == Decimal('50.00')
+
+    @pytest.mark.asyncio
+    async def test_success_concurrent_writes_stamped_in_commit_order(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.ATOMIC)
+        first = await repo.create_transaction(self._transaction(user.id, '100.00'))
+
+        results = await asyncio.gather(*(
+            repo.create_transaction(self._transaction(user.id, str(i % 7 + 1), transaction_type))
+            for i, transaction_type in enumerate([TransactionType.DEPOSIT, TransactionType.WITHDRAW] * 20)
+        ))
+
+        signed = {
+            t.created_at: t.amount if t.type == TransactionType.DEPOSIT else -t.amount for t in [first, *results]
+        }
+        assert len(signed) == len(results) + 1
+        for snapshot in await repo.get_user_snapshots(user.id):
+            assert snapshot.balance == sum(amount for stamp, amount in signed.items() if stamp <= snapshot.created_at)
+        balance = await repo.get_user_balance(user.id)
+        assert await repo.get_user_balance(user.id, max(signed)) == balance == sum(signed.values())
+
+class TestCreateTransactionsBulk:
+    @pytest.mark.asyncio
+    async def test_success_mixed_batch(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        other_user = UserCreate(id=uuid.uuid4(), name="Other User")
+        await repo.create_user(other_user)
+        existing = TransactionCreate(
+            id=uuid.uuid4(), user_id=user.id, amount=Decimal('10.00'), type=TransactionType.DEPOSIT
+        )
+        await repo.create_transaction(existing)
+
+        deposit = TransactionCreate(
+            id=uuid.uuid4(), user_id=other_user.id, amount=Decimal('50.00'), type=TransactionType.DEPOSIT
+        )
+        items = [
+            deposit,
+            TransactionCreate(id=uuid.uuid4(), user_id=user.id, amount=Decimal('15.00'),
+                              type=TransactionType.WITHDRAW),
+            TransactionCreate(id=uuid.uuid4(), user_id=other_user.id, amount=Decimal('20.00'),
+                              type=TransactionType.WITHDRAW),
+            existing,
+            deposit,
+            TransactionCreate(id=uuid.uuid4(), user_id=uuid.uuid4(), amount=Decimal('1.00'),
+                              type=TransactionType.DEPOSIT),
+            TransactionCreate(id=uuid.uuid4(), user_id=user.id, amount=Decimal('0'),
+                              type=TransactionType.DEPOSIT),
+        ]
+
+        results = await repo.create_transactions_bulk(items)
+
+        assert [type(r) for r in results] == [
+            Transaction,
+            InsufficientFundsError,
+            Transaction,
+            TransactionAlreadyExistsError,
+            TransactionAlreadyExistsError,
+            UserNotExistsError,
+            TransactionAmountZeroError,
+        ]
+        assert await repo.get_user_balance(user.id) == Decimal('10.00')
+        assert await repo.get_user_balance(other_user.id) == Decimal('30.00')
+        snapshots = await repo.get_user_snapshots(other_user.id)
+        assert [s.balance for s in snapshots] == [Decimal('30.00'), Decimal('50.00')]
+        assert (await repo.get_transaction(deposit.id)).amount == Decimal('50.00')
+
+    @pytest.mark.asyncio
+    async def test_success_concurrent_batches(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        other_user = UserCreate(id=uuid.uuid4(), name="Other User")
+        await repo.create_user(other_user)
+
+        def batch(*user_ids):
+            return [
+                TransactionCreate(id=uuid.uuid4(), user_id=user_id, amount=Decimal('1.00'),
+                                  type=TransactionType.DEPOSIT)
+                for user_id in user_ids
+            ]
+
+        await asyncio.gather(*(
+            repo.create_transactions_bulk(batch(user.id, other_user.id) if i % 2 else batch(other_user.id, user.id))
+            for i in range(10)
+        ))
+
+        assert await repo.get_user_balance(user.id) == Decimal('10.00')
+        assert await repo.get_user_balance(other_user.id) == Decimal('10.00')
+
+
 class TestGetTransaction:
     @pytest.mark.asyncio
     async def test_success_get_existing_transaction(self, db_session, user):
@@ -452,4 +606,239 @@ class TestGetUserBalance:
 
         balance = await repo.get_user_balance(user.id, snapshot_ts)
 
-        assert balance == deposit_amount
\ No newline at end of file
+        assert balance == deposit_amount
+
+class TestGetUserBalances:
+    @staticmethod
+    async def _deposit(repo, user_id, amount, transaction_type=TransactionType.DEPOSIT):
+        await repo.create_transaction(TransactionCreate(
+            id=uuid.uuid4(), user_id=user_id, amount=Decimal(amount), type=transaction_type))
+
+    @pytest.mark.parametrize("policy", [SnapshotPolicy(), SnapshotPolicy(every_n=3)])
+    @pytest.mark.asyncio
+    async def test_success_matches_single_lookups(self, db_session, user, policy):
+        repo = PaymentRepository(db_session, snapshot_policy=policy)
+        other = UserCreate(id=uuid.uuid4(), name="Other User")
+        idle = UserCreate(id=uuid.uuid4(), name="Idle User")
+        await repo.create_user(other)
+        await repo.create_user(idle)
+        before = datetime.utcnow()
+        for amount in ('100', '20', '5'):
+            await self._deposit(repo, user.id, amount)
+        await self._deposit(repo, other.id, '50')
+        middle = datetime.utcnow()
+        await self._deposit(repo, user.id, '30', TransactionType.WITHDRAW)
+        await self._deposit(repo, other.id, '7')
+        unknown_id = uuid.uuid4()
+        user_ids = [user.id, other.id, idle.id, unknown_id, user.id]
+
+        for ts in (None, before, middle, datetime.utcnow()):
+            balances = {user_id: balance async for user_id, balance in repo.get_user_balances(user_ids, ts)}
+
+            assert balances == {
+                user_id: await repo.get_user_balance(user_id, ts) for user_id in (user.id, other.id, idle.id)
+            }
+
+    @pytest.mark.asyncio
+    async def test_success_single_query(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        statements = []
+        sa.event.listen(
+            db_session.kw["bind"].sync_engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        user_ids = [user.id] + [uuid.uuid4() for _ in range(1000)]
+
+        balances = [item async for item in repo.get_user_balances(user_ids, datetime.utcnow())]
+
+        assert balances == [(user.id, Decimal(0))]
+        assert len(statements) == 1
+
+
+class TestUserHistory:
+    @staticmethod
+    async def _make_history(repo, user_id, count):
+        for _ in range(count):
+            await repo.create_transaction(TransactionCreate(
+                id=uuid.uuid4(),
+                user_id=user_id,
+                amount=Decimal('1.00'),
+                type=TransactionType.DEPOSIT
+            ))
+
+    @staticmethod
+    def _count_statements(db_session):
+        statements = []
+        sa.event.listen(
+            db_session.kw["bind"].sync_engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        return statements
+
+    @pytest.mark.asyncio
+    async def test_success_pagination(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        await self._make_history(repo, user.id, 5)
+
+        first_page = await repo.get_user_transactions(user.id, limit=3)
+        last = first_page[-1]
+        second_page = await repo.get_user_transactions(user.id, limit=3, before=(last.created_at, last.id))
+        assert len(first_page) == 3
+        assert len(second_page) == 2
+        assert not {t.id for t in first_page} & {t.id for t in second_page}
+        created = [t.created_at for t in [*first_page, *second_page]]
+        assert created == sorted(created, reverse=True)
+
+        snapshots = await repo.get_user_snapshots(user.id, limit=10)
+        assert [s.balance for s in snapshots] == [Decimal(n) for n in range(5, 0, -1)]
+
+    @pytest.mark.asyncio
+    async def test_success_time_range(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        await self._make_history(repo, user.id, 2)
+        since = datetime.utcnow()
+        await self._make_history(repo, user.id, 3)
+        until = datetime.utcnow()
+        await self._make_history(repo, user.id, 1)
+
+        page = await repo.get_user_transactions(user.id, since=since, until=until)
+        exported = [row async for row in repo.stream_user_transactions(user.id, since=since, until=until)]
+
+        assert len(page) == 3
+        assert [row.id for row in exported] == [t.id for t in reversed(page)]
+        assert len([row async for row in repo.stream_user_transactions(user.id)]) == 6
+
+    @pytest.mark.asyncio
+    async def test_fail_history_user_not_exists(self, db_session):
+        repo = PaymentRepository(db_session)
+
+        with pytest.raises(UserNotExistsError):
+            await repo.get_user_transactions(uuid.uuid4())
+        with pytest.raises(UserNotExistsError):
+            await anext(repo.stream_user_transactions(uuid.uuid4()))
+
+    @pytest.mark.asyncio
+    async def test_success_hot_paths_do_not_load_history(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        await self._make_history(repo, user.id, 20)
+        statements = self._count_statements(db_session)
+
+        await repo.get_user_balance(user.id)
+        await self._make_history(repo, user.id, 1)
+
+        history_queries = [
+            s for s in statements
+            if s.lstrip().startswith("SELECT") and "user_id" in s.rsplit("WHERE", 1)[-1]
+        ]
+        assert statements
+        assert history_queries == []
+
+
+class TestUserHistoryApi:
+    @staticmethod
+    def _client(db_session):
+        app = fastapi.FastAPI()
+        app.include_router(payments.ROUTER, prefix="/api")
+        app.dependency_overrides[get_db] = lambda: db_session
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+    @pytest.mark.asyncio
+    async def test_success_cursor_round_trip(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        await TestUserHistory._make_history(repo, user.id, 5)
+
+        pages, cursor = [], None
+        async with self._client(db_session) as client:
+            while True:
+                params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+                response = await client.get(f"/api/users/{user.id}/transactions", params=params)
+                assert response.status_code == 200
+                pages.append([item["id"] for item in response.json()["items"]])
+                cursor = response.json()["next_cursor"]
+                if cursor is None:
+                    break
+
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert [item for page in pages for item in page] == [
+            str(t.id) for t in await repo.get_user_transactions(user.id)]
+
+    @pytest.mark.parametrize("cursor", ["garbage", "!!!", base64.urlsafe_b64encode(b"yesterday 42").decode()])
+    @pytest.mark.asyncio
+    async def test_fail_invalid_cursor(self, db_session, user, cursor):
+        async with self._client(db_session) as client:
+            response = await client.get(f"/api/users/{user.id}/transactions", params={"cursor": cursor})
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Invalid cursor"}
+
+    @pytest.mark.asyncio
+    async def test_success_export(self, db_session, user):
+        repo = PaymentRepository(db_session)
+        await TestUserHistory._make_history(repo, user.id, 3)
+        expected = [str(t.id) for t in reversed(await repo.get_user_transactions(user.id))]
+
+        async with self._client(db_session) as client:
+            ndjson = await client.get(f"/api/users/{user.id}/transactions", params={"export": "ndjson"})
+            exported_csv = await client.get(f"/api/users/{user.id}/transactions", params={"export": "csv"})
+            unknown = await client.get(f"/api/users/{uuid.uuid4()}/transactions", params={"export": "csv"})
+
+        assert ndjson.headers["content-type"] == "application/x-ndjson"
+        rows = [json.loads(line) for line in ndjson.text.splitlines()]
+        assert [row["id"] for row in rows] == expected
+        assert rows[0]["amount"] == "1.00" and rows[0]["type"] == "DEPOSIT"
+        assert exported_csv.headers["content-type"].startswith("text/csv")
+        rows = list(csv.DictReader(io.StringIO(exported_csv.text)))
+        assert [row["id"] for row in rows] == expected
+        assert list(rows[0]) == ["id", "user_id", "amount", "type", "created_at"]
+        assert unknown.status_code == 400
+
+
+class TestSparseSnapshots:
+    @staticmethod
+    async def _apply(repo, write, user_id, amounts):
+        """Apply signed amounts one by one, return the timestamp right after each of them."""
+        timestamps = []
+        for amount in amounts:
+            transaction = TransactionCreate(
+                id=uuid.uuid4(),
+                user_id=user_id,
+                amount=abs(Decimal(amount)),
+                type=TransactionType.DEPOSIT if Decimal(amount) > 0 else TransactionType.WITHDRAW
+            )
+            if write == "bulk":
+                [result] = await repo.create_transactions_bulk([transaction])
+                assert isinstance(result, Transaction)
+            else:
+                await repo.create_transaction(transaction)
+            timestamps.append(datetime.utcnow())
+            await asyncio.sleep(0.01)
+        return timestamps
+
+    @pytest.mark.parametrize("write", [WriteMode.LOCKING, WriteMode.ATOMIC, "bulk"])
+    @pytest.mark.parametrize(
+        ("policy", "expected_snapshots"),
+        [
+            (SnapshotPolicy(every_n=3), 2),
+            (SnapshotPolicy(every_n=None, interval=timedelta(hours=1)), 1),
+            (SnapshotPolicy(), 7),
+        ],
+    )
+    @pytest.mark.asyncio
+    async def test_success_balance_rebuilt_from_sparse_snapshots(
+            self, db_session, user, write, policy, expected_snapshots):
+        write_mode = write if isinstance(write, WriteMode) else WriteMode.LOCKING
+        repo = PaymentRepository(db_session, write_mode=write_mode, snapshot_policy=policy)
+        amounts = ['100', '-30', '10', '-5', '20', '-95', '7']
+        before = datetime.utcnow()
+
+        timestamps = await self._apply(repo, write, user.id, amounts)
+
+        assert len(await repo.get_user_snapshots(user.id)) == expected_snapshots
+        assert await repo.get_user_balance(user.id, before) == Decimal(0)
+        running = Decimal(0)
+        for amount, ts in zip(amounts, timestamps):
+            running += Decimal(amount)
+            assert await repo.get_user_balance(user.id, ts) == running
+        assert await repo.get_user_balance(user.id) == running
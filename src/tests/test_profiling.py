@@ -0,0 +1,110 @@
+import json
+import os
+import uuid
+
+import fastapi
+import httpx
+import pytest
+from fastapi.responses import StreamingResponse
+
+from app.profiling import Profiler, ProfilingMiddleware
+from app.repositories import PaymentRepository
+from app.settings import Settings
+
+
+def make_app(db_session, profiler):
+    profiler.instrument_engine(db_session.kw["bind"])
+    app = fastapi.FastAPI()
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+    @app.get("/users/{user_id}/balance")
+    async def get_balance(user_id: uuid.UUID) -> dict:
+        return {"balance": str(await PaymentRepository(db_session).get_user_balance(user_id))}
+
+    return app
+
+
+def make_client(app):
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+
+class TestProfiling:
+    def test_success_disabled_by_default(self):
+        assert Profiler.from_settings(Settings()) is None
+
+    @pytest.mark.asyncio
+    async def test_success_requested_by_token(self, db_session, user, tmp_path):
+        app = make_app(db_session, Profiler(sample_rate=0, token="secret", directory=str(tmp_path)))
+
+        async with make_client(app) as client:
+            plain = await client.get(f"/users/{user.id}/balance")
+            wrong = await client.get(f"/users/{user.id}/balance", headers={"X-Profile": "guess"})
+            profiled = await client.get(f"/users/{user.id}/balance", headers={"X-Profile": "secret"})
+
+        assert "x-profile-id" not in plain.headers and "x-profile-id" not in wrong.headers
+        assert profiled.json() == plain.json()
+        profile_id = profiled.headers["x-profile-id"]
+        assert sorted(os.listdir(tmp_path)) == [f"{profile_id}.json", f"{profile_id}.prof"]
+        report = json.loads((tmp_path / f"{profile_id}.json").read_text())
+        assert (report["path"], report["status"]) == (f"/users/{user.id}/balance", 200)
+        assert report["db_queries"] == len(report["statements"]) >= 1
+        assert "users" in report["statements"][0]["sql"]
+        assert "get_balance" in report["top_functions"]
+
+    @pytest.mark.asyncio
+    async def test_success_inline(self, db_session, user, tmp_path):
+        app = make_app(db_session, Profiler(sample_rate=0, token="secret", directory=str(tmp_path)))
+
+        async with make_client(app) as client:
+            response = await client.get(
+                f"/users/{user.id}/balance", headers={"X-Profile": "secret", "X-Profile-Output": "inline"})
+
+        report = response.json()
+        assert report["id"] == response.headers["x-profile-id"]
+        assert report["status"] == 200 and report["statements"]
+
+    @pytest.mark.asyncio
+    async def test_success_sampled(self, db_session, user, tmp_path):
+        app = make_app(db_session, Profiler(sample_rate=1, token="", directory=str(tmp_path)))
+
+        async with make_client(app) as client:
+            response = await client.get(f"/users/{user.id}/balance", headers={"X-Profile": ""})
+
+        assert response.status_code == 200
+        assert f"{response.headers['x-profile-id']}.prof" in os.listdir(tmp_path)
+
+    @pytest.mark.asyncio
+    async def test_success_streams_are_profiled_until_they_start(self, db_session, user, tmp_path):
+        profiler = Profiler(sample_rate=0, token="secret", directory=str(tmp_path))
+        app = make_app(db_session, profiler)
+        seen = []
+
+        @app.get("/events")
+        async def events() -> StreamingResponse:
+            async def lines():
+                yield "event: first\n\n"
+                seen.append((profiler.active, len(os.listdir(tmp_path))))
+                await PaymentRepository(db_session).get_user_balance(user.id)
+                yield "event: second\n\n"
+
+            return StreamingResponse(lines(), media_type="text/event-stream")
+
+        async with make_client(app) as client:
+            response = await client.get("/events", headers={"X-Profile": "secret", "X-Profile-Output": "inline"})
+
+        # The body is not replaced, and the profile was saved before it was sent.
+        assert response.text == "event: first\n\nevent: second\n\n"
+        assert seen == [(False, 2)]
+        report = json.loads((tmp_path / f"{response.headers['x-profile-id']}.json").read_text())
+        assert report["status"] == 200 and report["statements"] == []
+
+    @pytest.mark.asyncio
+    async def test_success_keeps_newest_files(self, db_session, user, tmp_path):
+        app = make_app(db_session, Profiler(sample_rate=1, token="", directory=str(tmp_path), max_files=2))
+
+        async with make_client(app) as client:
+            profile_ids = [
+                (await client.get(f"/users/{user.id}/balance")).headers["x-profile-id"] for _ in range(3)]
+
+        assert sorted(os.listdir(tmp_path)) == sorted(
+            f"{profile_id}.{extension}" for profile_id in profile_ids[1:] for extension in ("json", "prof"))
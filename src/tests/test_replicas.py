@@ -0,0 +1,168 @@
+import asyncio
+import os
+import time
+import uuid
+from decimal import Decimal
+
+import fastapi
+import httpx
+import pytest
+import sqlalchemy as sa
+
+from app.api import payments, stats
+from app.application import AppBuilder
+from app.db.base import create_engine, get_db
+from app.db.replicas import CONSISTENCY_TOKEN_HEADER, Replica, ReplicaRouter, parse_lsn
+from app.db.resources import get_replica_router
+from app.repositories import PaymentRepository
+from app.schemas import UserCreate
+from app.settings import Settings
+from tests.conftest import make_transaction
+
+# A streaming replica of TEST_DATABASE_URL, e.g. set up with `pg_basebackup -R`.
+TEST_REPLICA_DATABASE_URL = os.getenv("TEST_REPLICA_DATABASE_URL")
+
+
+@pytest.fixture
+async def replica_engines(request):
+    settings = Settings()
+    settings.db_pool_size, settings.db_max_overflow = 2, 0
+    engines = [create_engine(settings, dsn) for dsn in request.param]
+    yield engines
+    for engine in engines:
+        await engine.dispose()
+
+
+def make_router(db_session, engines, max_lag=1.0):
+    return ReplicaRouter(
+        db_session, [Replica(f"replica-{i}", engine) for i, engine in enumerate(engines)],
+        max_lag=max_lag, check_interval=0.01)
+
+
+class TestReplicaRouter:
+    def test_success_parse_lsn(self):
+        assert parse_lsn("0/16B3748") == 0x16B3748
+        assert parse_lsn("1/0") == 1 << 32
+
+    # A server that is not a standby serves as its own always fresh replica.
+    @pytest.mark.parametrize("replica_engines", [[os.getenv("TEST_DATABASE_URL")] * 2], indirect=True)
+    @pytest.mark.asyncio
+    async def test_success_routes_to_fresh_replicas(self, db_session, replica_engines):
+        router = make_router(db_session, replica_engines)
+        assert router.session_maker() is db_session
+
+        await router.check()
+        chosen = [router.session_maker() for _ in range(4)]
+
+        assert chosen == [replica.session_maker for replica in router.replicas] * 2
+        assert router.session_maker(router.consistency_token()) is db_session
+        assert router.session_maker("not a token") is db_session
+        stats = router.stats()
+        assert stats["primary_reads"] == 3
+        assert [replica["reads"] for replica in stats["replicas"].values()] == [2, 2]
+
+    @pytest.mark.parametrize("replica_engines", [[os.getenv("TEST_DATABASE_URL")]], indirect=True)
+    @pytest.mark.asyncio
+    async def test_success_stale_replica_is_skipped(self, db_session, replica_engines):
+        router = make_router(db_session, replica_engines, max_lag=0.05)
+        await router.check()
+        assert router.session_maker() is not db_session
+
+        await asyncio.sleep(0.1)
+
+        assert router.session_maker() is db_session
+        assert router.stats()["replicas"]["replica-0"]["lag_seconds"] >= 0.1
+
+    @pytest.mark.asyncio
+    async def test_fail_unreachable_replica(self, db_session):
+        settings = Settings()
+        engine = create_engine(settings, "postgresql+asyncpg://postgres@/missing?host=/nonexistent")
+        router = make_router(db_session, [engine])
+        try:
+            await router.check()
+        finally:
+            await engine.dispose()
+
+        assert router.session_maker() is db_session
+        assert router.stats()["replicas"]["replica-0"] == {"reads": 0, "lag_seconds": None, "failed_checks": 1}
+
+    def test_fail_lag_beyond_commit_horizon(self, monkeypatch):
+        monkeypatch.setattr(Settings, "db_replica_max_lag_ms", Settings.commit_horizon_margin_seconds * 1000)
+
+        with pytest.raises(ValueError, match="DB_REPLICA_MAX_LAG_MS"):
+            AppBuilder(replica_dsns=["postgresql+asyncpg://replica/db"])
+
+
+class TestReplicaReads:
+    @pytest.mark.parametrize("replica_engines", [[os.getenv("TEST_DATABASE_URL")]], indirect=True)
+    @pytest.mark.asyncio
+    async def test_success_writes_return_consistency_tokens(self, db_session, user, replica_engines):
+        router = make_router(db_session, replica_engines, max_lag=60)
+        await router.check()
+        app = fastapi.FastAPI()
+        app.include_router(payments.ROUTER, prefix="/api")
+        app.include_router(stats.ROUTER, prefix="/api")
+        app.dependency_overrides[get_db] = lambda: db_session
+        app.dependency_overrides[get_replica_router] = lambda: router
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post("/api/transactions/", json={
+                "id": str(uuid.uuid4()), "user_id": str(user.id), "amount": "10", "type": "DEPOSIT"})
+            token = response.headers[CONSISTENCY_TOKEN_HEADER]
+            assert float(token) <= time.time()
+
+            # Not replayed as of the last check: read from the primary.
+            response = await client.get(f"/api/users/{user.id}/balance/", headers={CONSISTENCY_TOKEN_HEADER: token})
+            assert response.json() == {"balance": "10.00"}
+            await router.check()
+            response = await client.get(f"/api/users/{user.id}/balance/", headers={CONSISTENCY_TOKEN_HEADER: token})
+            assert response.json() == {"balance": "10.00"}
+
+            replica_stats = (await client.get("/api/stats/replicas")).json()
+
+        assert replica_stats["primary_reads"] == 1
+        assert replica_stats["replicas"]["replica-0"]["reads"] == 1
+
+
+@pytest.mark.skipif(TEST_REPLICA_DATABASE_URL is None, reason="TEST_REPLICA_DATABASE_URL is not set")
+class TestStreamingReplica:
+    @pytest.mark.parametrize("replica_engines", [[TEST_REPLICA_DATABASE_URL]], indirect=True)
+    @pytest.mark.asyncio
+    async def test_success_read_your_writes(self, db_session, replica_engines):
+        router = make_router(db_session, replica_engines, max_lag=60)
+        replica = router.replicas[0]
+        # Wait for the schema and the fixtures to be replayed.
+        started_at = time.time()
+        while replica.fresh_as_of < started_at:
+            await router.check()
+            await asyncio.sleep(0.01)
+
+        primary_repo = PaymentRepository(db_session)
+        user = UserCreate(id=uuid.uuid4(), name="Test User")
+        async with replica.engine.connect() as conn:
+            await conn.execute(sa.text("SELECT pg_wal_replay_pause()"))
+            await conn.commit()
+            try:
+                await primary_repo.create_user(user)
+                transaction = await primary_repo.create_transaction(make_transaction(user.id, '10'))
+                token = router.consistency_token()
+                await router.check()
+
+                # Lagging behind the token: the primary serves it.
+                assert router.session_maker(token) is db_session
+                # Without the token the replica serves it, falling back to the primary for what it misses.
+                replica_repo = PaymentRepository(db_session, route_reads=router.session_maker)
+                assert replica_repo.read_session_maker is replica.session_maker
+                assert (await replica_repo.get_transaction(transaction.id)).id == transaction.id
+                assert await replica_repo.get_user_balance(user.id) == Decimal('10')
+                assert await replica_repo.get_user_transactions(user.id) == []
+            finally:
+                await conn.execute(sa.text("SELECT pg_wal_replay_resume()"))
+                await conn.commit()
+
+        while replica.fresh_as_of < float(token):
+            await router.check()
+            await asyncio.sleep(0.01)
+        assert router.session_maker(token) is replica.session_maker
+        replica_repo = PaymentRepository(db_session, route_reads=lambda: router.session_maker(token))
+        assert [t.id for t in await replica_repo.get_user_transactions(user.id)] == [transaction.id]
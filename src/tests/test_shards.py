@@ -0,0 +1,270 @@
+import asyncio
+import os
+import uuid
+from decimal import Decimal
+
+import httpx
+import pytest
+import sqlalchemy as sa
+
+from app.application import AppBuilder
+from app.db.base import create_engine
+from app.db.shards import HashRing, ShardSet, rebalance
+from app.enums import TransactionType, WriteMode
+from app.exceptions import InsufficientFundsError, TransactionAlreadyExistsError, TransactionIdConflictError
+from app.models import Base, Transaction, User
+from app.repositories.sharded import ShardedPaymentRepository, merge
+from app.schemas import UserCreate
+from app.settings import Settings, parse_shard_dsns
+from tests.conftest import make_transaction
+
+# Comma separated databases to shard over, e.g. a few created next to TEST_DATABASE_URL's.
+TEST_SHARD_DATABASE_URLS = [dsn for dsn in os.getenv("TEST_SHARD_DATABASE_URLS", "").split(",") if dsn]
+
+USERS = [uuid.uuid5(uuid.NAMESPACE_OID, str(i)) for i in range(10_000)]
+
+
+class TestHashRing:
+    def test_success_spreads_users(self):
+        ring = HashRing(["a", "b", "c"])
+        placed = [ring.get(user_id) for user_id in USERS]
+
+        assert placed == [HashRing(["c", "b", "a"]).get(user_id) for user_id in USERS]
+        for name in "abc":
+            assert 0.25 < placed.count(name) / len(USERS) < 0.42
+
+    def test_success_new_shard_only_takes_users(self):
+        before, after = HashRing(["a", "b", "c"]), HashRing(["a", "b", "c", "d"])
+
+        moved = [user_id for user_id in USERS if before.get(user_id) != after.get(user_id)]
+
+        assert {after.get(user_id) for user_id in moved} == {"d"}
+        assert 0.18 < len(moved) / len(USERS) < 0.32
+
+    def test_success_parse_shard_dsns(self):
+        assert parse_shard_dsns("a=postgresql://h/db?x=1,b=postgresql://h2/db") == {
+            "a": "postgresql://h/db?x=1", "b": "postgresql://h2/db"}
+        assert parse_shard_dsns("") == {}
+
+    @pytest.mark.parametrize("value", ["postgresql://h/db", "=postgresql://h/db", "a="])
+    def test_fail_parse_shard_dsns(self, value):
+        with pytest.raises(ValueError):
+            parse_shard_dsns(value)
+
+    def test_fail_unsupported_options(self):
+        with pytest.raises(ValueError, match="DATABASE_REPLICA_URLS"):
+            AppBuilder(replica_dsns=["postgresql+asyncpg://replica/db"], shard_dsns={"a": "postgresql+asyncpg://a/db"})
+
+
+class TestMerge:
+    @pytest.mark.asyncio
+    async def test_success_interleaves(self):
+        async def numbers(start, delay):
+            for i in range(start, start + 3):
+                await asyncio.sleep(delay)
+                yield i
+
+        assert sorted([i async for i in merge([numbers(0, 0.01), numbers(10, 0)])]) == [0, 1, 2, 10, 11, 12]
+
+    @pytest.mark.asyncio
+    async def test_fail_error_cancels_the_others(self):
+        closed = asyncio.Event()
+
+        async def endless():
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield 0
+            finally:
+                closed.set()
+
+        async def failing():
+            yield 1
+            raise RuntimeError("shard down")
+
+        with pytest.raises(RuntimeError, match="shard down"):
+            async for _ in merge([endless(), failing()]):
+                pass
+        assert closed.is_set()
+
+
+@pytest.fixture
+async def shard_engines():
+    settings = Settings()
+    settings.db_pool_size, settings.db_max_overflow = 2, 0
+    engines = {f"shard-{i}": create_engine(settings, dsn) for i, dsn in enumerate(TEST_SHARD_DATABASE_URLS)}
+    for engine in engines.values():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    yield engines
+    for engine in engines.values():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await engine.dispose()
+
+
+async def stored_users(engines):
+    placed = {}
+    for name, engine in engines.items():
+        async with engine.connect() as conn:
+            placed.update({user_id: name for user_id in await conn.scalars(sa.select(User.id))})
+    return placed
+
+
+async def create_users(repo, count):
+    # Fixed IDs, placed on every shard.
+    users = [UserCreate(id=user_id, name="Test User") for user_id in USERS[:count]]
+    for user in users:
+        await repo.create_user(user)
+        await repo.create_transaction(make_transaction(user.id, '10'))
+    return users
+
+
+@pytest.mark.skipif(len(TEST_SHARD_DATABASE_URLS) < 3, reason="TEST_SHARD_DATABASE_URLS needs 3 databases")
+class TestShardedRepository:
+    @pytest.mark.asyncio
+    async def test_success_routes_by_user(self, shard_engines):
+        shards = ShardSet.from_engines(shard_engines)
+        repo = ShardedPaymentRepository(shards)
+        users = await create_users(repo, 12)
+
+        placed = await stored_users(shard_engines)
+        assert placed == {user.id: shards.ring.get(user.id) for user in users}
+        assert len(set(placed.values())) == 3
+
+        items = [make_transaction(user.id, '1', TransactionType.WITHDRAW) for user in users]
+        items.insert(3, make_transaction(users[0].id, '100', TransactionType.WITHDRAW))
+        results = await repo.create_transactions_bulk(items)
+        assert isinstance(results[3], InsufficientFundsError)
+        assert [result.id for i, result in enumerate(results) if i != 3] == [
+            item.id for i, item in enumerate(items) if i != 3]
+
+        assert (await repo.get_transaction(items[-1].id)).user_id == users[-1].id
+        assert await repo.get_transaction(uuid.uuid4()) is None
+        assert await repo.get_user_balance(users[0].id) == Decimal('9')
+        missing = uuid.uuid4()
+        balances = {user_id: balance async for user_id, balance in repo.get_user_balances(
+            [user.id for user in users] + [missing])}
+        assert balances == {user.id: Decimal('9') for user in users}
+        assert [t.amount for t in await repo.get_user_transactions(users[5].id)] == [Decimal('1'), Decimal('10')]
+
+    @pytest.mark.asyncio
+    async def test_fail_transaction_id_used_on_another_shard(self, shard_engines):
+        shards = ShardSet.from_engines(shard_engines)
+        repo = ShardedPaymentRepository(shards)
+        users = await create_users(repo, 12)
+        first = users[0].id
+        other = next(user.id for user in users if shards.ring.get(user.id) != shards.ring.get(first))
+        transaction = await repo.create_transaction(make_transaction(first, '1'))
+        reused = make_transaction(other, '1').model_copy(update={"id": transaction.id})
+
+        with pytest.raises(TransactionAlreadyExistsError):
+            await repo.create_transaction(reused)
+        results = await repo.create_transactions_bulk([make_transaction(other, '2'), reused])
+        assert results[0].amount == Decimal('2')
+        assert isinstance(results[1], TransactionAlreadyExistsError)
+        assert (await repo.get_transaction(transaction.id)).user_id == first
+        assert await repo.get_user_balance(other) == Decimal('12')
+
+        # A write racing the check, as if done by a repository that only knows the other shard.
+        other_shard = shards.ring.get(other)
+        racing = ShardedPaymentRepository(ShardSet.from_engines({other_shard: shard_engines[other_shard]}))
+        await racing.create_transaction(reused)
+        with pytest.raises(TransactionIdConflictError):
+            await repo.get_transaction(transaction.id)
+
+    @pytest.mark.asyncio
+    async def test_success_app(self, shard_engines):
+        builder = AppBuilder(shard_dsns={name: engine.url.render_as_string(hide_password=False)
+                                         for name, engine in shard_engines.items()})
+        await builder.init_async_resources()
+        transport = httpx.ASGITransport(app=builder.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                user_ids = [str(user_id) for user_id in USERS[:6]]
+                for user_id in user_ids:
+                    await client.post("/api/users/", json={"id": user_id, "name": "Test User"})
+                response = await client.post("/api/transactions/batch", json=[
+                    {"id": str(uuid.uuid4()), "user_id": user_id, "amount": "10", "type": "DEPOSIT"}
+                    for user_id in user_ids])
+                assert [item["status_code"] for item in response.json()] == [200] * 6
+                transaction_id, reused = response.json()[-1]["id"], response.json()[0]["id"]
+                assert (await client.get(f"/api/transactions/{transaction_id}")).status_code == 200
+                response = await client.post("/api/users/balances:batch", json={"user_ids": user_ids})
+                balances = {item["user_id"]: item["balance"] for item in response.json()}
+                assert balances == dict.fromkeys(user_ids, "10.00")
+                shards = ShardSet.from_engines(shard_engines)
+                other = next(user_id for user_id in USERS[1:6] if shards.ring.get(user_id) != shards.ring.get(USERS[0]))
+                transaction = {"id": reused, "user_id": str(other), "amount": "10", "type": "DEPOSIT"}
+                assert (await client.post("/api/transactions/", json=transaction)).status_code == 400
+                # A write racing the check, as if done by a repository that only knows the other shard.
+                other_shard = shards.ring.get(other)
+                racing = ShardedPaymentRepository(ShardSet.from_engines({other_shard: shard_engines[other_shard]}))
+                await racing.create_transaction(make_transaction(other, '10').model_copy(
+                    update={"id": uuid.UUID(reused)}))
+                assert (await client.get(f"/api/transactions/{reused}")).status_code == 409
+        finally:
+            await builder.tear_down()
+        shards = ShardSet.from_engines(shard_engines)
+        assert await stored_users(shard_engines) == {user_id: shards.ring.get(user_id) for user_id in USERS[:6]}
+
+
+@pytest.mark.skipif(len(TEST_SHARD_DATABASE_URLS) < 3, reason="TEST_SHARD_DATABASE_URLS needs 3 databases")
+class TestRebalance:
+    @pytest.mark.asyncio
+    async def test_success_add_and_drain_shard(self, shard_engines):
+        two = dict(list(shard_engines.items())[:2])
+        new_name, new_engine = list(shard_engines.items())[2]
+        repo = ShardedPaymentRepository(ShardSet.from_engines(two), write_mode=WriteMode.LEDGER)
+        users = await create_users(repo, 20)
+        # Not checkpointed yet: folded into the balance of the moved users.
+        await repo.create_transactions_bulk([make_transaction(user.id, '5') for user in users])
+        transaction_id = (await repo.get_user_transactions(users[0].id))[0].id
+
+        assert await rebalance(shard_engines, dry_run=True) == await rebalance(shard_engines)
+        moved = await stored_users(shard_engines)
+        assert moved == {user.id: HashRing(shard_engines).get(user.id) for user in users}
+        assert new_name in moved.values()
+        assert await rebalance(shard_engines) == ({}, [])
+
+        repo = ShardedPaymentRepository(ShardSet.from_engines(shard_engines), write_mode=WriteMode.LEDGER)
+        for user in users:
+            assert await repo.get_user_balance(user.id) == Decimal('15')
+            assert len(await repo.get_user_transactions(user.id)) == 2
+        assert (await repo.get_transaction(transaction_id)).user_id == users[0].id
+        async with new_engine.connect() as conn:
+            ledger_rows = sa.select(sa.func.count()).select_from(Transaction).where(Transaction.seq.is_not(None))
+            assert await conn.scalar(ledger_rows) == 0
+
+        assert sum((await rebalance(two, drain={new_name: new_engine})).moved.values()) == list(
+            moved.values()).count(new_name)
+        assert set((await stored_users(shard_engines)).values()) == set(two)
+        repo = ShardedPaymentRepository(ShardSet.from_engines(two), write_mode=WriteMode.LEDGER)
+        for user in users:
+            assert await repo.get_user_balance(user.id) == Decimal('15')
+
+    @pytest.mark.asyncio
+    async def test_fail_transaction_id_conflicts(self, shard_engines):
+        two = dict(list(shard_engines.items())[:2])
+        new_name = list(shard_engines)[2]
+        old_repo = ShardedPaymentRepository(ShardSet.from_engines(two))
+        new_repo = ShardedPaymentRepository(ShardSet.from_engines(shard_engines))
+        users = await create_users(old_repo, 20)
+        moving = [user.id for user in users if HashRing(shard_engines).get(user.id) == new_name]
+        # Written while the new shard was not checked yet: it already uses one of a moving user's IDs.
+        new_shard_repo = ShardedPaymentRepository(ShardSet.from_engines({new_name: shard_engines[new_name]}))
+        transaction_id = (await old_repo.get_user_transactions(moving[0]))[0].id
+        other = next(user_id for user_id in USERS[20:] if HashRing(shard_engines).get(user_id) == new_name)
+        await new_shard_repo.create_user(UserCreate(id=other, name="Test User"))
+        await new_shard_repo.create_transaction(make_transaction(other, '1').model_copy(update={"id": transaction_id}))
+
+        with pytest.raises(TransactionIdConflictError):
+            await new_repo.get_transaction(transaction_id)
+        assert (await rebalance(shard_engines, dry_run=True)).conflicts == [moving[0]]
+        result = await rebalance(shard_engines)
+
+        assert result.conflicts == [moving[0]]
+        assert sum(result.moved.values()) == len(moving) - 1
+        placed = await stored_users(shard_engines)
+        assert placed[moving[0]] == old_repo.shards.ring.get(moving[0])
+        assert all(placed[user_id] == new_name for user_id in moving[1:])
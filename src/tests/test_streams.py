@@ -0,0 +1,139 @@
+import asyncio
+import contextlib
+import os
+import uuid
+from decimal import Decimal
+
+import asyncpg
+import fastapi
+import httpx
+import pytest
+import sqlalchemy as sa
+
+from app.api import payments
+from app.db.resources import get_balance_stream
+from app.enums import TransactionType, WriteMode
+from app.exceptions import UserNotExistsError
+from app.repositories import PaymentRepository
+from app.streams.balances import BALANCE_CHANGES_CHANNEL, BalanceChangeHub, balance_change_payload
+from tests.conftest import make_transaction
+
+
+def listen_dsn():
+    return sa.make_url(os.getenv("TEST_DATABASE_URL")).set(drivername="postgresql").render_as_string(
+        hide_password=False)
+
+
+@contextlib.asynccontextmanager
+async def running_hub(fetch_balance):
+    hub = BalanceChangeHub(connect=lambda: asyncpg.connect(listen_dsn()), fetch_balance=fetch_balance)
+    task = asyncio.create_task(hub.run())
+    try:
+        while not hub.stats.connects:
+            await asyncio.sleep(0.01)
+        yield hub
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        await hub.close()
+
+
+class TestBalanceChangeNotifications:
+    @pytest.mark.parametrize("write", [WriteMode.LOCKING, WriteMode.ATOMIC, WriteMode.LEDGER, "bulk", "ledger_bulk"])
+    @pytest.mark.asyncio
+    async def test_success_subscribers_get_committed_balances(self, db_session, user, write):
+        write_mode = {"bulk": WriteMode.LOCKING, "ledger_bulk": WriteMode.LEDGER}.get(write, write)
+        repo = PaymentRepository(db_session, write_mode=write_mode, notify_balance_changes=True)
+
+        async with running_hub(repo.get_user_balance) as hub:
+            with hub.subscribe(user.id) as queue, hub.subscribe(user.id) as other_queue:
+                for amount, transaction_type in (('100', TransactionType.DEPOSIT), ('30', TransactionType.WITHDRAW)):
+                    transaction = make_transaction(user.id, amount, transaction_type)
+                    if isinstance(write, str):
+                        await repo.create_transactions_bulk([transaction])
+                    else:
+                        await repo.create_transaction(transaction)
+                    expected = Decimal('100') if transaction_type == TransactionType.DEPOSIT else Decimal('70')
+                    assert await asyncio.wait_for(queue.get(), 5) == expected
+                    assert await asyncio.wait_for(other_queue.get(), 5) == expected
+
+            assert hub.subscriber_count() == 0
+            assert hub.stats.refreshes == (2 if write_mode == WriteMode.LEDGER else 0)
+
+    @pytest.mark.asyncio
+    async def test_fail_rejected_transactions_do_not_notify(self, db_session, user):
+        repo = PaymentRepository(db_session, write_mode=WriteMode.ATOMIC, notify_balance_changes=True)
+
+        async with running_hub(repo.get_user_balance) as hub:
+            with hub.subscribe(user.id) as queue:
+                with pytest.raises(Exception):
+                    await repo.create_transaction(make_transaction(user.id, '1', TransactionType.WITHDRAW))
+                await PaymentRepository(db_session).create_transaction(make_transaction(user.id, '1'))
+                await asyncio.sleep(0.2)
+
+                assert queue.empty()
+                assert hub.stats.notifications == 0
+
+
+class TestBalanceChangeHub:
+    @pytest.mark.asyncio
+    async def test_success_slow_subscribers_get_latest_balance(self):
+        hub = BalanceChangeHub(connect=None, fetch_balance=None)
+        user_id = uuid.uuid4()
+
+        with hub.subscribe(user_id) as queue:
+            for balance in ('1', '2', '3'):
+                hub._on_notification(None, 0, BALANCE_CHANGES_CHANNEL, balance_change_payload(user_id, Decimal(balance)))
+            hub._on_notification(None, 0, BALANCE_CHANGES_CHANNEL, balance_change_payload(uuid.uuid4(), Decimal(9)))
+
+            assert queue.get_nowait() == Decimal('3')
+            assert queue.empty()
+        assert (hub.stats.notifications, hub.stats.published, hub.stats.conflated) == (4, 3, 2)
+
+    @pytest.mark.asyncio
+    async def test_success_refreshes_are_coalesced(self):
+        reads = []
+        release = asyncio.Event()
+
+        async def fetch_balance(user_id):
+            reads.append(user_id)
+            await release.wait()
+            return Decimal(len(reads))
+
+        hub = BalanceChangeHub(connect=None, fetch_balance=fetch_balance)
+        user_id = uuid.uuid4()
+        with hub.subscribe(user_id) as queue:
+            hub._on_notification(None, 0, BALANCE_CHANGES_CHANNEL, balance_change_payload(user_id))
+            await asyncio.sleep(0)
+            for _ in range(4):
+                hub._on_notification(None, 0, BALANCE_CHANGES_CHANNEL, balance_change_payload(user_id))
+            release.set()
+            while hub._refreshing:
+                await asyncio.sleep(0.01)
+
+            # One read in flight and one after it for all the notifications it may have missed.
+            assert len(reads) == 2
+            assert queue.get_nowait() == Decimal(2)
+
+
+class TestBalanceStreamApi:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("error", [UserNotExistsError("unknown"), RuntimeError("database down")])
+    async def test_fail_initial_read_unsubscribes(self, error):
+        async def fetch_balance(user_id):
+            raise error
+
+        hub = BalanceChangeHub(connect=None, fetch_balance=fetch_balance)
+        app = fastapi.FastAPI()
+        app.include_router(payments.ROUTER, prefix="/api")
+        app.dependency_overrides[get_balance_stream] = lambda: hub
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            if isinstance(error, UserNotExistsError):
+                assert (await client.get(f"/api/users/{uuid.uuid4()}/balance/stream")).status_code == 400
+            else:
+                with pytest.raises(RuntimeError, match="database down"):
+                    await client.get(f"/api/users/{uuid.uuid4()}/balance/stream")
+
+        assert hub.subscriber_count() == 0